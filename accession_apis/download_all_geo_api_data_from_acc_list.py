@@ -6,9 +6,13 @@ import sys, os, time
 from pathlib import Path
 from datetime import datetime
 from timeit import default_timer as timer
-import json
-import requests
-import backoff
+
+import http_client
+from geo_download import (
+    clean_accession_numbers,
+    download_geo_records,
+    NCBI_REQUESTS_PER_SECOND,
+)
 
 try:
     from humanfriendly import format_timespan
@@ -26,34 +30,27 @@ logger = root_logger.getChild(__name__)
 import pandas as pd
 import numpy as np
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=300)
-def make_request(url: str, method="GET", **kwargs) -> requests.Request:
-    r = requests.request(method=method, url=url, **kwargs)
-    r.raise_for_status()
-    return r
-
-
 def main(args):
+    if args.cache:
+        http_client.enable_cache(args.cache, offline=args.cache_only)
     logger.info(f"loading accession numbers from input file: {args.input}")
-    accession_numbers = Path(args.input).read_text().split("\n")
+    # (blank lines and duplicates are dropped)
+    accession_numbers = clean_accession_numbers(
+        Path(args.input).read_text().split("\n")
+    )
     outfp = Path(args.output)
     logger.info(f"found {len(accession_numbers)} accession numbers")
 
-    logger.info(f"opening file for write: {outfp}")
-    with outfp.open("w") as outf:
-        i = 0
-        for acc in accession_numbers:
-            api_url = f"https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={acc.lower()}&targ=self&view=brief&form=text"
-            r = make_request(api_url)
-            line = {
-                "acc_no": acc,
-                "api_response": r.text,
-            }
-            outf.write(f"{json.dumps(line)}\n")
-            i += 1
-            if i in [5, 10, 20, 50, 100] or i % 500 == 0:
-                logger.info(f"downloaded {i} entries so far. The last accession number downloaded was {acc}")
-        logger.info(f"finished downloading {i} entries. The last accession number downloaded was {acc}")
+    logger.info(f"appending to file: {outfp}")
+    num_downloaded = download_geo_records(
+        accession_numbers,
+        outfp,
+        max_workers=args.max_workers,
+        api_key=args.api_key or os.environ.get("NCBI_API_KEY"),
+        requests_per_second=args.requests_per_second,
+    )
+    logger.info(f"finished downloading {num_downloaded} entries to {outfp}")
+    http_client.log_stats()
 
 
 if __name__ == "__main__":
@@ -76,10 +73,39 @@ if __name__ == "__main__":
     parser.add_argument(
         "input", help="path to newline separated accession numbers file"
     )
-    parser.add_argument("output", help="path to the output file (JSON-lines)")
+    parser.add_argument(
+        "output",
+        help="path to the output file (JSON-lines). if it already exists, it is appended to, and the accession numbers already in it are skipped",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=4,
+        help="maximum number of requests to run at once (default: 4)",
+    )
+    parser.add_argument(
+        "--api-key",
+        help="NCBI API key, which raises the rate limit from 3 to 10 requests per second (default: the NCBI_API_KEY environment variable)",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        help=f"rate limit (default: {NCBI_REQUESTS_PER_SECOND}, or 10 with an API key)",
+    )
+    parser.add_argument(
+        "--cache",
+        help="path to a response cache file (SQLite). API responses are read from and saved to this cache",
+    )
+    parser.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="only use responses from the cache (no network requests). requires --cache",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
+    if args.cache_only and not args.cache:
+        parser.error("--cache-only requires --cache")
     if args.debug:
         root_logger.setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
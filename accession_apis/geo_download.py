@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# concurrent download of GEO records (the acc.cgi text view) for a list of accession numbers,
+# shared by download_all_geo_api_data.py and download_all_geo_api_data_from_acc_list.py.
+# requests run in a bounded thread pool behind one rate limiter, following the NCBI usage guidelines
+# (3 requests per second, or 10 with an API key). the output is JSON-lines, one
+# {"acc_no": ..., "api_response": ...} line per accession number, only ever appended to,
+# so an interrupted download can be resumed: accession numbers already in the output are skipped
+
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Set, Union
+
+import http_client
+from http_client import TokenBucket
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+GEO_API_URL = "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi"
+NCBI_REQUESTS_PER_SECOND = 3
+NCBI_REQUESTS_PER_SECOND_WITH_API_KEY = 10
+
+
+def clean_accession_numbers(accession_numbers: Iterable[str]) -> List[str]:
+    # strip whitespace, and drop blank lines and duplicates (case-insensitive, keeping the first one)
+    seen = set()
+    cleaned = []
+    for acc in accession_numbers:
+        acc = acc.strip()
+        if not acc or acc.upper() in seen:
+            continue
+        seen.add(acc.upper())
+        cleaned.append(acc)
+    return cleaned
+
+
+def read_downloaded_accessions(outfp: Union[str, Path]) -> Set[str]:
+    # accession numbers (upper case) already in an output file.
+    # a last line cut off by an interrupted run is removed from the file, so that appending continues
+    # after the last complete line
+    outfp = Path(outfp)
+    downloaded = set()
+    if not outfp.exists():
+        return downloaded
+    with outfp.open("rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            downloaded.add(json.loads(line)["acc_no"].upper())
+            end += len(line)
+        if end < f.tell():
+            logger.warning(f"removing incomplete last line from {outfp}")
+            f.truncate(end)
+    return downloaded
+
+
+def get_geo_record(
+    acc: str,
+    api_key: str | None = None,
+    rate_limiter: TokenBucket | None = None,
+    max_time: float = 300,
+) -> dict:
+    params = {"acc": acc.lower(), "targ": "self", "view": "brief", "form": "text"}
+    if api_key:
+        params["api_key"] = api_key
+    r = http_client.make_request(
+        GEO_API_URL,
+        params=params,
+        raise_for_status=True,
+        rate_limiter=rate_limiter,
+        max_time=max_time,
+    )
+    return {"acc_no": acc, "api_response": r.text}
+
+
+def download_geo_records(
+    accession_numbers: Iterable[str],
+    outfp: Union[str, Path],
+    max_workers: int = 4,
+    api_key: str | None = None,
+    requests_per_second: float | None = None,
+    max_time: float = 300,
+) -> int:
+    # download the GEO records for the accession numbers that are not in outfp yet, and append them to it.
+    # lines are written in the order of accession_numbers. returns the number of records downloaded
+    outfp = Path(outfp)
+    accession_numbers = clean_accession_numbers(accession_numbers)
+    downloaded = read_downloaded_accessions(outfp)
+    to_download = [acc for acc in accession_numbers if acc.upper() not in downloaded]
+    logger.info(
+        f"{len(accession_numbers)} unique accession numbers: {len(accession_numbers) - len(to_download)} already in {outfp}, {len(to_download)} to download"
+    )
+    if requests_per_second is None:
+        requests_per_second = (
+            NCBI_REQUESTS_PER_SECOND_WITH_API_KEY if api_key else NCBI_REQUESTS_PER_SECOND
+        )
+    # no bursts: requests are spaced evenly, so no one-second window has more than the limit
+    rate_limiter = TokenBucket(requests_per_second, capacity=1)
+    i = 0
+    with outfp.open("a") as outf, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+
+        def write_next():
+            line = futures.popleft().result()
+            outf.write(f"{json.dumps(line)}\n")
+            # flushed line by line, so that a crash loses at most the requests in flight
+            outf.flush()
+            return line["acc_no"]
+
+        for acc in to_download:
+            futures.append(
+                executor.submit(
+                    get_geo_record,
+                    acc,
+                    api_key=api_key,
+                    rate_limiter=rate_limiter,
+                    max_time=max_time,
+                )
+            )
+            # keep a bounded number of requests queued, and write in order
+            if len(futures) >= max_workers * 2:
+                last_acc = write_next()
+                i += 1
+                if i in [5, 10, 20, 50, 100] or i % 500 == 0:
+                    logger.info(
+                        f"downloaded {i} entries so far. The last accession number downloaded was {last_acc}"
+                    )
+        while futures:
+            write_next()
+            i += 1
+    return i
@@ -8,7 +8,8 @@ from datetime import datetime
 from timeit import default_timer as timer
 import json
 import requests
-import backoff
+
+import http_client
 
 try:
     from humanfriendly import format_timespan
@@ -27,11 +28,10 @@ import pandas as pd
 import numpy as np
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=300)
 def make_request(url: str, method="GET", **kwargs) -> requests.Request:
-    r = requests.request(method=method, url=url, **kwargs)
-    r.raise_for_status()
-    return r
+    return http_client.make_request(
+        url, method=method, raise_for_status=True, max_time=300, **kwargs
+    )
 
 
 def concatenate_row(row: pd.Series) -> str:
@@ -66,6 +66,8 @@ def get_result(idx, q, url) -> dict:
 
 
 def main(args):
+    if args.cache:
+        http_client.enable_cache(args.cache, offline=args.cache_only)
     filename = args.input
     outfp = Path(args.output)
     logger.info(f"loading input data from {filename}")
@@ -86,6 +88,7 @@ def main(args):
                     f"processed {i} / {len(df_geo_affil_dedup)} entries so far."
                 )
         logger.info(f"finished processing {i} / {len(df_geo_affil_dedup)} entries.")
+    http_client.log_stats()
 
 
 if __name__ == "__main__":
@@ -107,9 +110,20 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument("input", help="path to csv file")
     parser.add_argument("output", help="path to the output file (JSON-lines)")
+    parser.add_argument(
+        "--cache",
+        help="path to a response cache file (SQLite). API responses are read from and saved to this cache",
+    )
+    parser.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="only use responses from the cache (no network requests). requires --cache",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
+    if args.cache_only and not args.cache:
+        parser.error("--cache-only requires --cache")
     if args.debug:
         root_logger.setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
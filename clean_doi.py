@@ -3,6 +3,19 @@
 import re
 import unicodedata
 import math
+import functools
+
+# test cases for this regex are at https://regex101.com/r/zS4hA0/1
+DOI_PATTERN = re.compile(r"(10\.\d+\/[^\s]+)")
+
+# ASCII-only equivalents of the steps in clean_doi, written for the RE2 engine used
+# by pyarrow.compute. Python's \s (for str patterns) also matches \x1c-\x1f and
+# RE2's \s does not match \v, so the whitespace class is spelled out explicitly.
+# In ASCII, the only characters in the unicode categories C, M, Z that can be part of
+# a match are the non-whitespace control characters.
+_ASCII_WHITESPACE = " \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+_ASCII_DOI_PATTERN = r"(?P<doi>10\.[0-9]+/[^ \t\n\r\x0b\x0c\x1c-\x1f]+)"
+_ASCII_NONPRINTING_PATTERN = r"[\x00-\x08\x0e-\x1b\x7f]"
 
 
 # from https://stackoverflow.com/a/70274772
@@ -55,28 +68,26 @@ def replace_doi_bad_chars(doi):
     return doi
 
 
-def clean_doi(dirty_doi, return_none_if_error=False):
-    if not dirty_doi or is_nan(dirty_doi):
-        if return_none_if_error:
+def clean_doi_or_none(dirty_doi):
+    # same as clean_doi, but returns None instead of raising NoDoiException.
+    # this is the fast path for columns where many values are not DOIs (e.g. accession numbers),
+    # since raising and catching an exception for every one of them is slow
+    if isinstance(dirty_doi, str):
+        # cheap pre-check: there can't be a match without this substring
+        if "10." not in dirty_doi:
             return None
-        else:
-            raise NoDoiException("There's no DOI at all.")
+    elif not dirty_doi or is_nan(dirty_doi):
+        return None
 
     dirty_doi = dirty_doi.strip()
     dirty_doi = dirty_doi.lower()
     dirty_doi = replace_doi_bad_chars(dirty_doi)
 
-    # test cases for this regex are at https://regex101.com/r/zS4hA0/1
-    p = re.compile(r"(10\.\d+\/[^\s]+)")
+    match = DOI_PATTERN.search(dirty_doi)
+    if match is None:
+        return None
 
-    matches = re.findall(p, dirty_doi)
-    if len(matches) == 0:
-        if return_none_if_error:
-            return None
-        else:
-            raise NoDoiException("There's no valid DOI.")
-
-    match = matches[0]
+    match = match.group(1)
     match = remove_nonprinting_characters(match)
 
     try:
@@ -96,3 +107,113 @@ def clean_doi(dirty_doi, return_none_if_error=False):
         resp = resp[:-1]
 
     return resp
+
+
+def clean_doi(dirty_doi, return_none_if_error=False):
+    resp = clean_doi_or_none(dirty_doi)
+    if resp is None and not return_none_if_error:
+        if not dirty_doi or is_nan(dirty_doi):
+            raise NoDoiException("There's no DOI at all.")
+        else:
+            raise NoDoiException("There's no valid DOI.")
+    return resp
+
+
+# optional memoization layer. DOIs repeat heavily across citations (e.g. publications citing many datasets)
+DOI_CACHE_MAXSIZE = 1_000_000
+
+_clean_doi_cached = functools.lru_cache(maxsize=DOI_CACHE_MAXSIZE)(clean_doi_or_none)
+
+
+def clean_doi_cached(dirty_doi):
+    # same as clean_doi_or_none, with results memoized in a bounded LRU cache keyed on the raw string.
+    # use doi_cache_info() to see the hit/miss counts
+    if not isinstance(dirty_doi, str):
+        # NaN is not equal to itself, so it can't be looked up in the cache
+        return clean_doi_or_none(dirty_doi)
+    return _clean_doi_cached(dirty_doi)
+
+
+def doi_cache_info():
+    # returns a named tuple (hits, misses, maxsize, currsize)
+    return _clean_doi_cached.cache_info()
+
+
+def set_doi_cache_maxsize(maxsize):
+    # replace the cache with a new (empty) one with a different size bound
+    global _clean_doi_cached
+    _clean_doi_cached = functools.lru_cache(maxsize=maxsize)(clean_doi_or_none)
+
+
+def clear_doi_cache():
+    _clean_doi_cached.cache_clear()
+
+
+def clean_doi_array(dirty_dois):
+    # vectorized version of clean_doi, for a whole column at once.
+    # takes a pyarrow string array (or anything pyarrow.array() accepts)
+    # and returns a tuple of two pyarrow arrays: (cleaned_dois, is_doi).
+    # cleaned_dois is null where the input is not a DOI.
+    # ASCII values (nearly all of the corpus) are cleaned with pyarrow compute kernels.
+    # the remaining values fall back to clean_doi_or_none, so results are identical to the scalar function.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if isinstance(dirty_dois, pa.ChunkedArray):
+        dirty_dois = dirty_dois.combine_chunks()
+    if not isinstance(dirty_dois, pa.Array):
+        dirty_dois = pa.array(dirty_dois, type=pa.string(), from_pandas=True)
+    if pa.types.is_dictionary(dirty_dois.type):
+        dirty_dois = dirty_dois.dictionary_decode()
+    if not pa.types.is_string(dirty_dois.type):
+        dirty_dois = dirty_dois.cast(pa.string())
+
+    # cheap pre-check: only values containing "10." can be DOIs
+    has_prefix = pc.fill_null(pc.match_substring(dirty_dois, "10."), False)
+    candidates = pc.filter(dirty_dois, has_prefix)
+
+    arr = pc.ascii_trim(candidates, characters=_ASCII_WHITESPACE)
+    arr = pc.ascii_lower(arr)
+    arr = pc.extract_regex(arr, _ASCII_DOI_PATTERN).flatten()[0]
+    arr = pc.replace_substring_regex(arr, _ASCII_NONPRINTING_PATTERN, "")
+    # remove any url fragments
+    arr = pc.replace_substring_regex(arr, "#.*", "", max_replacements=1)
+    # remove double quotes
+    arr = pc.replace_substring(arr, '"', "")
+    # remove trailing period, comma
+    arr = pc.replace_substring_regex(arr, "[,.]$", "", max_replacements=1)
+
+    # non-ASCII values go through the scalar function
+    is_non_ascii = pc.invert(pc.string_is_ascii(candidates))
+    non_ascii_values = pc.filter(candidates, is_non_ascii).to_pylist()
+    if non_ascii_values:
+        replacements = pa.array(
+            [clean_doi_or_none(value) for value in non_ascii_values],
+            type=pa.string(),
+        )
+        arr = pc.replace_with_mask(arr, is_non_ascii, replacements)
+
+    arr = pc.replace_with_mask(
+        pa.nulls(len(dirty_dois), type=pa.string()), has_prefix, arr
+    )
+    is_doi = pc.is_valid(arr)
+    return arr, is_doi
+
+
+def clean_doi_series(dirty_dois):
+    # pandas version of clean_doi_array.
+    # returns a tuple of two series with the same index as the input: (cleaned_dois, is_doi).
+    # cleaned_dois is <NA> where the input is not a DOI
+    import pandas as pd
+    import pyarrow as pa
+
+    cleaned, is_doi = clean_doi_array(
+        pa.array(dirty_dois.astype("string"), type=pa.string(), from_pandas=True)
+    )
+    cleaned = pd.Series(
+        cleaned.to_pandas(), index=dirty_dois.index, name=dirty_dois.name
+    ).astype("string")
+    is_doi = pd.Series(
+        is_doi.to_numpy(zero_copy_only=False), index=dirty_dois.index, name="is_doi"
+    )
+    return cleaned, is_doi
@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """shared ingestion of the Data Citation Corpus: a single pass over the JSON dump, cached as parquet"""
+
+# the corpus JSON files are parsed once into a parquet file in a cache directory (by default .corpus_cache
+# inside the corpus directory), together with the content hashes of the records. the cache is keyed
+# on the source files: their names, sizes and modification times, and the hashes of their contents,
+# so it is rebuilt when the dump changes (and a file that was only touched is re-hashed, not re-parsed).
+# consumers read only the columns and rows they need from the cache, e.g.
+#   load_corpus_table(path_to_corpus, columns=["dataset"], filter=pc.field("repository") == "Gene Expression Omnibus (GEO)")
+
+import os
+import json
+import hashlib
+import shutil
+from pathlib import Path
+from typing import Tuple, Dict, List, Iterator, Optional, Union
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from clean_doi import clean_doi_series
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+
+# dtypes of the columns of the corpus dataframe
+CORPUS_DTYPES = {
+    "id": "string",
+    "title": "string",
+    "publisher": "category",
+    "journal": "category",
+    "repository": "category",
+    "publication": "string",
+    "dataset": "string",
+    "source": "category",
+}
+
+
+# flat columns with fixed arrow types, so that the part files written for each input file have the same schema
+# (the nested columns -- affiliations, funders, subjects -- keep their inferred types)
+CORPUS_COLUMN_TYPES = {
+    "id": pa.string(),
+    "title": pa.string(),
+    "publisher": pa.dictionary(pa.int32(), pa.string()),
+    "journal": pa.dictionary(pa.int32(), pa.string()),
+    "repository": pa.dictionary(pa.int32(), pa.string()),
+    "publication": pa.string(),
+    "publication_is_doi": pa.bool_(),
+    "dataset": pa.string(),
+    "dataset_is_doi": pa.bool_(),
+    "source": pa.dictionary(pa.int32(), pa.string()),
+}
+
+
+def iter_json_array(fp: Path, chunk_size: int = 1 << 22) -> Iterator[Dict]:
+    # parse a file holding one JSON array incrementally, yielding its elements one at a time,
+    # so that the whole text of the file (and all of its records) is never in memory at once
+    decoder = json.JSONDecoder()
+    with open(fp, "r", encoding="utf-8") as f:
+        buf = ""
+        while not buf:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buf = chunk.lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"{fp} does not contain a JSON array")
+        pos = 1
+        eof = False
+        while True:
+            # skip whitespace and the comma between elements
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf = f.read(chunk_size)
+                pos = 0
+                eof = not buf
+            if pos >= len(buf):
+                raise ValueError(f"{fp}: unexpected end of file")
+            if buf[pos] == "]":
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                # the element is only complete if it is followed by a comma or the end of the array
+                # (otherwise it may have been cut off, e.g. a number split between two chunks)
+                j = end
+                while j < len(buf) and buf[j] in " \t\r\n":
+                    j += 1
+                complete = j < len(buf) and buf[j] in ",]"
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                if eof:
+                    raise ValueError(f"{fp}: invalid JSON array")
+                # the element runs past the end of the buffer: read more and try again
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield record
+            pos = end
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
+
+
+def iter_record_batches(fp: Path, batch_size: int = 10000) -> Iterator[List[Dict]]:
+    batch = []
+    for record in iter_json_array(fp):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def records_to_frame(records: List[Dict]) -> pd.DataFrame:
+    # the columns of the corpus dataframe (with the id as the index) for a list of corpus records
+    data = {
+        "id": [r["id"] for r in records],
+        "title": [r["title"] for r in records],
+        "publisher": [r.get("publisher", {}).get("title") for r in records],
+        "journal": [r.get("journal", {}).get("title") for r in records],
+        "repository": [r.get("repository", {}).get("title") for r in records],
+        "publication": [r["publication"] for r in records],
+        "dataset": [r["dataset"] for r in records],
+        "publishedDate": [r.get("publishedDate") for r in records],
+        "source": [r["source"] for r in records],
+        "affiliations": [r.get("affiliations") for r in records],
+        "funders": [r.get("funders") for r in records],
+        "subjects": [r.get("subjects") for r in records],
+    }
+    df_corpus = pd.DataFrame(data)
+    # clean the whole columns at once. values that are not DOIs are kept as they are
+    insert_after = "dataset"
+    for col in ["publication", "dataset"]:
+        cleaned, is_doi = clean_doi_series(df_corpus[col])
+        df_corpus[col] = cleaned.where(is_doi, df_corpus[col].astype("string"))
+        df_corpus.insert(
+            df_corpus.columns.get_loc(insert_after) + 1, f"{col}_is_doi", is_doi
+        )
+        insert_after = f"{col}_is_doi"
+    for col, dtype in CORPUS_DTYPES.items():
+        df_corpus[col] = df_corpus[col].astype(dtype)
+    df_corpus["publishedDate"] = pd.to_datetime(df_corpus["publishedDate"])
+    return df_corpus.set_index("id")
+
+
+def frame_to_table(df_corpus: pd.DataFrame) -> pa.Table:
+    table = pa.Table.from_pandas(df_corpus)
+    for i, field in enumerate(table.schema):
+        if field.name in CORPUS_COLUMN_TYPES:
+            table = table.set_column(
+                i, field.name, table[field.name].cast(CORPUS_COLUMN_TYPES[field.name])
+            )
+    return table
+
+
+# content hashes of the records are written next to the output file (as {stem}.hashes.parquet),
+# so that the next release of the corpus can be converted incrementally (see apply_corpus_delta in scripts/corpus_data_to_parquet.py)
+HASHES_SCHEMA = pa.schema([("id", pa.string()), ("content_hash", pa.uint64())])
+
+
+def get_hashes_path(path: Path) -> Path:
+    return path.with_name(f"{path.stem}.hashes.parquet")
+
+
+def hash_text(text: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(text.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def record_content_hash(record: Dict) -> int:
+    # hash of the content of a raw corpus record (the same whatever the order of its keys)
+    return hash_text(
+        json.dumps(record, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    )
+
+
+def load_previous_hashes(path: Path) -> Tuple[np.ndarray, np.ndarray]:
+    # (hashes of the ids, content hashes) of a previous conversion, sorted by id hash for lookups
+    table = pq.read_table(path)
+    id_keys = np.fromiter(
+        (hash_text(x) for x in table["id"].to_pylist()),
+        dtype=np.uint64,
+        count=table.num_rows,
+    )
+    order = np.argsort(id_keys)
+    return id_keys[order], table["content_hash"].to_numpy()[order]
+
+
+def get_changes(
+    ids: List[str],
+    content_hashes: np.ndarray,
+    previous: Tuple[np.ndarray, np.ndarray],
+) -> np.ndarray:
+    # for each record: "added" (id not in the previous conversion), "changed" (different content),
+    # or "" (unchanged)
+    previous_keys, previous_content_hashes = previous
+    keys = np.fromiter((hash_text(x) for x in ids), dtype=np.uint64, count=len(ids))
+    changes = np.full(len(ids), "", dtype=object)
+    if len(previous_keys):
+        idx = np.minimum(previous_keys.searchsorted(keys), len(previous_keys) - 1)
+        found = previous_keys[idx] == keys
+    else:
+        idx = np.zeros(len(ids), dtype=np.int64)
+        found = np.zeros(len(ids), dtype=bool)
+    changes[~found] = "added"
+    changes[found & (previous_content_hashes[idx] != content_hashes)] = "changed"
+    return changes
+
+
+def convert_file_to_parquet(
+    fp: Path,
+    outfp: Path,
+    hashes_outfp: Path,
+    batch_size: int = 10000,
+    row_group_size: int = 100000,
+    previous: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+) -> Tuple[int, int]:
+    # convert one corpus JSON file to parquet, batch by batch. the batches are held as arrow tables
+    # (much smaller than the python records) until the end, when their schemas are unified,
+    # as a nested column can be all null in one batch and have values in another.
+    # the content hashes of all of the records are written to hashes_outfp.
+    # if `previous` (see load_previous_hashes) is given, only the records that were added or changed
+    # since the previous conversion are converted, with a "change" column saying which.
+    # returns (number of records, number of records converted)
+    tables = []
+    hash_tables = []
+    for records in iter_record_batches(fp, batch_size=batch_size):
+        ids = [r["id"] for r in records]
+        content_hashes = np.fromiter(
+            (record_content_hash(r) for r in records),
+            dtype=np.uint64,
+            count=len(records),
+        )
+        hash_tables.append(
+            pa.table({"id": ids, "content_hash": content_hashes}, schema=HASHES_SCHEMA)
+        )
+        if previous is None:
+            tables.append(frame_to_table(records_to_frame(records)))
+            continue
+        changes = get_changes(ids, content_hashes, previous)
+        to_convert = changes != ""
+        if to_convert.any():
+            table = frame_to_table(
+                records_to_frame([r for r, x in zip(records, to_convert) if x])
+            )
+            tables.append(
+                table.append_column(
+                    "change",
+                    pa.array(changes[to_convert], type=pa.string()),
+                )
+            )
+    if not tables:
+        table = frame_to_table(records_to_frame([]))
+        if previous is not None:
+            table = table.append_column("change", pa.array([], type=pa.string()))
+        tables.append(table)
+    table = pa.concat_tables(tables, promote_options="permissive")
+    pq.write_table(table, outfp, row_group_size=row_group_size)
+    pq.write_table(
+        pa.concat_tables(hash_tables or [HASHES_SCHEMA.empty_table()]), hashes_outfp
+    )
+    num_records = sum(t.num_rows for t in hash_tables)
+    logger.debug(f"{fp.name}: wrote {table.num_rows} of {num_records} records to {outfp}")
+    return num_records, table.num_rows
+
+
+def combine_hashes_parts(hashes_part_files: List[Path], outfp: Path) -> pa.Array:
+    # write the content hashes of all of the records to one file, and return the ids.
+    # ids must be unique, like the index of the dataframe the corpus used to be loaded into
+    table = pa.concat_tables(
+        [pq.read_table(fp, schema=HASHES_SCHEMA) for fp in hashes_part_files]
+        or [HASHES_SCHEMA.empty_table()]
+    )
+    ids = table["id"].combine_chunks()
+    if pc.count_distinct(ids).as_py() != len(ids):
+        raise ValueError("Index has duplicate keys: corpus ids are not unique")
+    pq.write_table(table, outfp)
+    return ids
+
+
+def combine_corpus_parts(
+    part_files: List[Path], outfp: Path, row_group_size: int = 100000
+) -> int:
+    # stream the part files (in order) into one parquet file with a unified schema
+    schema = pa.unify_schemas(
+        [pq.read_schema(fp) for fp in part_files], promote_options="permissive"
+    )
+    num_rows = 0
+    with pq.ParquetWriter(outfp, schema) as writer:
+        for fp in part_files:
+            for batch in pq.ParquetFile(fp).iter_batches(batch_size=row_group_size):
+                table = pa.Table.from_batches([batch])
+                writer.write_table(table.cast(schema), row_group_size=row_group_size)
+                num_rows += batch.num_rows
+    return num_rows
+
+
+
+# bump this when the conversion changes, so that existing caches are rebuilt
+CACHE_VERSION = 1
+CACHE_DIRNAME = ".corpus_cache"
+CACHE_FILENAME = "corpus.parquet"
+
+
+def get_cache_dir(path_to_corpus: Union[str, Path]) -> Path:
+    return Path(path_to_corpus).joinpath(CACHE_DIRNAME)
+
+
+def get_cache_meta_path(cache_dir: Path) -> Path:
+    return cache_dir.joinpath("corpus.meta.json")
+
+
+def hash_file(fp: Path, chunk_size: int = 1 << 24) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_sources(files: List[Path], previous_sources: Optional[List[Dict]] = None) -> List[Dict]:
+    # description of the corpus files (name, size, modification time, hash of the contents).
+    # a file's hash is taken from previous_sources if its size and modification time have not changed,
+    # so that checking an up-to-date cache doesn't read the whole dump
+    known = {
+        (x["name"], x["size"], x["mtime_ns"]): x["blake2b"]
+        for x in previous_sources or []
+    }
+    sources = []
+    for fp in files:
+        stat = os.stat(fp)
+        key = (fp.name, stat.st_size, stat.st_mtime_ns)
+        file_hash = known.get(key)
+        if file_hash is None:
+            file_hash = hash_file(fp)
+        sources.append(
+            {
+                "name": fp.name,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "blake2b": file_hash,
+            }
+        )
+    return sources
+
+
+def read_cache_meta(cache_dir: Path) -> Optional[Dict]:
+    meta_path = get_cache_meta_path(cache_dir)
+    if not meta_path.exists():
+        return None
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"could not read corpus cache metadata {meta_path} ({e})")
+        return None
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    if not cache_dir.joinpath(CACHE_FILENAME).exists():
+        return None
+    return meta
+
+
+def build_corpus_cache(
+    files: List[Path],
+    cache_dir: Path,
+    n_jobs: int = 1,
+    batch_size: int = 10000,
+) -> int:
+    # parse the corpus files into the cache (corpus.parquet, and the content hashes in corpus.hashes.parquet).
+    # each file is converted to a part file by a worker process, and the part files are then streamed
+    # into the cache file, which replaces the old one only once it is complete
+    from joblib import Parallel, delayed
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partsdir = cache_dir.joinpath("parts")
+    if partsdir.exists():
+        shutil.rmtree(partsdir)
+    partsdir.mkdir()
+    part_files = [
+        partsdir.joinpath(f"{i:05d}_{fp.stem}.parquet") for i, fp in enumerate(files)
+    ]
+    hashes_part_files = [
+        partsdir.joinpath(f"{i:05d}_{fp.stem}.hashes.parquet")
+        for i, fp in enumerate(files)
+    ]
+    Parallel(n_jobs=n_jobs, verbose=10 if n_jobs != 1 else 0)(
+        delayed(convert_file_to_parquet)(
+            fp, part_fp, hashes_part_fp, batch_size=batch_size
+        )
+        for fp, part_fp, hashes_part_fp in zip(files, part_files, hashes_part_files)
+    )
+    cache_fp = cache_dir.joinpath(CACHE_FILENAME)
+    tmp_fp = partsdir.joinpath(CACHE_FILENAME)
+    combine_hashes_parts(hashes_part_files, get_hashes_path(tmp_fp))
+    num_rows = combine_corpus_parts(part_files, tmp_fp)
+    os.replace(get_hashes_path(tmp_fp), get_hashes_path(cache_fp))
+    os.replace(tmp_fp, cache_fp)
+    shutil.rmtree(partsdir)
+    return num_rows
+
+
+def ensure_corpus_cache(
+    path_to_corpus: Union[str, Path],
+    cache_dir: Optional[Union[str, Path]] = None,
+    glob_pattern: str = "*.json",
+    n_jobs: int = 1,
+    batch_size: int = 10000,
+) -> Path:
+    # path to an up-to-date cache file for the corpus, (re)building the cache if the corpus files changed
+    path_to_corpus = Path(path_to_corpus)
+    cache_dir = Path(cache_dir) if cache_dir else get_cache_dir(path_to_corpus)
+    cache_fp = cache_dir.joinpath(CACHE_FILENAME)
+    files = sorted(path_to_corpus.glob(glob_pattern))
+    meta = read_cache_meta(cache_dir)
+    previous_sources = meta["sources"] if meta else None
+    sources = get_sources(files, previous_sources)
+    if meta and [
+        (x["name"], x["size"], x["blake2b"]) for x in previous_sources
+    ] == [(x["name"], x["size"], x["blake2b"]) for x in sources]:
+        if previous_sources != sources:
+            # only the modification times changed
+            meta["sources"] = sources
+            get_cache_meta_path(cache_dir).write_text(json.dumps(meta))
+        logger.debug(f"using corpus cache {cache_fp}")
+        return cache_fp
+    logger.info(
+        f"parsing {len(files)} corpus files from {path_to_corpus} into cache {cache_fp}"
+    )
+    # the metadata is removed first, so that an interrupted build leaves no cache that looks valid
+    get_cache_meta_path(cache_dir).unlink(missing_ok=True)
+    num_rows = build_corpus_cache(files, cache_dir, n_jobs=n_jobs, batch_size=batch_size)
+    meta = {"version": CACHE_VERSION, "num_rows": num_rows, "sources": sources}
+    get_cache_meta_path(cache_dir).write_text(json.dumps(meta))
+    logger.info(f"cached {num_rows} corpus records in {cache_fp}")
+    return cache_fp
+
+
+def load_corpus_table(
+    path_to_corpus: Union[str, Path],
+    columns: Optional[List[str]] = None,
+    filter=None,
+    cache_dir: Optional[Union[str, Path]] = None,
+    **kwargs,
+) -> pa.Table:
+    # the corpus as an arrow table (only `columns`, and the rows matching the pyarrow expression `filter`),
+    # read from the cache. other keyword arguments are passed to ensure_corpus_cache
+    cache_fp = ensure_corpus_cache(path_to_corpus, cache_dir=cache_dir, **kwargs)
+    return ds.dataset(cache_fp, format="parquet").to_table(
+        columns=columns, filter=filter
+    )
+
+
+def load_corpus_frame(
+    path_to_corpus: Union[str, Path],
+    columns: Optional[List[str]] = None,
+    filter=None,
+    cache_dir: Optional[Union[str, Path]] = None,
+    **kwargs,
+) -> pd.DataFrame:
+    # the corpus as a dataframe indexed by id, with the dtypes of CORPUS_DTYPES
+    if columns is not None and "id" not in columns:
+        columns = ["id"] + list(columns)
+    return load_corpus_table(
+        path_to_corpus, columns=columns, filter=filter, cache_dir=cache_dir, **kwargs
+    ).to_pandas()
@@ -4,10 +4,11 @@ from typing import Union, Set, Generator, Iterable
 from pathlib import Path
 
 import requests
-import backoff
 from bs4 import BeautifulSoup
 import io
 
+import http_client
+
 import pandas as pd
 import numpy as np
 
@@ -18,11 +19,10 @@ logger = logging.getLogger().getChild(__name__)
 URL_ACCESSION_DATA = "https://europepmc.org/ftp/TextMinedTerms"
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=60)
 def make_request(url: str, method="GET", **kwargs) -> requests.Request:
-    r = requests.request(method=method, url=url, **kwargs)
-    r.raise_for_status()
-    return r
+    return http_client.make_request(
+        url, method=method, raise_for_status=True, max_time=60, **kwargs
+    )
 
 
 def accession_csv_to_dataframe(
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """shared HTTP client for all of the API helpers: one pooled session with a unified retry policy"""
+
+import time
+import threading
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from response_cache import ResponseCache, DEFAULT_MAX_SIZE
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+# maximum number of open connections to any one host
+MAX_CONNECTIONS_PER_HOST = 16
+# maximum number of hosts to keep connection pools for
+MAX_HOSTS = 32
+
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+_cache = None
+
+_stats = defaultdict(
+    lambda: {"requests": 0, "retries": 0, "total_latency": 0.0, "cache_hits": 0}
+)
+_stats_lock = threading.Lock()
+
+
+class TokenBucket:
+    # thread-safe token bucket rate limiter.
+    # tokens are added at `rate` per second, up to `capacity`. acquire() blocks until a token is available
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session() -> requests.Session:
+    # return the shared session, creating it on first use.
+    # connections are kept alive and reused across calls, with at most
+    # MAX_CONNECTIONS_PER_HOST open connections to any one host
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers.update(DEFAULT_HEADERS)
+            adapter = HTTPAdapter(
+                pool_connections=MAX_HOSTS,
+                pool_maxsize=MAX_CONNECTIONS_PER_HOST,
+                pool_block=True,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def enable_cache(
+    path,
+    max_size: int = DEFAULT_MAX_SIZE,
+    ttl: float | None = None,
+    offline: bool = False,
+) -> ResponseCache:
+    # cache successful GET responses on disk for all calls to make_request.
+    # with offline=True, nothing goes to the network and a cache miss raises response_cache.CacheMissError
+    global _cache
+    _cache = ResponseCache(path, max_size=max_size, ttl=ttl, offline=offline)
+    logger.info(f"using response cache: {path} (offline: {offline})")
+    return _cache
+
+
+def disable_cache() -> None:
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def get_retry_after(r: requests.Response) -> float | None:
+    # parse the Retry-After header (either a number of seconds or an HTTP date)
+    value = r.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _record(url: str, latency: float, retry: bool, cache_hit: bool = False) -> None:
+    host = urlparse(url).netloc
+    with _stats_lock:
+        stats = _stats[host]
+        if cache_hit:
+            stats["cache_hits"] += 1
+            return
+        stats["requests"] += 1
+        stats["total_latency"] += latency
+        if retry:
+            stats["retries"] += 1
+
+
+def make_request(
+    url: str,
+    method: str = "GET",
+    raise_for_status: bool = False,
+    rate_limiter: TokenBucket | None = None,
+    max_time: float = 60,
+    **kwargs,
+) -> requests.Response:
+    # make a request using the shared session. this is the retry policy for all of the API helpers:
+    # connection errors and responses with status >= 429 are retried with exponential backoff,
+    # honoring the Retry-After header if the server sends one. other errors are not retried.
+    # after max_time seconds, the last response is returned (or the last exception raised).
+    # if raise_for_status is True, an HTTPError is raised for an error response.
+    # if the response cache is enabled (see enable_cache), GET requests are looked up there first
+    cache = _cache if method.upper() == "GET" else None
+    if cache is not None:
+        r = cache.get(method, url, params=kwargs.get("params"))
+        if r is not None:
+            _record(url, 0.0, retry=False, cache_hit=True)
+            return r
+    session = get_session()
+    start = time.monotonic()
+    wait = 1.0
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        this_start = time.monotonic()
+        try:
+            r = session.request(method=method, url=url, **kwargs)
+        except requests.exceptions.RequestException:
+            _record(url, time.monotonic() - this_start, retry=attempt > 0)
+            if time.monotonic() - start + wait > max_time:
+                raise
+            delay = wait
+        else:
+            _record(url, time.monotonic() - this_start, retry=attempt > 0)
+            if r.status_code < 429:
+                break
+            retry_after = get_retry_after(r)
+            delay = retry_after if retry_after is not None else wait
+            if time.monotonic() - start + delay > max_time:
+                break
+            logger.debug(f"got status code {r.status_code}. retrying in {delay:.1f}s")
+        time.sleep(delay)
+        wait = min(wait * 2, 60)
+        attempt += 1
+    if cache is not None and r.status_code == 200:
+        cache.put(method, url, r, params=kwargs.get("params"))
+    if raise_for_status:
+        r.raise_for_status()
+    return r
+
+
+def get_stats() -> dict[str, dict]:
+    # per-host request statistics: number of requests, retries, mean latency,
+    # and how many connections were opened (requests - connections = reused connections)
+    session = get_session()
+    connections = defaultdict(int)
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections[pool.host] += pool.num_connections
+    out = {}
+    with _stats_lock:
+        for host, stats in _stats.items():
+            num_connections = connections.get(host.split(":")[0], 0)
+            out[host] = {
+                "requests": stats["requests"],
+                "retries": stats["retries"],
+                "cache_hits": stats["cache_hits"],
+                "mean_latency": stats["total_latency"] / max(1, stats["requests"]),
+                "connections_opened": num_connections,
+                "connections_reused": max(0, stats["requests"] - num_connections),
+            }
+    return out
+
+
+def log_stats() -> None:
+    for host, stats in get_stats().items():
+        logger.info(
+            f"{host}: {stats['requests']} requests ({stats['retries']} retries, {stats['cache_hits']} cache hits), "
+            f"mean latency {stats['mean_latency']:.3f}s, "
+            f"{stats['connections_opened']} connections opened, {stats['connections_reused']} reused"
+        )
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# global dictionary encoding of OpenAIRE IDs as int64 codes.
+# the dictionary is the sorted list of all OpenAIRE IDs in the types files, and an ID's code is its
+# position in that list. it is written once by the type/DOI collection step, and downstream steps
+# join, sort and group on the codes instead of the (~50 character) ID strings.
+# because the list is sorted, ordering by code is the same as ordering by ID string
+
+from pathlib import Path
+from typing import Union, Iterable, List, Optional
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+# written to the same directory as the types and doi files
+ID_DICTIONARY_FILENAME = "openaire_id_dictionary.parquet"
+
+
+def build_id_dictionary(files: Iterable[Union[str, Path]]):
+    # sorted array (pyarrow) of the unique OpenAIRE IDs in the given types files
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    chunks = []
+    for fp in files:
+        column = pq.read_table(fp, columns=["openaire_id"])["openaire_id"]
+        chunks.append(pc.unique(column))
+    if not chunks:
+        return pa.array([], type=pa.string())
+    ids = pc.unique(pa.chunked_array(chunks, type=pa.string()))
+    return ids.take(pc.array_sort_indices(ids))
+
+
+def write_id_dictionary(files: Iterable[Union[str, Path]], outfp: Union[str, Path]) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    ids = build_id_dictionary(files)
+    table = pa.table(
+        {
+            "openaire_id": ids,
+            "id_code": pa.array(range(len(ids)), type=pa.int64()),
+        }
+    )
+    pq.write_table(table, outfp)
+    logger.info(f"wrote dictionary of {len(ids)} openaire ids to {outfp}")
+    return len(ids)
+
+
+def to_sort_keys(openaire_ids):
+    # fixed-width bytes numpy array of ID strings, for binary search with np.searchsorted.
+    # bytes compare like arrow sorts strings (by their UTF-8 bytes), so the dictionary order is kept
+    import pyarrow as pa
+
+    if not isinstance(openaire_ids, (pa.Array, pa.ChunkedArray)):
+        openaire_ids = pa.array(openaire_ids, type=pa.string())
+    if isinstance(openaire_ids, pa.ChunkedArray):
+        openaire_ids = openaire_ids.combine_chunks()
+    return (
+        openaire_ids.cast(pa.binary()).to_numpy(zero_copy_only=False).astype("S")
+    )
+
+
+class IdDictionary:
+    # encode OpenAIRE ID strings as int64 codes, and decode them back.
+    # only part of the dictionary needs to be in memory: `ids` are some of the IDs (sorted), `codes` their codes
+    # in the full dictionary, and `size` the number of IDs in the full dictionary. with from_file(path, openaire_ids),
+    # only the entries for the IDs given are read from the file, so memory scales with the IDs being joined,
+    # not with the whole graph. IDs are encoded by binary search over the sorted IDs in memory.
+    # IDs that are not in the dictionary (e.g. from relations to entities missing from the types files)
+    # get codes after the end of the dictionary, assigned in order of first appearance, so that they
+    # still encode to distinct codes and decode back to the same strings
+
+    def __init__(self, ids, codes=None, size: Optional[int] = None) -> None:
+        import numpy as np
+
+        self.ids = ids
+        if codes is None:
+            codes = np.arange(len(ids), dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.size = len(ids) if size is None else size
+        # built once here, and used by every call to encode
+        self.sort_keys = to_sort_keys(ids)
+        self.extra_codes = {}
+        self.extra_ids: List[str] = []
+
+    @classmethod
+    def from_file(
+        cls, path: Union[str, Path], openaire_ids: Optional[Iterable[str]] = None
+    ) -> "IdDictionary":
+        # the dictionary written by write_id_dictionary. if openaire_ids is given, only their entries are loaded
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        size = pq.ParquetFile(path).metadata.num_rows
+        dataset = ds.dataset(path, format="parquet")
+        row_filter = None
+        if openaire_ids is not None:
+            row_filter = pc.field("openaire_id").isin(
+                pc.unique(pa.array(openaire_ids, type=pa.string()))
+            )
+        table = dataset.to_table(columns=["openaire_id", "id_code"], filter=row_filter)
+        # the file is sorted, but the scan doesn't have to return the rows in order
+        table = table.sort_by("id_code")
+        return cls(
+            table["openaire_id"].combine_chunks(),
+            table["id_code"].to_numpy(),
+            size=size,
+        )
+
+    @classmethod
+    def from_types_files(
+        cls,
+        files: Iterable[Union[str, Path]],
+        openaire_ids: Optional[Iterable[str]] = None,
+    ) -> "IdDictionary":
+        # built from the types files. if openaire_ids is given, only those IDs are kept
+        # (the codes are then only valid for this dictionary, not for a dictionary file)
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        ids = build_id_dictionary(files)
+        if openaire_ids is not None:
+            ids = ids.filter(
+                pc.is_in(
+                    ids, value_set=pc.unique(pa.array(openaire_ids, type=pa.string()))
+                )
+            )
+        return cls(ids)
+
+    def __len__(self) -> int:
+        return self.size + len(self.extra_ids)
+
+    def encode(self, openaire_ids):
+        # numpy int64 array of codes for a sequence (pandas Series, pyarrow array, list) of ID strings
+        import numpy as np
+
+        keys = to_sort_keys(openaire_ids)
+        codes = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.sort_keys):
+            idx = np.minimum(
+                np.searchsorted(self.sort_keys, keys), len(self.sort_keys) - 1
+            )
+            found = self.sort_keys[idx] == keys
+            codes[found] = self.codes[idx[found]]
+        missing = np.flatnonzero(codes == -1)
+        for i in missing:
+            openaire_id = keys[i].decode()
+            code = self.extra_codes.get(openaire_id)
+            if code is None:
+                code = self.size + len(self.extra_ids)
+                self.extra_codes[openaire_id] = code
+                self.extra_ids.append(openaire_id)
+            codes[i] = code
+        return codes
+
+    def decode(self, codes):
+        # numpy object array of ID strings for an array of codes
+        import numpy as np
+        import pyarrow as pa
+
+        codes = np.asarray(codes, dtype=np.int64)
+        ids = self.ids
+        # positions in `ids` (sorted by code) for codes in the dictionary, and after its end for extra codes
+        positions = np.searchsorted(self.codes, codes)
+        is_extra = codes >= self.size
+        positions[is_extra] = len(ids) + (codes[is_extra] - self.size)
+        if self.extra_ids:
+            ids = pa.concat_arrays([ids, pa.array(self.extra_ids, type=pa.string())])
+        return ids.take(pa.array(positions)).to_numpy(zero_copy_only=False)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# compact membership test for large sets of OpenAIRE IDs.
+# the IDs are stored as a sorted array of 64-bit hashes in a .npy file, which is memory-mapped,
+# so any number of worker processes can share one copy (through the OS page cache) instead of
+# each holding a multi-GB python set. with tens of millions of IDs, the chance of a false positive
+# from a hash collision is around 1e-12 per lookup
+
+import os
+import json
+import math
+from itertools import islice
+from pathlib import Path
+from typing import Union, Iterable, List, Dict
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+# stored in the metadata file: an id set built with a different hash function has to be rebuilt
+HASH_NAME = "splitmix64-words"
+HASH_BATCH_SIZE = 1000000
+
+
+def mix64(x):
+    # splitmix64 finalizer, on a numpy uint64 array (wraps around on overflow)
+    import numpy as np
+
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_ids(openaire_ids: Iterable[str]):
+    # 64-bit hashes (numpy uint64 array) of the IDs, computed with numpy for all of the IDs at once:
+    # each ID's UTF-8 bytes are read as 8-byte words and mixed in one at a time.
+    # the words past the end of a shorter ID are zero (IDs have no NUL characters) and are skipped,
+    # so an ID hashes the same whatever the other IDs in the batch are
+    import numpy as np
+    from .id_dictionary import to_sort_keys
+
+    keys = to_sort_keys(openaire_ids)
+    width = -(-max(keys.itemsize, 1) // 8) * 8
+    words = keys.astype(f"S{width}").view("<u8").reshape(len(keys), width // 8)
+    h = np.full(len(keys), 0x9E3779B97F4A7C15, dtype=np.uint64)
+    for j in range(words.shape[1]):
+        h = np.where(words[:, j] != 0, mix64(h ^ words[:, j]), h)
+    return h
+
+
+def hash_id(openaire_id: str) -> int:
+    return int(hash_ids([openaire_id])[0])
+
+
+def check_id_set_path(path: Union[str, Path]) -> Path:
+    # np.save would add .npy to any other path, and the file would then not be found under the name given
+    path = Path(path)
+    if path.suffix != ".npy":
+        raise ValueError(f"id set file must have a .npy suffix: {path}")
+    return path
+
+
+def get_bloom_path(path: Union[str, Path]) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.stem}.bloom.npy")
+
+
+def get_meta_path(path: Union[str, Path]) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.stem}.meta.json")
+
+
+def get_sources(files: Iterable[Union[str, Path]]) -> List[Dict]:
+    # description of the input files (path, size, modification time), used to tell whether an id set is stale
+    sources = []
+    for fp in sorted(Path(fp) for fp in files):
+        stat = os.stat(fp)
+        sources.append(
+            {"path": str(fp.resolve()), "size": stat.st_size, "mtime": stat.st_mtime}
+        )
+    return sources
+
+
+def read_meta(path: Union[str, Path]) -> Dict | None:
+    meta_path = get_meta_path(path)
+    if not Path(path).exists() or not meta_path.exists():
+        return None
+    try:
+        return json.loads(meta_path.read_text())
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"could not read id set metadata {meta_path} ({e})")
+        return None
+
+
+def build_id_set(
+    ids: Iterable[str],
+    path: Union[str, Path],
+    bloom_bits_per_item: int = 0,
+    sources: Dict | None = None,
+) -> "IdSet":
+    # write the id set file (and, if bloom_bits_per_item > 0, a Bloom filter next to it), and open it.
+    # the Bloom filter can save the binary search for most lookups of IDs that are not in the set.
+    # `sources` (a description of the inputs, see get_sources) is stored in the metadata file,
+    # so that a stale id set can be detected
+    import numpy as np
+
+    path = check_id_set_path(path)
+    ids = iter(ids)
+    hashes = []
+    while batch := list(islice(ids, HASH_BATCH_SIZE)):
+        hashes.append(hash_ids(batch))
+    hashes = np.unique(np.concatenate(hashes)) if hashes else np.zeros(0, dtype=np.uint64)
+    np.save(path, hashes)
+    logger.debug(f"wrote {len(hashes)} id hashes to {path}")
+    meta = {
+        "num_ids": int(len(hashes)),
+        "sources": sources,
+        "hash": HASH_NAME,
+        "bloom": None,
+    }
+    bloom_path = get_bloom_path(path)
+    if bloom_bits_per_item > 0 and len(hashes):
+        num_bits = len(hashes) * bloom_bits_per_item
+        num_hashes = max(1, round(bloom_bits_per_item * math.log(2)))
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        bits = np.zeros(num_bits, dtype=bool)
+        for i in range(num_hashes):
+            bits[(h1 + np.uint64(i) * h2) % np.uint64(num_bits)] = True
+        np.save(bloom_path, np.packbits(bits, bitorder="little"))
+        # the packed array is padded to a whole number of bytes,
+        # so the number of bits the positions were computed with has to be stored
+        meta["bloom"] = {"num_bits": num_bits, "num_hashes": num_hashes}
+        logger.debug(f"wrote Bloom filter ({num_bits} bits) to {bloom_path}")
+    elif bloom_path.exists():
+        bloom_path.unlink()
+    get_meta_path(path).write_text(json.dumps(meta))
+    id_set = IdSet(path)
+    if id_set.bloom is not None:
+        # every id that went in has to pass the Bloom filter as it is read back
+        bloom = np.unpackbits(np.asarray(id_set.bloom), bitorder="little")
+        for i in range(id_set.num_hashes):
+            if not bloom[(h1 + np.uint64(i) * h2) % np.uint64(id_set.num_bits)].all():
+                raise RuntimeError(f"Bloom filter {bloom_path} is missing ids")
+    return id_set
+
+
+class IdSet:
+    # read-only set of OpenAIRE IDs supporting `openaire_id in id_set`, backed by a file written by build_id_set.
+    # pickling an IdSet only pickles the path, so sending it to worker processes is cheap,
+    # and each worker maps the same file
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        import numpy as np
+
+        self.path = check_id_set_path(path)
+        self.hashes = np.load(self.path, mmap_mode="r")
+        self.bloom = None
+        meta = read_meta(self.path) or {}
+        if meta.get("hash") != HASH_NAME:
+            raise ValueError(
+                f"id set {self.path} was not built with hash {HASH_NAME} (rebuild it with build_id_set)"
+            )
+        if meta.get("bloom"):
+            self.bloom = np.load(get_bloom_path(self.path), mmap_mode="r")
+            self.num_bits = meta["bloom"]["num_bits"]
+            self.num_hashes = meta["bloom"]["num_hashes"]
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state) -> None:
+        self.__init__(state["path"])
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, openaire_id: str) -> bool:
+        # for many lookups, contains_many is much faster
+        return bool(self.contains_many([openaire_id])[0])
+
+    def contains_many(self, openaire_ids: Iterable[str]):
+        # boolean numpy array: which of the IDs are in the set.
+        # the Bloom filter (if any) is probed for all of the IDs at once, and only the ones
+        # that pass it are looked up in the hashes
+        import numpy as np
+
+        h = hash_ids(openaire_ids)
+        found = np.zeros(len(h), dtype=bool)
+        if not len(self.hashes) or not len(h):
+            return found
+        candidates = np.arange(len(h))
+        if self.bloom is not None:
+            h1 = h & np.uint64(0xFFFFFFFF)
+            h2 = (h >> np.uint64(32)) | np.uint64(1)
+            passed = np.ones(len(h), dtype=bool)
+            for i in range(self.num_hashes):
+                pos = (h1 + np.uint64(i) * h2) % np.uint64(self.num_bits)
+                passed &= ((self.bloom[pos >> np.uint64(3)] >> (pos & np.uint64(7))) & 1).astype(bool)
+            candidates = candidates[passed]
+        # looking the hashes up in sorted order keeps the binary searches in nearby parts of the file
+        candidates = candidates[np.argsort(h[candidates])]
+        hc = h[candidates]
+        idx = np.minimum(self.hashes.searchsorted(hc), len(self.hashes) - 1)
+        found[candidates] = np.asarray(self.hashes[idx] == hc)
+        return found
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# helpers for joining tables that don't fit in memory together:
+# each input is spilled to disk in partitions by a hash of its join key, and then the tables are
+# joined one partition at a time (rows with equal keys are always in the same partition).
+# the results are streamed to a parquet file as they are produced
+
+from pathlib import Path
+from typing import Union, List, Sequence
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+
+def get_partition_numbers(df, key_columns: Sequence[str], num_partitions: int):
+    # partition number for each row of df, from a hash of the key columns.
+    # string columns are hashed as python objects, so that the same keys get the same partition
+    # whether they are stored with object dtype or pandas' string dtype
+    import numpy as np
+    import pandas as pd
+
+    h = np.zeros(len(df), dtype=np.uint64)
+    for colname in key_columns:
+        values = df[colname]
+        if not pd.api.types.is_numeric_dtype(values.dtype):
+            values = values.astype(object)
+        h = h * np.uint64(1000003) ^ pd.util.hash_array(values.to_numpy())
+    return (h % np.uint64(num_partitions)).astype(np.int64)
+
+
+class PartitionedSpill:
+    # a table spilled to disk in num_partitions partitions by a hash of key_columns.
+    # it can be written in any number of chunks, and each partition read back as one dataframe
+
+    def __init__(
+        self,
+        dirpath: Union[str, Path],
+        name: str,
+        key_columns: Sequence[str],
+        num_partitions: int,
+    ) -> None:
+        self.dirpath = Path(dirpath)
+        self.name = name
+        self.key_columns = list(key_columns)
+        self.num_partitions = num_partitions
+        self.num_chunks = 0
+        self.empty = None  # zero-row frame with the columns and dtypes, for partitions without rows
+
+    def get_partition_path(self, partition: int, chunk: int) -> Path:
+        return self.dirpath.joinpath(f"{self.name}_{partition:05d}_{chunk:05d}.parquet")
+
+    def write(self, df) -> None:
+        if self.empty is None:
+            self.empty = df.iloc[:0]
+        partitions = get_partition_numbers(df, self.key_columns, self.num_partitions)
+        for partition, df_partition in df.groupby(partitions, sort=False):
+            df_partition.to_parquet(
+                self.get_partition_path(partition, self.num_chunks), index=False
+            )
+        self.num_chunks += 1
+
+    def read(self, partition: int):
+        import pandas as pd
+
+        _dfs = []
+        for chunk in range(self.num_chunks):
+            fp = self.get_partition_path(partition, chunk)
+            if fp.exists():
+                _dfs.append(pd.read_parquet(fp))
+        if not _dfs:
+            return self.empty
+        return pd.concat(_dfs, ignore_index=True)
+
+    def delete(self, partition: int) -> None:
+        for chunk in range(self.num_chunks):
+            self.get_partition_path(partition, chunk).unlink(missing_ok=True)
+
+
+class ParquetFrameWriter:
+    # write dataframes one after another to a single parquet file.
+    # the schema comes from the first dataframe, and later ones are converted to it
+    # (e.g. a categorical column with no values in one chunk still gets the same dictionary type).
+    # empty dataframes are skipped, as the types of their columns can't always be inferred
+
+    def __init__(self, outfp: Union[str, Path]) -> None:
+        self.outfp = Path(outfp)
+        self.writer = None
+        self.schema = None
+        self.num_rows = 0
+        self.empty = None
+
+    def write(self, df) -> None:
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if len(df) == 0:
+            self.empty = df
+            return
+        for colname in df.columns:
+            # a categorical column with only missing values has float64 categories
+            if (
+                isinstance(df[colname].dtype, pd.CategoricalDtype)
+                and len(df[colname].cat.categories) == 0
+            ):
+                df = df.assign(
+                    **{
+                        colname: df[colname].cat.set_categories(
+                            pd.Index([], dtype=object)
+                        )
+                    }
+                )
+        if self.writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.schema = table.schema
+            self.writer = pq.ParquetWriter(self.outfp, self.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self.writer.write_table(table)
+        self.num_rows += len(df)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        elif self.empty is not None:
+            # nothing but empty dataframes: still write the (empty) file
+            self.empty.to_parquet(self.outfp, index=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# helpers for working with the members of the OpenAIRE graph dump .tar files
+# (each .tar holds many gzipped JSON-lines files)
+
+import io
+import os
+import json
+import mmap
+import tarfile
+from pathlib import Path
+from typing import Union, List, Dict, Callable, NamedTuple, Iterable
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+
+# sidecar index files are written next to the .tar file, e.g. relation_1.tar.index.json
+INDEX_SUFFIX = ".index.json"
+
+
+class TarMember(NamedTuple):
+    name: str
+    offset: int  # offset of the member's data (not its header) in the .tar file
+    size: int
+
+
+def get_index_path(path_to_tarfile: Union[str, Path]) -> Path:
+    path_to_tarfile = Path(path_to_tarfile)
+    return path_to_tarfile.with_name(f"{path_to_tarfile.name}{INDEX_SUFFIX}")
+
+
+def scan_tar_members(path_to_tarfile: Union[str, Path]) -> List[TarMember]:
+    # read through the headers of a .tar file, listing the regular file members
+    # with where their data starts and how big they are
+    with tarfile.open(path_to_tarfile, "r") as tar:
+        return [
+            TarMember(name=member.name, offset=member.offset_data, size=member.size)
+            for member in tar.getmembers()
+            if member.isfile()
+        ]
+
+
+def read_tar_index(path_to_tarfile: Union[str, Path]) -> List[TarMember] | None:
+    # load the sidecar index, if there is one and it matches the .tar file (same size and modification time)
+    index_path = get_index_path(path_to_tarfile)
+    if not index_path.exists():
+        return None
+    try:
+        index = json.loads(index_path.read_text())
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"could not read tar index {index_path} ({e})")
+        return None
+    stat = os.stat(path_to_tarfile)
+    if (
+        index.get("tar_size") != stat.st_size
+        or index.get("tar_mtime") != stat.st_mtime
+    ):
+        logger.debug(f"tar index {index_path} is out of date")
+        return None
+    return [TarMember(*member) for member in index["members"]]
+
+
+def write_tar_index(
+    path_to_tarfile: Union[str, Path], members: List[TarMember]
+) -> None:
+    index_path = get_index_path(path_to_tarfile)
+    stat = os.stat(path_to_tarfile)
+    index = {
+        "tar_size": stat.st_size,
+        "tar_mtime": stat.st_mtime,
+        "members": [list(member) for member in members],
+    }
+    # write to a temporary file and then rename it, so the index is never left half-written
+    tmp_path = index_path.with_name(f"{index_path.name}.tmp")
+    try:
+        tmp_path.write_text(json.dumps(index))
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logger.warning(f"could not write tar index {index_path} ({e})")
+
+
+def index_tar_members(
+    path_to_tarfile: Union[str, Path], use_index: bool = True
+) -> List[TarMember]:
+    # list the members of a .tar file (see scan_tar_members).
+    # with use_index=True, the list is read from the sidecar index file if it is up to date,
+    # and otherwise the .tar file is scanned and the sidecar index written for next time
+    if not use_index:
+        return scan_tar_members(path_to_tarfile)
+    members = read_tar_index(path_to_tarfile)
+    if members is None:
+        logger.debug(f"scanning {path_to_tarfile} for members")
+        members = scan_tar_members(path_to_tarfile)
+        write_tar_index(path_to_tarfile, members)
+    return members
+
+
+class TarMemberReader(io.RawIOBase):
+    # read-only file object for the data of one tar member, reading directly from the .tar file
+    # at the member's offset (no need to read through the archive up to it).
+    # with use_mmap=True, the .tar file is memory-mapped instead of read with seek/read calls
+
+    def __init__(
+        self,
+        path_to_tarfile: Union[str, Path],
+        member: TarMember,
+        use_mmap: bool = False,
+    ) -> None:
+        self.f = open(path_to_tarfile, "rb")
+        self.mm = None
+        if use_mmap:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = member.offset
+        self.size = member.size
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        self.pos = max(0, min(pos, self.size))
+        return self.pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        if self.mm is not None:
+            offset = self.start + self.pos
+            memoryview(b)[:n] = self.mm[offset : offset + n]
+        else:
+            self.f.seek(self.start + self.pos)
+            n = self.f.readinto(memoryview(b)[:n])
+        self.pos += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            if self.mm is not None:
+                self.mm.close()
+            self.f.close()
+        super().close()
+
+
+def open_tar_member(
+    path_to_tarfile: Union[str, Path], member: TarMember, use_mmap: bool = False
+) -> io.BufferedReader:
+    return io.BufferedReader(
+        TarMemberReader(path_to_tarfile, member, use_mmap=use_mmap), 1024 * 1024
+    )
+
+
+def open_tar_member_by_name(
+    path_to_tarfile: Union[str, Path], name: str, use_mmap: bool = False
+) -> io.BufferedReader:
+    # open one member of a .tar file, looking up its offset in the sidecar index
+    # Example usage:
+    # with open_tar_member_by_name("relation_1.tar", "relation/part-00042.json.gz") as f:
+    #     with gzip.GzipFile(fileobj=f) as gf:
+    #         ...
+    for member in index_tar_members(path_to_tarfile):
+        if member.name == name:
+            return open_tar_member(path_to_tarfile, member, use_mmap=use_mmap)
+    raise KeyError(f"{name} not found in {path_to_tarfile}")
+
+
+def run_on_tar_members(
+    tar_files: Iterable[Union[str, Path]],
+    func: Callable,
+    n_jobs: int = 1,
+    verbose: int = 0,
+    **kwargs,
+) -> Dict[Path, List]:
+    # call func(path_to_tarfile, member_idx, member, **kwargs) for every member of every .tar file,
+    # spreading the members over n_jobs processes. the largest members are started first,
+    # so that a few very large archives don't leave the other workers idle at the end.
+    # returns, for each .tar file, the list of results in the order of the members in the archive
+    from joblib import Parallel, delayed
+
+    tasks = []
+    for fp in tar_files:
+        fp = Path(fp)
+        members = index_tar_members(fp)
+        logger.debug(f"file {fp} has {len(members)} members")
+        for member_idx, member in enumerate(members):
+            tasks.append((fp, member_idx, member))
+    tasks.sort(key=lambda task: task[2].size, reverse=True)
+    logger.info(
+        f"running {len(tasks)} tar members in parallel -- number of parallel jobs: {n_jobs}"
+    )
+    results = Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(func)(fp, member_idx, member, **kwargs)
+        for fp, member_idx, member in tasks
+    )
+    out = {}
+    for (fp, member_idx, _), result in sorted(
+        zip(tasks, results), key=lambda x: (str(x[0][0]), x[0][1])
+    ):
+        out.setdefault(fp, []).append(result)
+    return out
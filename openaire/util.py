@@ -2,6 +2,7 @@
 
 from typing import Union, Set, Generator, Iterable
 from pathlib import Path
+from functools import lru_cache
 
 
 def yield_dataset_ids(files: Iterable[Path], openaire_type="dataset") -> Generator[Set, None, None]:
@@ -16,10 +17,53 @@ def get_dataset_ids(
     datadir: Union[str, Path],
     glob_pattern: str = "df_openaire_types*.parquet",
     openaire_type="dataset",
-) -> Set:
+    id_set_path: Union[str, Path, None] = None,
+    bloom_bits_per_item: int = 0,
+) -> Union[Set, "IdSet"]:
+    # with id_set_path (a .npy file), return a memory-mapped IdSet (see openaire/id_set.py) instead of a python set.
+    # it is built from the files the first time, and reused after that as long as it was built
+    # from the same files (unchanged) and openaire_type. otherwise it is rebuilt
     datadir = Path(datadir)
     openaire_type_files = list(datadir.glob(glob_pattern))
+    if id_set_path is not None:
+        from itertools import chain
+        from .id_set import IdSet, build_id_set, check_id_set_path, get_sources, read_meta, HASH_NAME
+
+        id_set_path = check_id_set_path(id_set_path)
+        sources = {
+            "files": get_sources(openaire_type_files),
+            "openaire_type": openaire_type,
+        }
+        meta = read_meta(id_set_path)
+        if (
+            meta is not None
+            and meta.get("sources") == sources
+            and meta.get("hash") == HASH_NAME
+            and bool(meta.get("bloom")) == (bloom_bits_per_item > 0)
+        ):
+            return IdSet(id_set_path)
+        return build_id_set(
+            chain.from_iterable(
+                yield_dataset_ids(openaire_type_files, openaire_type=openaire_type)
+            ),
+            id_set_path,
+            bloom_bits_per_item=bloom_bits_per_item,
+            sources=sources,
+        )
     ids_set = set()
     for ids_set_from_one_file in yield_dataset_ids(openaire_type_files, openaire_type=openaire_type):
         ids_set.update(ids_set_from_one_file)
     return ids_set
+
+
+@lru_cache(maxsize=1)
+def load_ids_set(path_to_ids_set: Union[str, Path]) -> Union[Set, "IdSet"]:
+    # load a set of ids: either a pickled python set, or an IdSet file (.npy) written by build_id_set.
+    # cached, so that parallel worker processes only load it once each
+    if Path(path_to_ids_set).suffix == ".npy":
+        from .id_set import IdSet
+
+        return IdSet(path_to_ids_set)
+    import pickle
+
+    return pickle.loads(Path(path_to_ids_set).read_bytes())
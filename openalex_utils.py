@@ -8,6 +8,10 @@ import numpy
 import sys, os, time
 import re
 import json
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from typing import Iterable, Mapping, Generator
@@ -21,11 +25,17 @@ except ImportError:
         return "{:.2f} seconds".format(seconds)
 
 
-import requests
-import backoff
+import http_client
+from http_client import TokenBucket
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
 
 
 # ENTITY_TYPES = {
@@ -122,18 +132,29 @@ import numpy as np
 #             return entity_type.lower()
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=60)
-@backoff.on_predicate(backoff.expo, lambda x: x.status_code >= 429, max_time=60)
-def make_request(url, params=None, debug=False):
+OPENALEX_API_URL = "https://api.openalex.org"
+
+# limits for the OpenAlex polite pool: https://docs.openalex.org/how-to-use-the-api/rate-limits-and-authentication
+OPENALEX_REQUESTS_PER_SECOND = 10
+
+
+def make_request(
+    url,
+    params=None,
+    debug=False,
+    rate_limiter: TokenBucket | None = None,
+    max_time: float = 60,
+):
+    # GET request through the shared session (see http_client.make_request for the retry policy).
+    # after max_time seconds, the last response is returned (or the last exception raised)
     if debug:
         print(url, params)
-    if params is None:
-        return requests.get(url)
-    else:
-        return requests.get(url, params=params)
+    return http_client.make_request(
+        url, params=params, rate_limiter=rate_limiter, max_time=max_time
+    )
 
 
-def paginate_openalex(url, params=None, per_page=200, debug=False):
+def paginate_openalex(url, params=None, per_page=200, debug=False, rate_limiter=None):
     if params is None:
         params = {}
     if "per-page" not in params and per_page:
@@ -141,7 +162,7 @@ def paginate_openalex(url, params=None, per_page=200, debug=False):
     cursor = "*"
     while cursor:
         params["cursor"] = cursor
-        r = make_request(url, params, debug=debug)
+        r = make_request(url, params, debug=debug, rate_limiter=rate_limiter)
         yield r
 
         page_with_results = r.json()
@@ -149,6 +170,91 @@ def paginate_openalex(url, params=None, per_page=200, debug=False):
         cursor = page_with_results["meta"]["next_cursor"]
 
 
+def get_group_by_counts(
+    url, group_by, params=None, debug=False, rate_limiter=None
+) -> dict[str, int]:
+    # number of results for each value of `group_by` (e.g. "publication_year") for the query
+    params = dict(params) if params is not None else {}
+    params.pop("select", None)
+    params["group_by"] = group_by
+    counts = {}
+    for r in paginate_openalex(url, params, debug=debug, rate_limiter=rate_limiter):
+        r.raise_for_status()
+        for group in r.json()["group_by"]:
+            counts[group["key"]] = group["count"]
+    return counts
+
+
+def paginate_openalex_sharded(
+    url,
+    shard_filters: Iterable[str],
+    params=None,
+    per_page=200,
+    max_parallel=4,
+    requests_per_second=OPENALEX_REQUESTS_PER_SECOND,
+    debug=False,
+):
+    # page through several disjoint shards of a query at once, one cursor chain per shard.
+    # each shard filter (e.g. "publication_year:2020") is added to the filter in params.
+    # yields (shard_filter, response) tuples in the order the responses arrive
+    if params is None:
+        params = {}
+    existing_filter = params.get("filter")
+    rate_limiter = TokenBucket(requests_per_second)
+    results = queue.Queue(maxsize=max_parallel * 2)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up if the consumer has stopped, so worker threads can't block forever
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def page_through_shard(shard_filter):
+        shard_params = dict(params)
+        if existing_filter:
+            shard_params["filter"] = f"{existing_filter},{shard_filter}"
+        else:
+            shard_params["filter"] = shard_filter
+        try:
+            for r in paginate_openalex(
+                url,
+                shard_params,
+                per_page=per_page,
+                debug=debug,
+                rate_limiter=rate_limiter,
+            ):
+                r.raise_for_status()
+                if not put((shard_filter, r)):
+                    return
+        except Exception as e:
+            put((shard_filter, e))
+        put((shard_filter, done))
+
+    shard_filters = list(shard_filters)
+    executor = ThreadPoolExecutor(max_workers=max_parallel)
+    try:
+        for shard_filter in shard_filters:
+            executor.submit(page_through_shard, shard_filter)
+        num_done = 0
+        while num_done < len(shard_filters):
+            shard_filter, item = results.get()
+            if item is done:
+                num_done += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield shard_filter, item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def entities_by_ids(
     id_list,
     api_endpoint="works",
@@ -172,6 +278,82 @@ def entities_by_ids(
         yield make_request(url, params=params, debug=debug)
 
 
+def entities_by_ids_concurrent(
+    id_list,
+    api_endpoint="works",
+    filterkey="openalex",
+    chunksize=100,
+    params=None,
+    max_in_flight=8,
+    requests_per_second=OPENALEX_REQUESTS_PER_SECOND,
+    base_url=OPENALEX_API_URL,
+    debug=False,
+):
+    # same as entities_by_ids, but with up to `max_in_flight` requests running at once in a thread pool,
+    # and all requests sharing one rate limiter.
+    # responses are yielded in the same order as the chunks of id_list, so output is deterministic
+    chunks = (
+        id_list[i : i + chunksize] for i in range(0, len(id_list), chunksize)
+    )
+    yield from entities_by_id_chunks_concurrent(
+        chunks,
+        api_endpoint=api_endpoint,
+        filterkey=filterkey,
+        params=params,
+        max_in_flight=max_in_flight,
+        requests_per_second=requests_per_second,
+        base_url=base_url,
+        debug=debug,
+    )
+
+
+def entities_by_id_chunks_concurrent(
+    chunks,
+    api_endpoint="works",
+    filterkey="openalex",
+    params=None,
+    max_in_flight=8,
+    requests_per_second=OPENALEX_REQUESTS_PER_SECOND,
+    base_url=OPENALEX_API_URL,
+    debug=False,
+):
+    # like entities_by_ids_concurrent, but takes an iterable of chunks (lists of ids) that are already split up.
+    # yields one response per chunk, in order
+    if params is None:
+        params = {}
+    existing_filter = params.get("filter")
+    url = f"{base_url}/{api_endpoint}"
+    rate_limiter = TokenBucket(requests_per_second)
+
+    def get_chunk_params(chunk):
+        chunk_params = dict(params)
+        chunk_params["per-page"] = len(chunk)
+        chunk_str = "|".join(chunk)
+        if existing_filter:
+            chunk_params["filter"] = existing_filter + f",{filterkey}:{chunk_str}"
+        else:
+            chunk_params["filter"] = f"{filterkey}:{chunk_str}"
+        return chunk_params
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = deque()
+        for chunk in chunks:
+            futures.append(
+                executor.submit(
+                    make_request,
+                    url,
+                    params=get_chunk_params(chunk),
+                    debug=debug,
+                    rate_limiter=rate_limiter,
+                )
+            )
+            # keep a bounded number of requests queued, and yield in order
+            if len(futures) >= max_in_flight * 2:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
 # def openalex_entities_by_ids(id_list, chunksize=100, params=None):
 #     id_list = [OpenAlexID(oid) for oid in id_list]
 #     if params is None:
@@ -205,6 +387,12 @@ def get_publisher_id(original_publisher):
         return None
 
 
+def sorted_unique(items: Iterable) -> list:
+    # sorted list of the unique items, with None last.
+    # (lists built from sets would otherwise come out in an order that depends on the process's hash seed)
+    return sorted(set(items), key=lambda x: (x is None, x or ""))
+
+
 def process_row(work: dict) -> dict:
     # process an OpenAlex work from the API, returning a flattened
     # dict with some of the data
@@ -223,13 +411,17 @@ def process_row(work: dict) -> dict:
                 if "lineage" in institution:
                     for item in institution["lineage"]:
                         lineage.add(item.split("/")[-1])
-        return list(institutions), list(institutions_ror), list(lineage)
+        return (
+            sorted_unique(institutions),
+            sorted_unique(institutions_ror),
+            sorted_unique(lineage),
+        )
 
     def get_funders(grants: list[dict]) -> list[str]:
         funders = set()
         for grant in grants:
             funders.add(grant.get("funder_display_name"))
-        return list(funders)
+        return sorted_unique(funders)
 
     def get_primary_topic(topics: list[dict]) -> tuple[str, str, str, str]:
         if not topics:
@@ -242,7 +434,7 @@ def process_row(work: dict) -> dict:
         return primary_topic_name, subfield_name, field_name, domain_name
 
     openalex_id = work["id"].split("/")[-1]
-    doi = work["doi"].replace("https://doi.org/", "")
+    doi = work["doi"].replace("https://doi.org/", "") if work.get("doi") else None
     if "pmid" in work["ids"]:
         pmid = work["ids"]["pmid"].split("/")[-1]
     else:
@@ -280,8 +472,228 @@ def process_row(work: dict) -> dict:
     return row
 
 
+# schema of the rows returned by process_row
+OPENALEX_WORKS_SCHEMA = pa.schema(
+    [
+        ("openalex_id", pa.string()),
+        ("doi", pa.string()),
+        ("pmid", pa.string()),
+        ("pmcid", pa.string()),
+        ("publication_date", pa.string()),
+        ("is_oa", pa.bool_()),
+        ("oa_url", pa.string()),
+        ("type", pa.string()),
+        ("type_crossref", pa.string()),
+        ("institutions", pa.list_(pa.string())),
+        ("institutions_ror", pa.list_(pa.string())),
+        ("lineage", pa.list_(pa.string())),
+        ("funders", pa.list_(pa.string())),
+        ("datasets", pa.list_(pa.string())),
+        ("cited_by_count", pa.int64()),
+        ("primary_topic", pa.string()),
+        ("topic_subfield", pa.string()),
+        ("topic_field", pa.string()),
+        ("topic_domain", pa.string()),
+    ]
+)
+
+
+class WorksParquetWriter:
+    # flatten OpenAlex works with process_row as they arrive, and append them to parquet files
+    # in row groups of `row_group_size` rows. a new file is started every `max_rows_per_file` rows.
+    # files are named like the JSON-lines output ({basename}_NN.parquet), starting at the first unused index.
+    # a parquet file is only readable once it is closed, so always call close() (or use as a context manager)
+
+    def __init__(
+        self,
+        outdir: str | Path,
+        basename: str = "openalex_works",
+        row_group_size: int = 100000,
+        max_rows_per_file: int = 200000,
+    ) -> None:
+        self.outdir = Path(outdir)
+        self.basename = basename
+        self.row_group_size = row_group_size
+        self.max_rows_per_file = max_rows_per_file
+        self.file_idx = 0
+        self.rows = []
+        self.writer = None
+        self.outfp = None
+        self.num_rows_this_file = 0
+        self._open_next_file()
+
+    def _open_next_file(self) -> None:
+        while True:
+            outfp = self.outdir.joinpath(f"{self.basename}_{self.file_idx:02}.parquet")
+            if outfp.exists():
+                self.file_idx += 1
+            else:
+                break
+        logger.info(f"Writing to file: {outfp}...")
+        self.outfp = outfp
+        self.writer = pq.ParquetWriter(outfp, OPENALEX_WORKS_SCHEMA)
+        self.num_rows_this_file = 0
+
+    def _flush(self) -> None:
+        if self.rows:
+            batch = pa.RecordBatch.from_pylist(self.rows, schema=OPENALEX_WORKS_SCHEMA)
+            self.writer.write_batch(batch, row_group_size=self.row_group_size)
+            self.rows = []
+
+    def write(self, work: dict) -> None:
+        self.rows.append(process_row(work))
+        self.num_rows_this_file += 1
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+        if self.num_rows_this_file >= self.max_rows_per_file:
+            self._flush()
+            logger.info(f"closing file: {self.outfp}")
+            self.writer.close()
+            self._open_next_file()
+
+    def close(self) -> None:
+        self._flush()
+        logger.info(f"closing file: {self.outfp}")
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# list columns of the rows returned by process_row
+OPENALEX_LIST_COLUMNS = [
+    field.name for field in OPENALEX_WORKS_SCHEMA if pa.types.is_list(field.type)
+]
+# compact storage for the list columns: each distinct string is stored once per array,
+# and the lists hold int32 codes into it
+COMPACT_LIST_TYPE = pa.list_(pa.dictionary(pa.int32(), pa.string()))
+
+
+def to_list_array(values: pd.Series) -> pa.Array:
+    # arrow list array for a column of lists (either python lists in an object column or an arrow-backed column)
+    if isinstance(values.dtype, pd.ArrowDtype):
+        arr = pa.array(values)
+    else:
+        arr = pa.array(values, type=pa.list_(pa.string()), from_pandas=True)
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    return arr
+
+
+def list_array_to_series(
+    arr: pa.Array | pa.ChunkedArray, index=None, compact: bool = False
+) -> pd.Series:
+    # inverse of to_list_array. with compact=True, the column is arrow-backed with dictionary-encoded strings
+    # (see COMPACT_LIST_TYPE). otherwise it holds python lists, as in the original loaders
+    if compact:
+        return pd.Series(
+            pd.arrays.ArrowExtensionArray(arr.cast(COMPACT_LIST_TYPE)), index=index
+        )
+    return pd.Series(arr.to_pylist(), index=index, dtype="object")
+
+
+def compact_list_columns(
+    df: pd.DataFrame, columns: list[str] | None = None
+) -> pd.DataFrame:
+    # convert list columns (by default, all of the list columns in OPENALEX_WORKS_SCHEMA, plus lineage_ror)
+    # to the compact arrow representation. this uses much less memory than python lists,
+    # and works with works_affiliated_with and map_lineage_to_ror
+    if columns is None:
+        columns = [
+            col for col in OPENALEX_LIST_COLUMNS + ["lineage_ror"] if col in df.columns
+        ]
+    for col in columns:
+        df[col] = list_array_to_series(
+            to_list_array(df[col]), index=df.index, compact=True
+        )
+    return df
+
+
+def map_lineage_to_ror(
+    lineage: pd.Series, ror_map: Mapping, compact: bool = False
+) -> pd.Series:
+    # map each list of OpenAlex institution IDs to a list of ROR IDs (None where there is no ROR ID).
+    # all of the IDs are looked up at once in arrow, instead of one python dict lookup at a time
+    import pyarrow.compute as pc
+
+    arr = to_list_array(lineage)
+    values = pc.list_flatten(arr)
+    keys = pa.array(list(ror_map.keys()), type=pa.string())
+    rors = pa.array(list(ror_map.values()), type=pa.string())
+    if pa.types.is_dictionary(values.type):
+        # look up each distinct ID once, then expand using the dictionary codes
+        mapped = rors.take(pc.index_in(values.dictionary, value_set=keys)).take(
+            values.indices
+        )
+    else:
+        mapped = rors.take(pc.index_in(values, value_set=keys))
+    lengths = pc.list_value_length(arr).fill_null(0).to_numpy()
+    offsets = pa.array(np.concatenate([[0], np.cumsum(lengths)]), type=pa.int32())
+    out = pa.ListArray.from_arrays(offsets, mapped, mask=arr.is_null())
+    return list_array_to_series(out, index=lineage.index, compact=compact)
+
+
+def works_affiliated_with(
+    df: pd.DataFrame, institution_ids: str | Iterable[str], column: str = "lineage"
+) -> pd.Series:
+    # boolean mask of the works affiliated with any of the given institutions.
+    # IDs can be short ("I111979921") or full ("https://openalex.org/I111979921").
+    # use column="institutions_ror" (with ROR IDs) or "lineage_ror" to query by ROR ID.
+    # Example usage:
+    # df_openalex[works_affiliated_with(df_openalex, ["I111979921", "I188538660"])]
+    import pyarrow.compute as pc
+
+    if isinstance(institution_ids, str):
+        institution_ids = [institution_ids]
+    value_set = pa.array(
+        sorted_unique(x.split("/")[-1] for x in institution_ids), type=pa.string()
+    )
+    arr = to_list_array(df[column])
+    values = pc.list_flatten(arr)
+    if pa.types.is_dictionary(values.type):
+        hits = pc.is_in(values.dictionary, value_set=value_set).take(values.indices)
+    else:
+        hits = pc.is_in(values, value_set=value_set)
+    parents = pc.list_parent_indices(arr).filter(hits.fill_null(False))
+    mask = np.zeros(len(df), dtype=bool)
+    mask[parents.to_numpy()] = True
+    return pd.Series(mask, index=df.index, name=f"affiliated_{column}")
+
+
+def get_openalex_dataframe_from_parquet(
+    datadir: str | Path,
+    glob_pattern: str = "openalex_works*.parquet",
+    columns: list[str] | None = None,
+    ror_map: Mapping | None = None,
+    compact_lists: bool = False,
+) -> pd.DataFrame:
+    # load works written by WorksParquetWriter. only the requested columns are read (no JSON parsing).
+    # like get_openalex_dataframe_from_multiple_works_files, works are deduplicated on openalex_id.
+    # with compact_lists=True, the list columns are kept in arrow (see compact_list_columns)
+    datadir = Path(datadir)
+    files = sorted(datadir.glob(glob_pattern))
+    if columns is not None:
+        columns = ["openalex_id"] + [c for c in columns if c != "openalex_id"]
+        if ror_map is not None and "lineage" not in columns:
+            columns.append("lineage")
+    df = works_table_to_dataframe(
+        pq.read_table(files, columns=columns), compact_lists=compact_lists
+    )
+    if ror_map is not None:
+        # create a new column, which is the "lineage" list mapped to ror ids
+        df["lineage_ror"] = map_lineage_to_ror(
+            df["lineage"], ror_map, compact=compact_lists
+        )
+    return df
+
+
 def get_openalex_dataframe_from_works(
-    works: Iterable[str | dict], ror_map: Mapping | None = None
+    works: Iterable[str | dict],
+    ror_map: Mapping | None = None,
+    compact_lists: bool = False,
 ) -> pd.DataFrame:
     rows = []
     seen_ids = set()
@@ -293,13 +705,12 @@ def get_openalex_dataframe_from_works(
             rows.append(process_row(work))
             seen_ids.add(openalex_id)
     df = pd.DataFrame(rows).set_index("openalex_id")
+    if compact_lists:
+        compact_list_columns(df)
     if ror_map is not None:
         # create a new column, which is the "lineage" list mapped to ror ids
-        df["lineage_ror"] = df["lineage"].apply(
-            lambda id_list: [
-                ror_map.get(openalex_institution_id, None)
-                for openalex_institution_id in id_list
-            ]
+        df["lineage_ror"] = map_lineage_to_ror(
+            df["lineage"], ror_map, compact=compact_lists
         )
     return df
 
@@ -321,6 +732,7 @@ def get_openalex_dataframe_from_multiple_works_files(
     datadir: str | Path,
     glob_pattern: str = "openalex_works*.gz",
     ror_map: Mapping | None = None,
+    compact_lists: bool = False,
 ) -> pd.DataFrame:
     # Example usage:
     # ror_map = get_ror_map_from_institutions_file("openalex_institutions.gz")
@@ -342,8 +754,62 @@ def get_openalex_dataframe_from_multiple_works_files(
     files = list(datadir.glob(glob_pattern))
     files.sort()
     return get_openalex_dataframe_from_works(
-        yield_lines_from_files(files), ror_map=ror_map
+        yield_lines_from_files(files), ror_map=ror_map, compact_lists=compact_lists
+    )
+
+
+def works_table_to_dataframe(
+    table: pa.Table, compact_lists: bool = False
+) -> pd.DataFrame:
+    # convert a table of processed rows (see process_row) to a dataframe indexed on openalex_id,
+    # keeping the first occurrence of each work
+    list_columns = [col for col in OPENALEX_LIST_COLUMNS if col in table.column_names]
+    df = table.drop_columns(list_columns).to_pandas()
+    for col in list_columns:
+        df[col] = list_array_to_series(table.column(col), compact=compact_lists)
+    df = df[table.column_names]
+    df = df[~df["openalex_id"].duplicated(keep="first")]
+    return df.set_index("openalex_id")
+
+
+def works_file_to_table(path_to_file: str | Path) -> pa.Table:
+    # parse one JSON-lines works file into an arrow table of processed rows (see process_row)
+    rows = []
+    f = open_file(path_to_file)
+    try:
+        for line in f:
+            if line:
+                rows.append(process_row(json.loads(line)))
+    finally:
+        f.close()
+    return pa.Table.from_pylist(rows, schema=OPENALEX_WORKS_SCHEMA)
+
+
+def get_openalex_dataframe_from_multiple_works_files_parallel(
+    datadir: str | Path,
+    glob_pattern: str = "openalex_works*.gz",
+    ror_map: Mapping | None = None,
+    n_jobs: int = -1,
+    compact_lists: bool = False,
+) -> pd.DataFrame:
+    # same output as get_openalex_dataframe_from_multiple_works_files, but the files are parsed
+    # in parallel (one job per file), and duplicates are dropped in one vectorized pass at the end
+    from joblib import Parallel, delayed
+
+    datadir = Path(datadir)
+    files = list(datadir.glob(glob_pattern))
+    files.sort()
+    tables = Parallel(n_jobs=n_jobs)(delayed(works_file_to_table)(fp) for fp in files)
+    # files are concatenated in sorted order, so the first occurrence of a work is kept, as in the serial version
+    df = works_table_to_dataframe(
+        pa.concat_tables(tables), compact_lists=compact_lists
     )
+    if ror_map is not None:
+        # create a new column, which is the "lineage" list mapped to ror ids
+        df["lineage_ror"] = map_lineage_to_ror(
+            df["lineage"], ror_map, compact=compact_lists
+        )
+    return df
 
 
 def get_ror_map_from_institutions_file(path_to_file: str | Path) -> dict[str, str]:
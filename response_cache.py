@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """size-bounded on-disk cache for API responses (SQLite), keyed on the request"""
+
+import sqlite3
+import hashlib
+import json
+import threading
+import time
+import zlib
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import logging
+
+logger = logging.getLogger().getChild(__name__)
+
+DEFAULT_MAX_SIZE = 10 * 1024**3  # 10GB (compressed)
+
+
+class CacheMissError(Exception):
+    # raised in offline mode when a request is not in the cache
+    pass
+
+
+# query parameters that are credentials rather than part of what is requested.
+# they are left out of the cache key (and of the request string stored in the cache)
+CREDENTIAL_PARAMS = {"api_key"}
+
+
+def normalize_request(method: str, url: str, params=None) -> str:
+    # build a canonical string for the request: the full url with the query parameters sorted,
+    # so that the same request with params in a different order (or in the url instead of params) maps to the same key
+    prepared_url = requests.Request(method, url, params=params).prepare().url
+    parts = urlsplit(prepared_url)
+    query = urlencode(
+        sorted(
+            (k, v)
+            for k, v in parse_qsl(parts.query, keep_blank_values=True)
+            if k not in CREDENTIAL_PARAMS
+        )
+    )
+    normalized_url = urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path, query, "")
+    )
+    return f"{method.upper()} {normalized_url}"
+
+
+def get_cache_key(method: str, url: str, params=None) -> str:
+    return hashlib.sha256(normalize_request(method, url, params).encode()).hexdigest()
+
+
+class ResponseCache:
+    # responses are stored zlib-compressed in a SQLite database.
+    # entries older than `ttl` seconds are treated as missing (ttl=None means they never expire).
+    # when the total size goes over `max_size` bytes, the least recently used entries are evicted.
+    # in offline mode, a miss raises CacheMissError instead of going to the network
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_size: int = DEFAULT_MAX_SIZE,
+        ttl: float | None = None,
+        offline: bool = False,
+    ) -> None:
+        self.path = Path(path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                request TEXT,
+                status_code INTEGER,
+                headers TEXT,
+                encoding TEXT,
+                content BLOB,
+                size INTEGER,
+                created_at REAL,
+                last_access REAL
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)"
+        )
+        self.conn.commit()
+        # running total of the stored sizes, kept up to date by put and _evict,
+        # so that the table only has to be scanned when the cache is over max_size
+        self.total_size = self._get_total_size()
+
+    def get(self, method: str, url: str, params=None) -> requests.Response | None:
+        key = get_cache_key(method, url, params)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status_code, headers, encoding, content, created_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None and (
+                self.ttl is None or time.time() - row[4] <= self.ttl
+            ):
+                self.conn.execute(
+                    "UPDATE responses SET last_access = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                self.conn.commit()
+                self.hits += 1
+            else:
+                row = None
+                self.misses += 1
+        if row is None:
+            if self.offline:
+                raise CacheMissError(normalize_request(method, url, params))
+            return None
+        status_code, headers, encoding, content, _ = row
+        r = requests.Response()
+        r.status_code = status_code
+        r.headers = CaseInsensitiveDict(json.loads(headers))
+        r.encoding = encoding
+        r._content = zlib.decompress(content)
+        r.url = url
+        return r
+
+    def put(self, method: str, url: str, r: requests.Response, params=None) -> None:
+        key = get_cache_key(method, url, params)
+        content = zlib.compress(r.content)
+        # content is stored decompressed, so drop the headers describing the transfer
+        headers = {
+            k: v
+            for k, v in r.headers.items()
+            if k.lower() not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    normalize_request(method, url, params),
+                    r.status_code,
+                    json.dumps(headers),
+                    r.encoding,
+                    content,
+                    len(content),
+                    now,
+                    now,
+                ),
+            )
+            self.total_size += len(content)
+            self._evict()
+            self.conn.commit()
+
+    def _get_total_size(self) -> int:
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return total
+
+    def _evict(self) -> None:
+        # delete least recently used entries until the cache is under max_size
+        if self.total_size <= self.max_size:
+            return
+        # recount before evicting, in case other processes have written to (or evicted from) the same file
+        total = self._get_total_size()
+        if total <= self.max_size:
+            self.total_size = total
+            return
+        to_delete = []
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access"
+        ):
+            if total <= self.max_size:
+                break
+            to_delete.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self.total_size = total
+        logger.debug(f"evicted {len(to_delete)} entries from the response cache")
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """benchmark the scalar clean_doi against the vectorized clean_doi_series on a synthetic column"""
+
+import sys, os, time
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import pandas as pd
+import numpy as np
+
+from clean_doi import clean_doi, clean_doi_cached, clean_doi_series, doi_cache_info
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+
+def make_synthetic_column(n: int, seed: int = 0) -> pd.Series:
+    # mix of the kinds of values seen in the corpus `publication` and `dataset` fields:
+    # DOIs in different forms, accession numbers, and a few non-ASCII values
+    rng = np.random.default_rng(seed)
+    nums = rng.integers(0, 10_000_000, size=n).astype(str)
+    templates = np.array(
+        [
+            "10.5061/DRYAD.{}",
+            "https://doi.org/10.1371/journal.pone.{}",
+            " doi:10.6084/m9.figshare.{}. ",
+            "10.1234/ünïcode‐{}",
+            "GSE{}",
+            "PRJNA{}",
+        ]
+    )
+    which = rng.choice(len(templates), size=n, p=[0.3, 0.2, 0.1, 0.01, 0.3, 0.09])
+    values = [templates[w].format(num) for w, num in zip(which, nums)]
+    return pd.Series(values, dtype="string")
+
+
+def main(args):
+    logger.info(f"generating synthetic column with {args.n} rows")
+    s = make_synthetic_column(args.n)
+
+    logger.info("running vectorized clean_doi_series...")
+    this_start = timer()
+    cleaned, is_doi = clean_doi_series(s)
+    vectorized_time = timer() - this_start
+    logger.info(f"vectorized: {format_timespan(vectorized_time)}")
+
+    logger.info("running scalar clean_doi...")
+    this_start = timer()
+    expected = s.apply(clean_doi, return_none_if_error=True)
+    scalar_time = timer() - this_start
+    logger.info(f"scalar: {format_timespan(scalar_time)}")
+
+    logger.info("running scalar clean_doi_cached (non-raising, memoized)...")
+    this_start = timer()
+    s.apply(clean_doi_cached)
+    cached_time = timer() - this_start
+    logger.info(f"scalar cached: {format_timespan(cached_time)}. {doi_cache_info()}")
+
+    expected_is_doi = expected.notna()
+    if not (
+        (expected_is_doi == is_doi).all()
+        and (cleaned[is_doi] == expected[expected_is_doi].astype("string")).all()
+    ):
+        raise RuntimeError("vectorized output does not match scalar output")
+    logger.info(
+        f"outputs match ({is_doi.sum()} DOIs). speedup: {scalar_time / vectorized_time:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "-n",
+        type=int,
+        default=10_000_000,
+        help="number of rows in the synthetic column (default: 10,000,000)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """benchmark the relation type counts of get_crosstab against pd.crosstab, and check that the outputs are the same"""
+
+import sys, os, time
+import tracemalloc
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan, format_size
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+    def format_size(num_bytes):
+        return "{:.1f} MB".format(num_bytes / 1e6)
+
+
+import pandas as pd
+import numpy as np
+
+from gather_data_for_dataset_relations import get_crosstab
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+REL_TYPE_NAMES = ["Cites", "References", "IsSupplementedBy"]
+
+
+def get_crosstab_pandas(df: pd.DataFrame, type_map: pd.Series) -> pd.DataFrame:
+    # the previous implementation of get_crosstab
+    cats = df["relType_name"].unique()
+    df_crosstab = pd.crosstab(
+        [df["source"], df["target"]], df["relType_name"].astype("string")
+    ).reset_index(drop=False)
+    for colname in cats:
+        df_crosstab[colname] = df_crosstab[colname].astype("int8")
+    df_crosstab["source_type"] = df_crosstab["source"].map(type_map).astype("category")
+    df_crosstab["target_type"] = df_crosstab["target"].map(type_map).astype("category")
+    return df_crosstab
+
+
+def make_synthetic_relations(n: int, num_ids: int, seed: int = 0) -> pd.DataFrame:
+    # relations between integer-coded ids, sorted by source and target like load_relations_with_datasets,
+    # with some pairs repeated under the same or a different relation type
+    rng = np.random.default_rng(seed)
+    source = rng.integers(0, num_ids, size=n)
+    target = rng.integers(0, num_ids, size=n)
+    repeat = rng.random(n) < 0.3
+    target[repeat] = source[repeat] % 1000
+    df = pd.DataFrame(
+        {
+            "source": source,
+            "target": target,
+            "relType_name": pd.Categorical.from_codes(
+                rng.integers(0, len(REL_TYPE_NAMES), size=n), REL_TYPE_NAMES
+            ),
+        }
+    )
+    return df.sort_values(["source", "target"]).reset_index(drop=True)
+
+
+def run(func, df, type_map):
+    tracemalloc.start()
+    this_start = timer()
+    result = func(df, type_map)
+    elapsed = timer() - this_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(args):
+    df = make_synthetic_relations(args.n, args.num_ids)
+    type_map = pd.Series(
+        pd.Categorical.from_codes(
+            np.arange(args.num_ids) % 3, ["dataset", "publication", "software"]
+        )
+    )
+    logger.info(f"{len(df)} relations between {args.num_ids} ids")
+
+    expected, pandas_time, pandas_peak = run(get_crosstab_pandas, df, type_map)
+    logger.info(
+        f"pd.crosstab: {format_timespan(pandas_time)}, peak memory {format_size(pandas_peak)}"
+    )
+    result, time_new, peak_new = run(get_crosstab, df, type_map)
+    logger.info(
+        f"get_crosstab: {format_timespan(time_new)}, peak memory {format_size(peak_new)}"
+    )
+
+    pd.testing.assert_frame_equal(result, expected)
+    logger.info(
+        f"outputs match ({len(result)} pairs). speedup: {pandas_time / time_new:.1f}x, peak memory: {pandas_peak / peak_new:.1f}x lower"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "-n",
+        type=int,
+        default=1000000,
+        help="number of synthetic relations (default: 1,000,000)",
+    )
+    parser.add_argument(
+        "--num-ids",
+        type=int,
+        default=200000,
+        help="number of distinct ids (default: 200,000)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """benchmark the serial and parallel loaders for OpenAlex works files, and check that they give the same output"""
+
+import sys, os, time
+import gzip
+import json
+import random
+import tempfile
+from pathlib import Path
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import pandas as pd
+
+from openalex_utils import (
+    get_openalex_dataframe_from_multiple_works_files,
+    get_openalex_dataframe_from_multiple_works_files_parallel,
+)
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+
+def make_synthetic_work(i: int, rng: random.Random) -> dict:
+    institutions = [f"I{rng.randint(1, 5000)}" for _ in range(rng.randint(0, 6))]
+    return {
+        "id": f"https://openalex.org/W{i}",
+        "doi": f"https://doi.org/10.1234/{i}",
+        "ids": {"pmid": f"https://pubmed.ncbi.nlm.nih.gov/{i}"} if i % 2 else {},
+        "publication_date": "2020-01-01",
+        "open_access": {"is_oa": bool(i % 3), "oa_url": None},
+        "type": "article",
+        "type_crossref": "journal-article",
+        "authorships": [
+            {
+                "institutions": [
+                    {
+                        "id": f"https://openalex.org/{inst}",
+                        "ror": f"https://ror.org/0{inst}",
+                        "lineage": [f"https://openalex.org/{inst}"],
+                    }
+                ]
+            }
+            for inst in institutions
+        ],
+        "grants": [{"funder_display_name": f"Funder {rng.randint(1, 50)}"}],
+        "datasets": [],
+        "cited_by_count": rng.randint(0, 1000),
+        "topics": [
+            {
+                "display_name": "Topic",
+                "subfield": {"display_name": "Subfield"},
+                "field": {"display_name": "Field"},
+                "domain": {"display_name": "Domain"},
+            }
+        ],
+    }
+
+
+def write_synthetic_files(datadir: Path, num_files: int, works_per_file: int) -> None:
+    rng = random.Random(0)
+    for file_idx in range(num_files):
+        outfp = datadir.joinpath(f"openalex_works_{file_idx:02}.gz")
+        with gzip.open(outfp, "wt") as outf:
+            for i in range(file_idx * works_per_file, (file_idx + 1) * works_per_file):
+                outf.write(f"{json.dumps(make_synthetic_work(i, rng))}\n")
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.datadir:
+            datadir = Path(args.datadir)
+        else:
+            datadir = Path(tmpdir)
+            logger.info(
+                f"writing {args.num_files} synthetic files with {args.works_per_file} works each to {datadir}"
+            )
+            write_synthetic_files(datadir, args.num_files, args.works_per_file)
+
+        logger.info("running serial loader...")
+        this_start = timer()
+        df_serial = get_openalex_dataframe_from_multiple_works_files(datadir)
+        serial_time = timer() - this_start
+        logger.info(f"serial: {format_timespan(serial_time)}")
+
+        logger.info(f"running parallel loader (n_jobs: {args.n_jobs})...")
+        this_start = timer()
+        df_parallel = get_openalex_dataframe_from_multiple_works_files_parallel(
+            datadir, n_jobs=args.n_jobs
+        )
+        parallel_time = timer() - this_start
+        logger.info(f"parallel: {format_timespan(parallel_time)}")
+
+    pd.testing.assert_frame_equal(df_serial, df_parallel)
+    logger.info(
+        f"outputs match ({len(df_serial)} works). speedup: {serial_time / parallel_time:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--datadir",
+        help="directory with openalex_works*.gz files to use. if not given, synthetic files are generated",
+    )
+    parser.add_argument(
+        "--num-files",
+        type=int,
+        default=10,
+        help="number of synthetic files to generate (default: 10)",
+    )
+    parser.add_argument(
+        "--works-per-file",
+        type=int,
+        default=200000,
+        help="number of works in each synthetic file (default: 200000)",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=-1,
+        help="number of parallel jobs for the parallel loader (default: -1, all cores)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
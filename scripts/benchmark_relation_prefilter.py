@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """benchmark the byte-level prefilter for openaire relations against full JSON parsing, and check that they select the same relations"""
+
+import sys, os, time
+import gzip
+import json
+import random
+from datetime import datetime
+from timeit import default_timer as timer
+from typing import List, Set
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from extract_relations_with_datasets import (
+    is_relation_with_dataset,
+    relation_line_matches,
+)
+from openaire.tar_utils import index_tar_members, open_tar_member
+from openaire.util import load_ids_set
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+REL_TYPE_NAMES = [
+    "Cites",
+    "IsCitedBy",
+    "IsReferencedBy",
+    "References",
+    "IsSupplementedBy",
+    "IsSupplementTo",
+    "HasPart",
+    "IsPartOf",
+    "IsRelatedTo",
+    "HasAuthorInstitution",
+]
+
+
+def make_synthetic_lines(n: int, ids_set: Set[str], seed: int = 0) -> List[bytes]:
+    # relation lines in the dump's format, plus some that the byte-level scan can't handle
+    # and has to fall back to parsing: escaped characters, different key order and spacing, nested keys
+    rng = random.Random(seed)
+    ids = sorted(ids_set)
+    lines = []
+    for i in range(n):
+        source = rng.choice(ids) if rng.random() < 0.05 else f"50|other::{i}"
+        target = rng.choice(ids) if rng.random() < 0.05 else f"50|other::{i + n}"
+        record = {
+            "source": source,
+            "sourceType": "result",
+            "target": target,
+            "targetType": "result",
+            "relType": {"name": rng.choice(REL_TYPE_NAMES), "type": "citation"},
+            "provenance": [{"provenance": "Harvested", "trust": "0.9"}],
+            "validated": False,
+        }
+        kind = i % 100
+        if kind == 0:
+            record["source"] = source + ' "quoted"'
+        elif kind == 1:
+            record = dict(reversed(list(record.items())))
+        elif kind == 2:
+            record["provenance"][0]["source"] = rng.choice(ids)
+        elif kind == 3:
+            record["relType"] = {"type": "citation", "name": record["relType"]["name"]}
+        if kind == 4:
+            line = json.dumps(record, indent=None, separators=(",", ":"))
+        else:
+            line = json.dumps(record, ensure_ascii=(kind != 5))
+        lines.append(line.encode() + b"\n")
+    return lines
+
+
+def main(args):
+    if args.ids_set:
+        ids_set = load_ids_set(args.ids_set)
+    else:
+        ids_set = {f"50|dataset::{i}" for i in range(100000)}
+    if args.tarfile:
+        lines = []
+        for member in index_tar_members(args.tarfile)[: args.num_members]:
+            with open_tar_member(args.tarfile, member) as f:
+                with gzip.GzipFile(fileobj=f) as gf:
+                    lines.extend(line for line in gf if line)
+    else:
+        lines = make_synthetic_lines(args.n, ids_set)
+    logger.info(f"checking {len(lines)} lines against {len(ids_set)} ids")
+
+    this_start = timer()
+    expected = [is_relation_with_dataset(json.loads(line), ids_set) for line in lines]
+    full_parse_time = timer() - this_start
+    logger.info(f"full parse: {format_timespan(full_parse_time)}")
+
+    this_start = timer()
+    result = [relation_line_matches(line, ids_set) for line in lines]
+    prefilter_time = timer() - this_start
+    logger.info(f"prefilter: {format_timespan(prefilter_time)}")
+
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, result)) if a != b]
+    if mismatches:
+        for i in mismatches[:10]:
+            logger.error(f"mismatch (expected {expected[i]}): {lines[i]!r}")
+        raise RuntimeError(
+            f"prefilter does not match full parsing for {len(mismatches)} lines"
+        )
+    logger.info(
+        f"outputs match ({sum(result)} matching lines). speedup: {full_parse_time / prefilter_time:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--tarfile",
+        help="relation .tar file to take lines from. if not given, synthetic lines are generated",
+    )
+    parser.add_argument(
+        "--num-members",
+        type=int,
+        default=1,
+        help="number of members of the tarfile to read (default: 1)",
+    )
+    parser.add_argument(
+        "--ids-set",
+        help="file (.pickle) with ids to match. if not given, synthetic ids are used",
+    )
+    parser.add_argument(
+        "-n",
+        type=int,
+        default=1000000,
+        help="number of synthetic lines (default: 1,000,000)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
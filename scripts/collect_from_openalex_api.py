@@ -4,7 +4,12 @@ DESCRIPTION = """collect doi data from openalex api"""
 
 import sys, os, time
 import gzip
+import zlib
 import json
+import hashlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 from datetime import datetime
 from timeit import default_timer as timer
@@ -17,8 +22,13 @@ except ImportError:
         return "{:.2f} seconds".format(seconds)
 
 
-from openalex_utils import entities_by_ids
-from clean_doi import clean_doi
+from openalex_utils import (
+    entities_by_id_chunks_concurrent,
+    OPENALEX_REQUESTS_PER_SECOND,
+    WorksParquetWriter,
+)
+from clean_doi import clean_doi, clean_doi_or_none
+import http_client
 
 import logging
 
@@ -26,13 +36,132 @@ root_logger = logging.getLogger()
 logger = root_logger.getChild(__name__)
 
 
+MANIFEST_FILENAME = "collect_manifest.json"
+MAX_WORKS_PER_FILE = 200000
+
+
 def doi_clean_for_api(doi: str) -> str:
     doi = doi.replace("&", "")
     doi = doi.replace(",", "")
     return doi
 
 
+def write_manifest(manifest: dict, path: Path) -> None:
+    # write to a temporary file and then rename it, so the manifest is never left half-written
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(manifest))
+    os.replace(tmp_path, path)
+
+
+def get_dois_in_existing_gz_files(outdir: Path) -> set[str]:
+    found = set()
+    for fp in sorted(outdir.glob("openalex_works_*.gz")):
+        try:
+            with gzip.open(fp, "rt") as f:
+                for line in f:
+                    if line.strip():
+                        doi = clean_doi_or_none(json.loads(line).get("doi"))
+                        if doi:
+                            found.add(doi)
+        except (EOFError, OSError, json.JSONDecodeError) as e:
+            logger.warning(
+                f"could not read all of {fp} ({e}). DOIs in the unreadable part will be collected again"
+            )
+    return found
+
+
+def get_dois_in_existing_parquet_files(outdir: Path) -> set[str]:
+    found = set()
+    for fp in sorted(outdir.glob("openalex_works_*.parquet")):
+        try:
+            dois = pq.read_table(fp, columns=["doi"]).column("doi").to_pylist()
+        except (OSError, pa.ArrowInvalid) as e:
+            logger.warning(f"could not read {fp} ({e}). DOIs in it will be collected again")
+            continue
+        for doi in dois:
+            doi = clean_doi_or_none(doi)
+            if doi:
+                found.add(doi)
+    return found
+
+
+def is_readable_parquet(fp: Path) -> bool:
+    # a parquet file is only readable once it has been closed (the footer is written last)
+    try:
+        pq.ParquetFile(fp)
+        return True
+    except (OSError, pa.ArrowInvalid):
+        return False
+
+
+def get_chunk_files(chunk: dict) -> list[str]:
+    # the files a chunk was written to (manifests written before "files" was added have a single "file")
+    if "files" in chunk:
+        return chunk["files"]
+    return [chunk["file"]] if chunk.get("file") else []
+
+
+def truncate_gz_files(gz_files: set[str], chunks: dict, outdir: Path) -> None:
+    # a run that died partway through a write can leave an incomplete gzip member at the end of a .gz file,
+    # which makes readers fail with EOFError. each of the gz_files (written by this collection) is cut back
+    # to the end of the last chunk written to it that is recorded as done in the manifest ("gz_end").
+    # anything after that is collected again
+    ends = {name: 0 for name in gz_files}
+    for chunk in chunks.values():
+        if chunk.get("gz_end") is not None:
+            (name,) = [x for x in get_chunk_files(chunk) if x.endswith(".gz")]
+            ends[name] = max(ends.get(name, 0), chunk["gz_end"])
+    for name, end in ends.items():
+        fp = outdir.joinpath(name)
+        if fp.exists() and fp.stat().st_size > end:
+            logger.warning(
+                f"truncating {fp} from {fp.stat().st_size} to {end} bytes (the end of the last chunk in the manifest)"
+            )
+            with fp.open("r+b") as f:
+                f.truncate(end)
+
+
+def get_complete_gz_end(fp: Path) -> int:
+    # the byte offset of the end of the last complete gzip member in the file
+    end = 0
+    data_start = 0
+    d = zlib.decompressobj(wbits=31)
+    with fp.open("rb") as f:
+        while data := f.read(1024**2):
+            while data:
+                try:
+                    d.decompress(data)
+                except zlib.error:
+                    return end
+                if not d.eof:
+                    data_start += len(data)
+                    break
+                end = data_start + len(data) - len(d.unused_data)
+                data_start = end
+                data = d.unused_data
+                d = zlib.decompressobj(wbits=31)
+    return end
+
+
+def truncate_incomplete_gz_file(fp: Path) -> None:
+    # for a .gz file that isn't recorded in the manifest (e.g. started after the last checkpoint),
+    # the end of the last complete gzip member is found by reading the file.
+    # a file with no complete member is removed
+    end = get_complete_gz_end(fp)
+    if end == 0:
+        logger.warning(f"removing {fp} (no complete gzip member)")
+        fp.unlink()
+    elif fp.stat().st_size > end:
+        logger.warning(
+            f"truncating {fp} from {fp.stat().st_size} to {end} bytes (the end of the last complete gzip member)"
+        )
+        with fp.open("r+b") as f:
+            f.truncate(end)
+
+
 def main(args):
+    if args.cache:
+        http_client.enable_cache(args.cache, offline=args.cache_only)
     path_to_dois = Path(args.id_list)
     dois = path_to_dois.read_text().split("\n")
     outdir = Path(args.outdir)
@@ -70,32 +199,165 @@ def main(args):
     if args.mailto:
         params["mailto"] = args.mailto
 
-    dois_success = []
-    file_idx = 0
-    while True:
-        outfp = outdir.joinpath(f"openalex_works_{file_idx:02}.gz")
-        if outfp.exists():
-            file_idx += 1
+    chunksize = args.chunksize
+    chunks = [dois[i : i + chunksize] for i in range(0, len(dois), chunksize)]
+    manifest_path = outdir.joinpath(MANIFEST_FILENAME)
+    manifest = {
+        "input": str(path_to_dois),
+        "input_sha256": hashlib.sha256("\n".join(dois).encode()).hexdigest(),
+        "chunksize": chunksize,
+        "chunks": {},
+    }
+    write_jsonl = args.output_format in ("jsonl", "both")
+    write_parquet = args.output_format in ("parquet", "both")
+    skip_dois = set()
+    # DOIs already in the output files of each format. a chunk that was only partly written to a format
+    # (e.g. it spans a parquet file that was closed and one that was never closed) is collected again,
+    # but its works are not written again to the files that already have them
+    gz_dois = set()
+    parquet_dois = set()
+    if args.resume:
+        gz_files = set()
+        if manifest_path.exists():
+            prev_manifest = json.loads(manifest_path.read_text())
+            if (
+                prev_manifest.get("input_sha256") == manifest["input_sha256"]
+                and prev_manifest.get("chunksize") == chunksize
+            ):
+                manifest = prev_manifest
+                gz_files = {
+                    name
+                    for chunk in manifest["chunks"].values()
+                    for name in get_chunk_files(chunk)
+                    if name.endswith(".gz")
+                }
+                # chunks written (even partly) to parquet files that were never closed are lost,
+                # so they need to be collected again. in "both" mode, their JSON-lines output is at the end
+                # of the .gz files, and is removed by truncate_gz_files, so it isn't written twice
+                parquet_files = {
+                    name
+                    for chunk in manifest["chunks"].values()
+                    for name in get_chunk_files(chunk)
+                    if name.endswith(".parquet")
+                }
+                unreadable = {
+                    name
+                    for name in parquet_files
+                    if not is_readable_parquet(outdir.joinpath(name))
+                }
+                for chunk_idx, chunk in list(manifest["chunks"].items()):
+                    if unreadable.intersection(get_chunk_files(chunk)):
+                        del manifest["chunks"][chunk_idx]
+                for name in unreadable:
+                    # nothing can be read from a parquet file without its footer
+                    fp = outdir.joinpath(name)
+                    if fp.exists():
+                        logger.warning(f"removing unreadable parquet file {fp}")
+                        fp.unlink()
+                truncate_gz_files(gz_files, manifest["chunks"], outdir)
+                logger.info(
+                    f"resuming: {len(manifest['chunks'])} chunks already done according to {manifest_path}"
+                )
+            else:
+                logger.warning(
+                    f"{manifest_path} is for a different input list or chunksize. Only skipping DOIs found in existing output files"
+                )
+        for fp in sorted(outdir.glob("openalex_works_*.gz")):
+            if fp.name not in gz_files:
+                truncate_incomplete_gz_file(fp)
+        if write_jsonl:
+            gz_dois = get_dois_in_existing_gz_files(outdir)
+        if write_parquet:
+            parquet_dois = get_dois_in_existing_parquet_files(outdir)
+        if write_jsonl and write_parquet:
+            skip_dois = gz_dois & parquet_dois
         else:
-            break
-    logger.info(f"Writing to file: {outfp}...")
-    outfile = gzip.open(outfp, mode="wt")
+            skip_dois = gz_dois | parquet_dois
+        logger.info(f"resuming: found {len(skip_dois)} DOIs in existing output files")
+
+    pending = []
+    for chunk_idx, chunk in enumerate(chunks):
+        if str(chunk_idx) in manifest["chunks"]:
+            continue
+        remaining = [doi for doi in chunk if clean_doi_or_none(doi) not in skip_dois]
+        if remaining:
+            pending.append((chunk_idx, remaining))
+        else:
+            manifest["chunks"][str(chunk_idx)] = {"file": None, "num_works": 0}
+    logger.info(f"{len(pending)} of {len(chunks)} chunks left to collect")
+
+    dois_success = []
+    # the output files are only opened if there is something to collect,
+    # so a resume with nothing left to do doesn't leave empty files behind
+    outfile = None
+    if write_jsonl and pending:
+        file_idx = 0
+        while True:
+            outfp = outdir.joinpath(f"openalex_works_{file_idx:02}.gz")
+            if outfp.exists():
+                file_idx += 1
+            else:
+                break
+        logger.info(f"Writing to file: {outfp}...")
+        outfile = outfp.open("wb")
+    parquet_writer = None
+    if write_parquet and pending:
+        parquet_writer = WorksParquetWriter(
+            outdir,
+            row_group_size=args.row_group_size,
+            max_rows_per_file=MAX_WORKS_PER_FILE,
+        )
 
     try:
         num_dois_this_file = 0
+        chunks_since_checkpoint = 0
         logger.info(
-            f"Starting API queries for {len(dois)} DOIs (chunksize: {args.chunksize})"
+            f"Starting API queries for {sum(len(chunk) for _, chunk in pending)} DOIs (chunksize: {chunksize}, max in flight: {args.max_in_flight})"
         )
-        for r in entities_by_ids(
-            dois, filterkey="doi", params=params, chunksize=args.chunksize
-        ):
+        responses = entities_by_id_chunks_concurrent(
+            (chunk for _, chunk in pending),
+            filterkey="doi",
+            params=params,
+            max_in_flight=args.max_in_flight,
+            requests_per_second=args.requests_per_second,
+        )
+        for (chunk_idx, _), r in zip(pending, responses):
             r.raise_for_status()
-            for work in r.json()["results"]:
+            works = r.json()["results"]
+            if works and write_jsonl:
+                # each chunk is written as a complete gzip member,
+                # so the file stays readable if the script dies partway through
+                lines = "".join(
+                    f"{json.dumps(work)}\n"
+                    for work in works
+                    if clean_doi_or_none(work["doi"]) not in gz_dois
+                )
+                if lines:
+                    outfile.write(gzip.compress(lines.encode()))
+                    outfile.flush()
+            # every file the chunk is written to, including both parquet files if the writer
+            # starts a new file partway through the chunk
+            files = [outfp.name] if write_jsonl else []
+            for work in works:
                 work_doi = clean_doi(work["doi"])
-                outfile.write(f"{json.dumps(work)}\n")
+                if write_parquet and work_doi not in parquet_dois:
+                    if parquet_writer.outfp.name not in files:
+                        files.append(parquet_writer.outfp.name)
+                    parquet_writer.write(work)
                 dois_success.append(work_doi)
                 num_dois_this_file += 1
-            if num_dois_this_file >= 200000:
+            manifest["chunks"][str(chunk_idx)] = {
+                "files": files,
+                "num_works": len(works),
+            }
+            if write_jsonl:
+                # the byte offset of the end of this chunk's gzip member(s), to truncate back to on resume
+                manifest["chunks"][str(chunk_idx)]["gz_end"] = outfile.tell()
+            chunks_since_checkpoint += 1
+            if chunks_since_checkpoint >= args.checkpoint_every:
+                write_manifest(manifest, manifest_path)
+                chunks_since_checkpoint = 0
+            if write_jsonl and num_dois_this_file >= MAX_WORKS_PER_FILE:
                 logger.info(
                     f"Collected {len(dois_success)} DOIs so far. Closing file {outfp}"
                 )
@@ -103,12 +365,17 @@ def main(args):
                 file_idx += 1
                 outfp = outdir.joinpath(f"openalex_works_{file_idx:02}.gz")
                 logger.info(f"Writing to file: {outfp}...")
-                outfile = gzip.open(outfp, mode="wt")
+                outfile = outfp.open("wb")
                 num_dois_this_file = 0
 
     finally:
-        logger.info(f"closing file: {outfp}")
-        outfile.close()
+        if outfile is not None:
+            logger.info(f"closing file: {outfp}")
+            outfile.close()
+        if parquet_writer is not None:
+            parquet_writer.close()
+        logger.info(f"writing checkpoint manifest: {manifest_path}")
+        write_manifest(manifest, manifest_path)
         success_file_idx = 0
         while True:
             success_file_path = outdir.joinpath(
@@ -120,6 +387,7 @@ def main(args):
                 break
         logger.info(f"Writing {len(dois_success)} DOIs to {success_file_path}")
         success_file_path.write_text("\n".join(dois_success))
+        http_client.log_stats()
 
 
 if __name__ == "__main__":
@@ -153,9 +421,55 @@ if __name__ == "__main__":
         default=80,
         help="how many dois to request at once (default: 80)",
     )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=8,
+        help="maximum number of concurrent requests to the API (default: 8)",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        default=OPENALEX_REQUESTS_PER_SECOND,
+        help=f"rate limit for requests to the API (default: {OPENALEX_REQUESTS_PER_SECOND})",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["jsonl", "parquet", "both"],
+        default="jsonl",
+        help="write raw JSON-lines (openalex_works_NN.gz), flattened parquet (openalex_works_NN.parquet), or both (default: jsonl)",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=100000,
+        help="number of rows per parquet row group (default: 100000)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip chunks recorded as done in the checkpoint manifest in the output directory, and DOIs already present in existing output files",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=50,
+        help="write the checkpoint manifest after this many chunks (default: 50)",
+    )
+    parser.add_argument(
+        "--cache",
+        help="path to a response cache file (SQLite). API responses are read from and saved to this cache",
+    )
+    parser.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="only use responses from the cache (no network requests). requires --cache",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
+    if args.cache_only and not args.cache:
+        parser.error("--cache-only requires --cache")
     if args.debug:
         root_logger.setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
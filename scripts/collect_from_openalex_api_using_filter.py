@@ -10,6 +10,7 @@ import json
 from pathlib import Path
 from datetime import datetime
 from timeit import default_timer as timer
+from typing import Generator
 
 try:
     from humanfriendly import format_timespan
@@ -19,8 +20,15 @@ except ImportError:
         return "{:.2f} seconds".format(seconds)
 
 
-from openalex_utils import paginate_openalex
+from openalex_utils import (
+    paginate_openalex,
+    paginate_openalex_sharded,
+    get_group_by_counts,
+    OPENALEX_REQUESTS_PER_SECOND,
+    WorksParquetWriter,
+)
 from clean_doi import clean_doi
+import http_client
 
 import logging
 
@@ -34,6 +42,72 @@ def doi_clean_for_api(doi: str) -> str:
     return doi
 
 
+def get_shard_filters(url: str, params: dict, shard_by: str) -> list[tuple[str, int]]:
+    # split the query into disjoint shards, one per value of `shard_by`.
+    # returns (shard filter, expected number of works) tuples, largest first
+    # so that the big shards don't end up running alone at the end
+    counts = get_group_by_counts(url, shard_by, params=params)
+    shards = []
+    for key, count in counts.items():
+        value = "null" if key in (None, "unknown") else key
+        shards.append((f"{shard_by}:{value}", count))
+    shards.sort(key=lambda x: x[1], reverse=True)
+    return shards
+
+
+def yield_works(url: str, params: dict) -> Generator[dict, None, None]:
+    for r in paginate_openalex(url, params=params):
+        r.raise_for_status()
+        yield from r.json()["results"]
+
+
+def yield_works_sharded(
+    url: str,
+    params: dict,
+    shard_by: str,
+    max_parallel: int,
+    requests_per_second: float,
+    progress_interval: float = 60,
+) -> Generator[dict, None, None]:
+    logger.info(f"splitting query into shards by {shard_by}...")
+    shards = get_shard_filters(url, params, shard_by)
+    expected = dict(shards)
+    logger.info(
+        f"{len(shards)} shards, {sum(expected.values())} works expected. paging through {max_parallel} shards at a time"
+    )
+    collected = {shard_filter: 0 for shard_filter in expected}
+    started = {}
+    last_progress = timer()
+    for shard_filter, r in paginate_openalex_sharded(
+        url,
+        expected.keys(),
+        params=params,
+        max_parallel=max_parallel,
+        requests_per_second=requests_per_second,
+    ):
+        started.setdefault(shard_filter, timer())
+        page = r.json()
+        collected[shard_filter] += len(page["results"])
+        yield from page["results"]
+        if not page["meta"]["next_cursor"]:
+            logger.info(
+                f"shard {shard_filter} finished: {collected[shard_filter]} works in {format_timespan(timer() - started[shard_filter])}"
+            )
+            started[shard_filter] = None
+        if timer() - last_progress > progress_interval:
+            last_progress = timer()
+            for active_filter, start in started.items():
+                if start is None:
+                    continue
+                done = collected[active_filter]
+                rate = done / max(timer() - start, 1e-9)
+                remaining = max(expected[active_filter] - done, 0)
+                eta = format_timespan(remaining / rate) if rate else "unknown"
+                logger.info(
+                    f"shard {active_filter}: {done} / {expected[active_filter]} works. ETA: {eta}"
+                )
+
+
 def main(args):
     outdir = Path(args.outdir)
     if not outdir.exists():
@@ -70,33 +144,57 @@ def main(args):
     if args.mailto:
         params["mailto"] = args.mailto
 
-    file_idx = 0
-    while True:
-        outfp = outdir.joinpath(f"openalex_works_{file_idx:02}.gz")
-        if outfp.exists():
-            file_idx += 1
-        else:
-            break
-    logger.info(f"Writing to file: {outfp}...")
-    outfile = gzip.open(outfp, mode="wt")
+    write_jsonl = args.output_format in ("jsonl", "both")
+    write_parquet = args.output_format in ("parquet", "both")
+    outfile = None
+    if write_jsonl:
+        file_idx = 0
+        while True:
+            outfp = outdir.joinpath(f"openalex_works_{file_idx:02}.gz")
+            if outfp.exists():
+                file_idx += 1
+            else:
+                break
+        logger.info(f"Writing to file: {outfp}...")
+        outfile = gzip.open(outfp, mode="wt")
+    parquet_writer = None
+    if write_parquet:
+        parquet_writer = WorksParquetWriter(
+            outdir, row_group_size=args.row_group_size, max_rows_per_file=200000
+        )
 
+    num_written = 0
     try:
-        num_written = 0
         num_written_this_file = 0
         logger.info(f"Starting API queries, using filter: {args.filter})")
         url = "https://api.openalex.org/works"
-        for r in paginate_openalex(url, params=params):
-            r.raise_for_status()
-            for work in r.json()["results"]:
+        if args.parallel > 1:
+            works = yield_works_sharded(
+                url,
+                params,
+                shard_by=args.shard_by,
+                max_parallel=args.parallel,
+                requests_per_second=args.requests_per_second,
+            )
+        else:
+            works = yield_works(url, params)
+        seen_ids = set()
+        for work in works:
+            if work["id"] in seen_ids:
+                continue
+            seen_ids.add(work["id"])
+            if write_jsonl:
                 outfile.write(f"{json.dumps(work)}\n")
-                num_written += 1
-                num_written_this_file += 1
-                if (
-                    num_written in [5, 25, 100, 1000, 10000, 20000, 30000, 40000]
-                    or num_written % 50000 == 0
-                ):
-                    logger.info(f"Collected {num_written} works so far")
-            if num_written_this_file >= 200000:
+            if write_parquet:
+                parquet_writer.write(work)
+            num_written += 1
+            num_written_this_file += 1
+            if (
+                num_written in [5, 25, 100, 1000, 10000, 20000, 30000, 40000]
+                or num_written % 50000 == 0
+            ):
+                logger.info(f"Collected {num_written} works so far")
+            if write_jsonl and num_written_this_file >= 200000:
                 logger.info(
                     f"Collected {num_written} works so far. closing file {outfp}"
                 )
@@ -108,9 +206,13 @@ def main(args):
                 num_written_this_file = 0
 
     finally:
-        logger.info(f"closing file: {outfp}")
-        outfile.close()
+        if outfile is not None:
+            logger.info(f"closing file: {outfp}")
+            outfile.close()
+        if parquet_writer is not None:
+            parquet_writer.close()
         logger.info(f"Collection finished. Collected {num_written} works.")
+        http_client.log_stats()
 
 
 if __name__ == "__main__":
@@ -139,6 +241,35 @@ if __name__ == "__main__":
         "--mailto",
         help="email to include as an identifier in the calls to the OpenAlex API",
     )
+    parser.add_argument(
+        "--output-format",
+        choices=["jsonl", "parquet", "both"],
+        default="jsonl",
+        help="write raw JSON-lines (openalex_works_NN.gz), flattened parquet (openalex_works_NN.parquet), or both (default: jsonl)",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=100000,
+        help="number of rows per parquet row group (default: 100000)",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="split the query into disjoint shards and page through this many shards at once (default: 1, no sharding)",
+    )
+    parser.add_argument(
+        "--shard-by",
+        default="publication_year",
+        help="field to split the query into shards by (default: publication_year)",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        default=OPENALEX_REQUESTS_PER_SECOND,
+        help=f"rate limit for requests to the API when sharding (default: {OPENALEX_REQUESTS_PER_SECOND})",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
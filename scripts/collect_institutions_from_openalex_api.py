@@ -18,6 +18,7 @@ except ImportError:
 
 
 from openalex_utils import paginate_openalex
+import http_client
 
 import logging
 
@@ -72,6 +73,7 @@ def main(args):
         logger.info(f"finished collecting data for {num_written} institutions")
         logger.info(f"closing file: {outfp}")
         outfile.close()
+        http_client.log_stats()
 
 
 if __name__ == "__main__":
@@ -3,11 +3,14 @@
 DESCRIPTION = """convert the Data Citation Corpus from JSON-lines to parquet"""
 
 import sys, os, time
+import shutil
 from pathlib import Path
 import json
 from datetime import datetime
 from timeit import default_timer as timer
-from typing import Tuple
+from typing import Tuple, Dict, List, Optional, Union
+from urllib.parse import quote
+from joblib import Parallel, delayed
 
 try:
     from humanfriendly import format_timespan
@@ -19,75 +22,283 @@ except ImportError:
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 import logging
 
-from clean_doi import clean_doi, NoDoiException
+from corpus_utils import (
+    CORPUS_COLUMN_TYPES,
+    get_hashes_path,
+    load_previous_hashes,
+    convert_file_to_parquet,
+    combine_hashes_parts,
+    ensure_corpus_cache,
+)
 
 root_logger = logging.getLogger()
 logger = root_logger.getChild(__name__)
 
 
-def try_clean_doi(doi: str) -> Tuple[str, bool]:
-    # if clean_doi is unsuccessful, return False indicating that the input was not actually a doi
-    try:
-        return clean_doi(doi), True
-    except NoDoiException:
-        return doi, False
-
-
-def load_corpus_data(path_to_corpus: Path, glob_pattern="*.json") -> pd.DataFrame:
-    files = list(path_to_corpus.glob(glob_pattern))
-    data = []
-    dtype_dict = {
-        "id": "string",
-        "title": "string",
-        "publisher": "category",
-        "journal": "category",
-        "repository": "category",
-        "publication": "string",
-        "dataset": "string",
-        "source": "category",
+def apply_corpus_delta(
+    previous_fp: Path,
+    delta_part_files: List[Path],
+    new_ids: pa.Array,
+    outfp: Path,
+    delta_outfp: Path,
+    row_group_size: int = 100000,
+) -> Dict[str, int]:
+    # write the delta between the previous conversion and the new release to delta_outfp:
+    # the added and changed records (converted), and the ids of the removed records, with a "change" column.
+    # then rebuild the full new table as the unchanged rows of the previous conversion followed by
+    # the changed and added records
+    delta = pa.concat_tables(
+        [pq.read_table(fp) for fp in delta_part_files], promote_options="permissive"
+    )
+    previous_dataset = open_corpus_dataset(previous_fp)
+    previous_ids = previous_dataset.to_table(columns=["id"])["id"].combine_chunks()
+    removed_ids = previous_ids.filter(
+        pc.invert(pc.is_in(previous_ids, value_set=new_ids))
+    )
+    removed = pa.table(
+        {
+            "id": removed_ids.cast(pa.string()),
+            "change": pa.array(["removed"] * len(removed_ids), type=pa.string()),
+        }
+    )
+    delta_with_removed = pa.concat_tables(
+        [delta, removed], promote_options="permissive"
+    )
+    pq.write_table(delta_with_removed, delta_outfp, row_group_size=row_group_size)
+    num_changes = {
+        change: int(pc.sum(pc.equal(delta_with_removed["change"], change)).as_py() or 0)
+        for change in ["added", "changed", "removed"]
     }
-    for fp in files:
-        txt = fp.read_text()
-        records = json.loads(txt)
-        for r in records:
-            publication, publication_is_doi = try_clean_doi(r["publication"])
-            dataset, dataset_is_doi = try_clean_doi(r["dataset"])
-            data.append(
-                {
-                    "id": r["id"],
-                    "title": r["title"],
-                    "publisher": r.get("publisher", {}).get("title"),
-                    "journal": r.get("journal", {}).get("title"),
-                    "repository": r.get("repository", {}).get("title"),
-                    "publication": publication,
-                    "dataset": dataset,
-                    "publication_is_doi": publication_is_doi,
-                    "dataset_is_doi": dataset_is_doi,
-                    "publishedDate": r.get("publishedDate"),
-                    "source": r["source"],
-                    "affiliations": r.get("affiliations"),
-                    "funders": r.get("funders"),
-                    "subjects": r.get("subjects"),
-                }
+
+    delta = delta.drop_columns(["change"])
+    drop_ids = pa.concat_arrays(
+        [
+            delta["id"].combine_chunks().cast(pa.string()),
+            removed_ids.cast(pa.string()),
+        ]
+    )
+    schema = pa.unify_schemas(
+        [delta.schema, previous_dataset.schema], promote_options="permissive"
+    )
+    with pq.ParquetWriter(outfp, schema) as writer:
+        for batch in previous_dataset.to_batches(batch_size=row_group_size):
+            # (partition columns of a partitioned previous conversion get their types back)
+            table = read_corpus_table(ds.dataset(pa.Table.from_batches([batch])))
+            table = table.filter(pc.invert(pc.is_in(table["id"], value_set=drop_ids)))
+            writer.write_table(
+                table.select(schema.names).cast(schema), row_group_size=row_group_size
+            )
+        writer.write_table(delta.cast(schema), row_group_size=row_group_size)
+    return num_changes
+
+
+# columns the corpus can be partitioned by (see write_partitioned_corpus)
+PARTITION_COLUMNS = ["repository", "source", "publication_is_doi", "dataset_is_doi"]
+# directory name pyarrow uses for null partition values
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def write_partitioned_corpus(
+    infp: Path,
+    outdir: Path,
+    partition_by: List[str],
+    sort_by: Tuple[str, ...] = ("publication", "dataset"),
+    row_group_size: int = 100000,
+) -> int:
+    # rewrite a corpus parquet file as a hive-partitioned dataset (e.g. outdir/repository=Dryad/part-0.parquet),
+    # one partition at a time. within each partition the rows are sorted by `sort_by`,
+    # so the min/max statistics of the row groups let readers filtering on those columns skip row groups.
+    # see load_corpus_parquet for reading it back
+    if outdir.exists() and any(outdir.iterdir()):
+        raise FileExistsError(f"output directory {outdir} is not empty")
+    dataset = ds.dataset(infp, format="parquet")
+    # (dictionary columns are decoded first: row groups written separately can have different dictionaries)
+    partition_values = dataset.to_table(columns=partition_by)
+    for i, field in enumerate(partition_values.schema):
+        if pa.types.is_dictionary(field.type):
+            partition_values = partition_values.set_column(
+                i, field.name, partition_values[field.name].cast(field.type.value_type)
             )
-    df_corpus = pd.DataFrame(data)
-    for col, dtype in dtype_dict.items():
-        df_corpus[col] = df_corpus[col].astype(dtype)
-    df_corpus["publishedDate"] = pd.to_datetime(df_corpus["publishedDate"])
-    df_corpus = df_corpus.set_index("id", verify_integrity=True)
-    return df_corpus
+    combinations = partition_values.group_by(partition_by).aggregate([])
+    num_rows = 0
+    for values in combinations.to_pylist():
+        row_filter = None
+        dirnames = []
+        for colname in partition_by:
+            value = values[colname]
+            if value is None:
+                expr = pc.field(colname).is_null()
+                dirnames.append(f"{colname}={HIVE_NULL_PARTITION}")
+            else:
+                expr = pc.field(colname) == value
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                dirnames.append(f"{colname}={quote(str(value), safe='')}")
+            row_filter = expr if row_filter is None else row_filter & expr
+        table = dataset.to_table(filter=row_filter)
+        table = table.sort_by([(colname, "ascending") for colname in sort_by])
+        partition_dir = outdir.joinpath(*dirnames)
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        pq.write_table(
+            table.drop_columns(partition_by),
+            partition_dir.joinpath("part-0.parquet"),
+            row_group_size=row_group_size,
+            write_statistics=True,
+        )
+        num_rows += table.num_rows
+    logger.debug(f"wrote {len(combinations)} partitions to {outdir}")
+    return num_rows
+
+
+def open_corpus_dataset(path: Path) -> ds.Dataset:
+    # a converted corpus: either a single parquet file, or a directory written by write_partitioned_corpus
+    path = Path(path)
+    if path.is_dir():
+        return ds.dataset(
+            path,
+            format="parquet",
+            partitioning=ds.HivePartitioning.discover(infer_dictionary=True),
+        )
+    return ds.dataset(path, format="parquet")
+
+
+def read_corpus_table(
+    dataset: ds.Dataset, filter=None, columns: Optional[List[str]] = None
+) -> pa.Table:
+    # read (part of) a converted corpus. partition columns get back the types they had in the file,
+    # and the columns their original order
+    table = dataset.to_table(filter=filter, columns=columns)
+    for colname in PARTITION_COLUMNS:
+        if colname in table.column_names:
+            i = table.schema.get_field_index(colname)
+            column = table[colname]
+            if pa.types.is_dictionary(column.type) and colname.endswith("_is_doi"):
+                column = column.cast(pa.string())
+            table = table.set_column(
+                i, colname, column.cast(CORPUS_COLUMN_TYPES[colname])
+            )
+    pandas_metadata = (table.schema.metadata or {}).get(b"pandas")
+    if pandas_metadata:
+        order = [
+            c["name"] for c in json.loads(pandas_metadata)["columns"] if c["name"]
+        ]
+        order = [c for c in order if c in table.column_names]
+        order += [c for c in table.column_names if c not in order]
+        table = table.select(order)
+    return table
+
+
+def load_corpus_parquet(
+    path: Union[str, Path], filter=None, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    # load a converted corpus into a dataframe (indexed by id), like pd.read_parquet.
+    # `filter` is a pyarrow expression, e.g. pc.field("repository") == "Gene Expression Omnibus (GEO)",
+    # which is pushed down into the scan: with a partitioned corpus, only the matching partitions are read,
+    # and row groups are skipped using their statistics
+    if columns is not None and "id" not in columns:
+        columns = ["id"] + list(columns)
+    return read_corpus_table(
+        open_corpus_dataset(path), filter=filter, columns=columns
+    ).to_pandas()
 
 
 def main(args):
     path_to_corpus = Path(args.path_to_corpus)
     outfp = Path(args.output)
-    logger.info(f"loading corpus data from {path_to_corpus}")
-    df_corpus = load_corpus_data(path_to_corpus)
-    logger.info(f"writing dataframe with shape {df_corpus.shape} to file: {outfp}")
-    df_corpus.to_parquet(outfp)
+    # with --partition-by, the output is a directory, written from a single parquet file
+    if args.partition_by and outfp.exists() and any(outfp.iterdir()):
+        raise FileExistsError(f"output directory {outfp} is not empty")
+    if not args.previous:
+        # full conversion: the corpus is parsed into the shared cache (see corpus_utils),
+        # unless the cache is already up to date, and the output is written from it
+        cache_fp = ensure_corpus_cache(
+            path_to_corpus,
+            cache_dir=args.corpus_cache,
+            n_jobs=args.n_jobs,
+            batch_size=args.batch_size,
+        )
+        shutil.copyfile(get_hashes_path(cache_fp), get_hashes_path(outfp))
+        if args.partition_by:
+            logger.info(f"writing dataset partitioned by {args.partition_by} to {outfp}")
+            num_rows = write_partitioned_corpus(cache_fp, outfp, args.partition_by)
+        else:
+            logger.info(f"writing to file: {outfp}")
+            shutil.copyfile(cache_fp, outfp)
+            num_rows = pq.ParquetFile(outfp).metadata.num_rows
+        logger.info(f"wrote {num_rows} records to {outfp}")
+        return
+
+    # incremental mode: only the records that changed since the previous conversion are converted
+    previous_fp = Path(args.previous)
+    if previous_fp.resolve() == outfp.resolve():
+        raise ValueError("the output file must be different from the previous file")
+    previous_hashes_fp = get_hashes_path(previous_fp)
+    if not previous_hashes_fp.exists():
+        raise FileNotFoundError(
+            f"no content hashes for {previous_fp} ({previous_hashes_fp} not found). convert that release without --previous first"
+        )
+    logger.info(
+        f"loading content hashes of the previous conversion from {previous_hashes_fp}"
+    )
+    previous = load_previous_hashes(previous_hashes_fp)
+    files = sorted(path_to_corpus.glob("*.json"))
+    # each input file is converted to a part file by a worker process, and the part files are then
+    # streamed into the output file. peak memory is about one input file's records as arrow tables per worker
+    partsdir = outfp.with_name(f"{outfp.stem}_parts")
+    partsdir.mkdir(parents=True, exist_ok=True)
+    part_files = [
+        partsdir.joinpath(f"{i:05d}_{fp.stem}.parquet") for i, fp in enumerate(files)
+    ]
+    hashes_part_files = [
+        partsdir.joinpath(f"{i:05d}_{fp.stem}.hashes.parquet")
+        for i, fp in enumerate(files)
+    ]
+    logger.info(
+        f"converting {len(files)} corpus files from {path_to_corpus} -- number of parallel jobs: {args.n_jobs}"
+    )
+    nums = Parallel(n_jobs=args.n_jobs, verbose=10)(
+        delayed(convert_file_to_parquet)(
+            fp,
+            part_fp,
+            hashes_part_fp,
+            batch_size=args.batch_size,
+            previous=previous,
+        )
+        for fp, part_fp, hashes_part_fp in zip(files, part_files, hashes_part_files)
+    )
+    logger.info(
+        f"read {sum(n for n, _ in nums)} records, converted {sum(n for _, n in nums)}"
+    )
+    new_ids = combine_hashes_parts(hashes_part_files, get_hashes_path(outfp))
+    if args.partition_by:
+        combined_fp = partsdir.joinpath("combined.parquet")
+    else:
+        combined_fp = outfp
+    if args.delta:
+        delta_outfp = Path(args.delta)
+    else:
+        delta_outfp = outfp.with_name(f"{outfp.stem}_delta.parquet")
+    num_changes = apply_corpus_delta(
+        previous_fp, part_files, new_ids, combined_fp, delta_outfp
+    )
+    logger.info(
+        f"changes since {previous_fp}: {num_changes}. wrote them to {delta_outfp}"
+    )
+    logger.info(f"wrote {len(new_ids)} records to {combined_fp}")
+    if args.partition_by:
+        logger.info(f"writing dataset partitioned by {args.partition_by} to {outfp}")
+        write_partitioned_corpus(combined_fp, outfp, args.partition_by)
+        combined_fp.unlink()
+    for part_fp in part_files + hashes_part_files:
+        part_fp.unlink()
+    partsdir.rmdir()
 
 
 if __name__ == "__main__":
@@ -110,7 +321,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "path_to_corpus", help="directory with Data Citation Corpus data"
     )
-    parser.add_argument("output", help="path to output file")
+    parser.add_argument("output", help="path to output file (a directory with --partition-by)")
+    parser.add_argument(
+        "--partition-by",
+        nargs="+",
+        choices=PARTITION_COLUMNS,
+        help="write the output as a directory with a hive-partitioned dataset, partitioned by these columns, with the rows of each partition sorted by publication and dataset. load it with load_corpus_parquet",
+    )
+    parser.add_argument(
+        "--previous",
+        help="parquet file converted from the previous release of the corpus. if given, only the records that were added or changed are converted, the changes are written to a delta file, and the full table is rebuilt from the previous file plus the delta",
+    )
+    parser.add_argument(
+        "--delta",
+        help="path to the delta output file (added, changed, and removed records) when --previous is used (default: <output>_delta.parquet)",
+    )
+    parser.add_argument(
+        "--corpus-cache",
+        help="directory for the parsed corpus shared with the other scripts that read the corpus (default: .corpus_cache in the corpus directory). it is rebuilt when the corpus files change",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="number of corpus files to convert in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="number of records to parse before converting them to a columnar batch (default: 10000)",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
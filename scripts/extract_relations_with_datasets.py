@@ -6,13 +6,12 @@ import sys, os, time
 from pathlib import Path
 from datetime import datetime
 from timeit import default_timer as timer
-from typing import Union, List, Optional, Dict, Set
-import tarfile
+from typing import Union, List, Optional, Dict, Set, Tuple
+import shutil
+import re
 import gzip
 import json
-import pickle
 from tqdm import tqdm
-from joblib import Parallel, delayed
 
 try:
     from humanfriendly import format_timespan
@@ -25,12 +24,37 @@ except ImportError:
 import pandas as pd
 import numpy as np
 
+from openaire.tar_utils import (
+    TarMember,
+    open_tar_member,
+    run_on_tar_members,
+)
+from openaire import util as openaire_util
+from openaire.util import load_ids_set
+
 import logging
 
 root_logger = logging.getLogger()
 logger = root_logger.getChild(__name__)
 
 MAX_FILE_SIZE = 5 * 1024**3  # 5GB uncompressed
+BATCH_SIZE = 100000  # lines per id lookup batch
+
+REL_TYPES = [
+    "Cites",
+    "IsCitedBy",
+    "IsReferencedBy",
+    "References",
+    "IsSupplementedBy",
+    "IsSupplementTo",
+]
+REL_TYPES_BYTES = {rel_type.encode() for rel_type in REL_TYPES}
+
+# the fields we filter on are pulled straight out of the raw JSON bytes: find the key (which must appear
+# exactly once in the line), then match the value right after it.
+# string values with escaped characters don't match, and fall back to full parsing
+STRING_VALUE_PATTERN = re.compile(rb'\s*:\s*"([^"\\]*)"')
+REL_TYPE_NAME_PATTERN = re.compile(rb'\s*:\s*\{[^{}]*?"name"\s*:\s*"([^"\\]*)"')
 
 
 def get_dataset_ids(datadir: Union[str, Path]) -> Set[str]:
@@ -40,74 +64,140 @@ def get_dataset_ids(datadir: Union[str, Path]) -> Set[str]:
     return ids_set
 
 
-def extract_from_one_file(
-    file: Union[str, Path],  # .tar file containing gzipped json-lines files
-    outdir: Union[str, Path],
-    datadir: Union[str, Path],
-    ids_set: Set[str],
+def is_relation_with_dataset(record: Dict, ids_set: Set[str]) -> bool:
+    return (record["relType"]["name"] in REL_TYPES) and (
+        record["source"] in ids_set or record["target"] in ids_set
+    )
+
+
+def scan_value(line: bytes, key: bytes, pattern: re.Pattern) -> bytes | None:
+    start = line.find(key)
+    if start == -1 or line.find(key, start + 1) != -1:
+        return None
+    m = pattern.match(line, start + len(key))
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def relation_line_ids(line: bytes) -> Tuple[str, str] | None:
+    # the (source, target) of a relation line with one of REL_TYPES, or None for any other line.
+    # most lines are decided from the raw bytes without being parsed
+    rel_type = scan_value(line, b'"relType"', REL_TYPE_NAME_PATTERN)
+    if rel_type is not None and rel_type not in REL_TYPES_BYTES:
+        return None
+    source = scan_value(line, b'"source"', STRING_VALUE_PATTERN)
+    target = scan_value(line, b'"target"', STRING_VALUE_PATTERN)
+    if rel_type is None or source is None or target is None:
+        # unusual line (escaped characters, keys appearing more than once, ...)
+        record = json.loads(line)
+        if record["relType"]["name"] not in REL_TYPES:
+            return None
+        return record["source"], record["target"]
+    return source.decode(), target.decode()
+
+
+def ids_in_set(openaire_ids: List[str], ids_set: Union[Set[str], "IdSet"]) -> np.ndarray:
+    # boolean array: which of the ids are in ids_set. an IdSet looks them all up at once
+    if hasattr(ids_set, "contains_many"):
+        return ids_set.contains_many(openaire_ids)
+    return np.fromiter(
+        (x in ids_set for x in openaire_ids), dtype=bool, count=len(openaire_ids)
+    )
+
+
+def filter_relation_lines(
+    lines: List[bytes], ids_set: Union[Set[str], "IdSet"]
+) -> List[bytes]:
+    # the lines that are relations with datasets (same result as is_relation_with_dataset on each parsed line),
+    # in their original order
+    candidates = []
+    sources = []
+    targets = []
+    for line in lines:
+        ids = relation_line_ids(line)
+        if ids is not None:
+            candidates.append(line)
+            sources.append(ids[0])
+            targets.append(ids[1])
+    if not candidates:
+        return []
+    matches = ids_in_set(sources, ids_set) | ids_in_set(targets, ids_set)
+    return [line for line, match in zip(candidates, matches) if match]
+
+
+def write_lines(lines: List[bytes], outf) -> int:
+    # matching lines are written as they are, without re-serializing. returns the number of bytes written
+    size = 0
+    for line in lines:
+        out_line = line if line.endswith(b"\n") else line + b"\n"
+        outf.write(out_line)
+        size += len(out_line)
+    return size
+
+
+def extract_from_one_member(
+    path_to_tarfile: Path,
+    member_idx: int,
+    member: TarMember,
+    partsdir: Path,
+    path_to_ids_set: Union[str, Path],
+    batch_size: int = BATCH_SIZE,
+) -> Tuple[Path, int]:
+    # extract the relations from one tarfile member (a gzipped JSON-lines file) to its own gzip file.
+    # returns the path to the file and the uncompressed size of its contents.
+    # lines are filtered in batches, so that the id lookups for a batch are done together
+    # loaded once per worker process, rather than sent along with every job
+    ids_set = load_ids_set(path_to_ids_set)
+    outfp = partsdir.joinpath(f"{path_to_tarfile.stem}_{member_idx:05}.gz")
+    total_size = 0
+    with gzip.open(outfp, "wb") as outf:
+        with open_tar_member(path_to_tarfile, member) as f:
+            with gzip.GzipFile(fileobj=f) as gf:
+                batch = []
+                for line in gf:
+                    if line:
+                        batch.append(line)
+                    if len(batch) >= batch_size:
+                        total_size += write_lines(filter_relation_lines(batch, ids_set), outf)
+                        batch = []
+                total_size += write_lines(filter_relation_lines(batch, ids_set), outf)
+    return outfp, total_size
+
+
+def combine_member_files(
+    member_outputs: List[Tuple[Path, int]],
+    path_to_tarfile: Path,
+    outdir: Path,
     max_file_size: int = MAX_FILE_SIZE,
 ) -> None:
-    fp = Path(file)
-    outdir = Path(outdir)
-    datadir = Path(datadir)
+    # concatenate the per-member gzip files (in order) into part files for the tarfile.
+    # concatenated gzip files are a valid gzip file, so no recompression is needed.
+    # a new part file is started when the next member would take the uncompressed size over max_file_size
     part_file_number = 0
-    part_file = None  # Initialize as None
     total_size = 0
-    # ids_set = get_dataset_ids(datadir)
-
-    logger.debug(f"starting processing for file: {fp}")
-
-    if part_file is None:
-        part_file_path = outdir.joinpath(
-            f"{fp.stem}_datasets_part_{part_file_number:03}.gz"
-        )
-        logger.debug(f"opening file for write: {part_file_path}")
-        part_file = gzip.open(part_file_path, "wt")
-
-    with tarfile.open(fp, "r") as tar:
-        members = list(tar.getmembers())
-        for member in members:
-            with tar.extractfile(member) as f:
-                with gzip.GzipFile(fileobj=f) as gf:
-                    for line in gf:
-                        if line:
-                            record = json.loads(line)
-
-                            if (
-                                record["relType"]["name"]
-                                in [
-                                    "Cites",
-                                    "IsCitedBy",
-                                    "IsReferencedBy",
-                                    "References",
-                                    "IsSupplementedBy",
-                                    "IsSupplementTo",
-                                ]
-                            ) and (
-                                record["source"] in ids_set
-                                or record["target"] in ids_set
-                            ):
-                                out_line = json.dumps(record) + "\n"
-                                line_size = len(out_line.encode("utf-8"))
-                                # If this line will make the file exceed the max size, close the current file and open a new one
-                                if total_size + line_size > max_file_size:
-                                    part_file.close()
-                                    part_file_number += 1
-                                    part_file_path = outdir.joinpath(
-                                        f"{fp.stem}_datasets_part_{part_file_number:03}.gz"
-                                    )
-                                    logger.debug(
-                                        f"opening file for write: {part_file_path}"
-                                    )
-                                    part_file = gzip.open(part_file_path, "wt")
-                                    total_size = 0
-
-                                part_file.write(out_line)
-                                total_size += line_size
-
-    if part_file is not None:
+    part_file_path = outdir.joinpath(
+        f"{path_to_tarfile.stem}_datasets_part_{part_file_number:03}.gz"
+    )
+    logger.debug(f"opening file for write: {part_file_path}")
+    part_file = part_file_path.open("wb")
+    try:
+        for member_fp, size in member_outputs:
+            if total_size > 0 and total_size + size > max_file_size:
+                part_file.close()
+                part_file_number += 1
+                part_file_path = outdir.joinpath(
+                    f"{path_to_tarfile.stem}_datasets_part_{part_file_number:03}.gz"
+                )
+                logger.debug(f"opening file for write: {part_file_path}")
+                part_file = part_file_path.open("wb")
+                total_size = 0
+            with member_fp.open("rb") as f:
+                shutil.copyfileobj(f, part_file)
+            total_size += size
+            member_fp.unlink()
+    finally:
         part_file.close()
-    logger.debug(f"finished processing file: {fp}")
 
 
 def main(args):
@@ -119,21 +209,48 @@ def main(args):
         logger.debug(f"creating directory: {outdir}")
         outdir.mkdir()
     n_jobs = args.n_jobs
-    logger.info(f"loading file: {args.ids_set}")
-    ids_set = pickle.loads(Path(args.ids_set).read_bytes())
-    logger.debug(f"ids_set contains {len(ids_set)} ids")
-
-    parallel_args = [
-        [(fp,), {"outdir": outdir, "datadir": datadir, "ids_set": ids_set}]
-        for fp in raw_data_files
-    ]
-    logger.info(
-        f"running {len(parallel_args)} jobs in total -- number of parallel jobs at a time: {n_jobs}"
-    )
-    Parallel(n_jobs=n_jobs, verbose=1000)(
-        delayed(extract_from_one_file)(*args, **kwargs)
-        for args, kwargs in parallel_args
+    path_to_ids_set = Path(args.ids_set)
+    if args.types_datadir and path_to_ids_set.suffix == ".npy":
+        # build the id set file, or reuse it if it is up to date with the types files
+        id_set = openaire_util.get_dataset_ids(
+            args.types_datadir,
+            glob_pattern="df_openaire_types_all*.parquet",
+            id_set_path=path_to_ids_set,
+            bloom_bits_per_item=args.bloom_bits_per_item,
+        )
+        logger.info(f"id set {path_to_ids_set} contains {len(id_set)} ids")
+    elif args.types_datadir:
+        # in-memory python set (the default): each worker holds its own copy, but lookups are fastest
+        import pickle
+
+        ids_set = openaire_util.get_dataset_ids(
+            args.types_datadir, glob_pattern="df_openaire_types_all*.parquet"
+        )
+        logger.info(f"writing {len(ids_set)} ids to {path_to_ids_set}")
+        path_to_ids_set.write_bytes(pickle.dumps(ids_set))
+        del ids_set
+    elif not path_to_ids_set.exists():
+        raise FileNotFoundError(
+            f"{path_to_ids_set} not found (to build it, use --types-datadir)"
+        )
+
+    # members are processed in parallel across all of the tarfiles (largest first),
+    # then the per-member files are combined into part files for each tarfile
+    partsdir = outdir.joinpath("member_parts")
+    partsdir.mkdir(exist_ok=True)
+    results = run_on_tar_members(
+        raw_data_files,
+        extract_from_one_member,
+        n_jobs=n_jobs,
+        verbose=1000,
+        partsdir=partsdir,
+        path_to_ids_set=path_to_ids_set,
     )
+    for fp in raw_data_files:
+        member_outputs = results.get(fp, [])
+        logger.info(f"combining {len(member_outputs)} member files for {fp.name}")
+        combine_member_files(member_outputs, fp, outdir)
+    partsdir.rmdir()
 
 
 if __name__ == "__main__":
@@ -155,9 +272,25 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument("datadir", help="input data directory")
     parser.add_argument("outdir", help="output directory")
-    parser.add_argument("ids_set", help="file (.pickle) with ids to match")
     parser.add_argument(
-        "--n-jobs", default=1, help="number of parallel jobs to run (default: 1)"
+        "ids_set",
+        help="file with ids to match: either a pickled set (.pickle, the default, fastest when the ids fit in memory in every worker), or a memory-mapped id set (.npy) shared by all of the workers",
+    )
+    parser.add_argument(
+        "--types-datadir",
+        help="directory with df_openaire_types_all*.parquet files, used to build the ids file. a .npy id set is only rebuilt if it is out of date",
+    )
+    parser.add_argument(
+        "--bloom-bits-per-item",
+        type=int,
+        default=0,
+        help="when building the id set file, also build a Bloom filter with this many bits per id (default: 0, no Bloom filter)",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="number of parallel jobs to run (tarfile members are spread over the jobs) (default: 1)",
     )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
@@ -5,6 +5,12 @@ DESCRIPTION = """gather data for dataset relations."""
 # - df_relation.parquet
 # - df_relation_doi.parquet
 # - df_provenance.parquet
+# OpenAIRE IDs are encoded as int64 codes (using the dictionary written by openaire_graph_collect_type_and_doi.py)
+# for all of the joins and aggregations, and only turned back into strings when the output files are written.
+# with --partitions, the pipeline runs out of core: the relations are spilled to disk in partitions by a hash
+# of the source ID as they are read, the provenance data and crosstab are computed one partition at a time,
+# and the merges of steps 4 and 6 join the spilled tables one partition at a time, streaming the results to the
+# output files. only the types and doi data for the IDs in the relations (step 2) are held in memory
 
 import sys, os, time
 from pathlib import Path
@@ -12,8 +18,8 @@ from datetime import datetime
 from timeit import default_timer as timer
 from typing import Union, List, Optional, Dict, Set, Iterable
 from joblib import Parallel, delayed
-import json
 import gc
+import tempfile
 
 try:
     from humanfriendly import format_timespan
@@ -26,7 +32,9 @@ except ImportError:
 import pandas as pd
 import numpy as np
 
-from clean_doi import clean_doi, NoDoiException
+from corpus_utils import load_corpus_table
+from openaire.id_dictionary import ID_DICTIONARY_FILENAME, IdDictionary
+from openaire.partitions import PartitionedSpill, ParquetFrameWriter
 
 import logging
 
@@ -34,43 +42,134 @@ root_logger = logging.getLogger()
 logger = root_logger.getChild(__name__)
 
 
+# relation types to keep
+REL_TYPES = ["Cites", "References", "IsSupplementedBy"]
+
+
+def iter_relation_batches(fp: Path, block_size: int = 1 << 24):
+    # record batches (of about block_size bytes of JSON each) of one relation part file.
+    # (pyarrow before version 19 has no streaming JSON reader, so the parsed file is held in memory,
+    # but only the relations that are kept are converted to pandas)
+    import pyarrow.json as pa_json
+
+    table = pa_json.read_json(fp, read_options=pa_json.ReadOptions(block_size=block_size))
+    yield from table.to_batches()
+
+
+def relation_batch_to_table(batch):
+    # filter a batch of relations to REL_TYPES, and pull the fields out of the structs
+    # (relType.name, provenance.provenance, provenance.trust) with arrow compute kernels
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    rel_type_name = pc.struct_field(batch.column("relType"), "name")
+    mask = pc.is_in(rel_type_name, value_set=pa.array(REL_TYPES))
+    batch = batch.filter(mask)
+    provenance = batch.column("provenance")
+    return pa.table(
+        {
+            "source": batch.column("source"),
+            "target": batch.column("target"),
+            "relType_name": rel_type_name.filter(mask),
+            "provenance": pc.struct_field(provenance, "provenance"),
+            "validated": batch.column("validated"),
+            "trust": pc.cast(pc.struct_field(provenance, "trust"), pa.float64()),
+        }
+    )
+
+
+def load_relation_file(fp: Path):
+    import pyarrow as pa
+
+    tables = [relation_batch_to_table(batch) for batch in iter_relation_batches(fp)]
+    logger.debug(f"{fp.name}: {sum(t.num_rows for t in tables)} relations")
+    return pa.concat_tables(tables, promote_options="permissive")
+
+
 def load_relations_with_datasets(
-    dirpath: Path, glob_pattern: str = "relation_*part_*.gz"
+    dirpath: Path, glob_pattern: str = "relation_*part_*.gz", n_jobs: int = 1
 ) -> pd.DataFrame:
+    # the files are read (in n_jobs threads) into arrow tables, filtered batch by batch,
+    # and only the relations that are kept are converted to pandas
+    import pyarrow as pa
+
     files = list(dirpath.glob(glob_pattern))
-    _dfs = []
-    for fp in files:
-        _df = pd.read_json(fp, lines=True, engine="pyarrow")
-        _df["relType_name"] = (
-            _df["relType"].apply(lambda x: x["name"]).astype("category")
-        )
-        _df = _df[["source", "target", "relType_name", "provenance", "validated"]]
-        prov_objs = _df["provenance"].dropna()
-        _df["trust"] = prov_objs.apply(lambda x: float(x["trust"]))
-        _df["provenance"] = prov_objs.apply(lambda x: x["provenance"]).astype(
-            "category"
-        )
-        _df = _df[_df["relType_name"].isin(["Cites", "References", "IsSupplementedBy"])]
-        _dfs.append(_df)
-    df_relations = pd.concat(_dfs, ignore_index=True)
+    tables = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(load_relation_file)(fp) for fp in files
+    )
+    df_relations = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+    for colname in ["relType_name", "provenance"]:
+        df_relations[colname] = df_relations[colname].astype("category")
     df_relations = df_relations.sort_values(["source", "target"]).reset_index(drop=True)
     return df_relations
 
 
+def spill_relations_with_datasets(
+    dirpath: Path,
+    relations_spill: PartitionedSpill,
+    glob_pattern: str = "relation_*part_*.gz",
+    n_jobs: int = 1,
+):
+    # like load_relations_with_datasets, but the relations of each file are spilled (in file order) as the file
+    # is read, rather than concatenated in memory. returns the unique IDs (source or target) as an arrow array,
+    # and the sorted relation types that occur
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    files = list(dirpath.glob(glob_pattern))
+    tables = Parallel(n_jobs=n_jobs, prefer="threads", return_as="generator")(
+        delayed(load_relation_file)(fp) for fp in files
+    )
+    ids = []
+    rel_types = set()
+    for table in tables:
+        for colname in ["source", "target"]:
+            ids.append(pc.unique(table[colname]).cast(pa.string()))
+        rel_types.update(pc.unique(table["relType_name"]).drop_null().to_pylist())
+        relations_spill.write(table.to_pandas())
+    relation_ids = pc.unique(pa.chunked_array(ids, type=pa.string()))
+    return relation_ids, sorted(rel_types)
+
+
+def scan_openaire_parquet(
+    files: List[Path], columns: List[str], ids_to_include: Optional[Iterable] = None
+) -> pd.DataFrame:
+    # read the columns of a set of parquet files (with multiple threads), keeping only the rows for ids_to_include.
+    # the filter is pushed down into the scan, so rows are dropped as each batch is decoded, and row groups
+    # whose openaire_id statistics (min/max) rule out all of the ids are skipped without being read.
+    # (openaire_graph_collect_type_and_doi.py --sort-by-id writes files where this skips most row groups)
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    schema = pa.schema([(colname, pa.string()) for colname in columns])
+    dataset = ds.dataset(files, schema=schema, format="parquet")
+    if ids_to_include is not None:
+        value_set = pa.array(pd.Series(ids_to_include).dropna().unique(), type=pa.string())
+        row_filter = ds.field("openaire_id").isin(value_set)
+    else:
+        row_filter = None
+    table = dataset.to_table(columns=columns, filter=row_filter, use_threads=True)
+    return table.to_pandas()
+
+
 def get_openaire_type_map(
     path_to_types: Path,
     ids_to_include: Optional[Iterable] = None,
     glob_pattern: str = "df_openaire_types*.parquet",
+    id_dictionary: Optional[IdDictionary] = None,
 ) -> pd.Series:
+    # if id_dictionary is given, the map is indexed by the integer codes of the OpenAIRE IDs
     files = list(path_to_types.glob(glob_pattern))
-    _dfs = []
-    for fp in files:
-        _df = pd.read_parquet(fp, columns=["openaire_id", "openaire_type"])
-        if ids_to_include is not None:
-            _df = _df[_df["openaire_id"].isin(ids_to_include)]
-        _df["openaire_type"] = _df["openaire_type"].astype("category")
-        _dfs.append(_df)
-    df_openaire_type = pd.concat(_dfs)
+    df_openaire_type = scan_openaire_parquet(
+        files, ["openaire_id", "openaire_type"], ids_to_include=ids_to_include
+    )
+    df_openaire_type["openaire_type"] = df_openaire_type["openaire_type"].astype(
+        "category"
+    )
+    if id_dictionary is not None:
+        df_openaire_type["openaire_id"] = id_dictionary.encode(
+            df_openaire_type["openaire_id"]
+        )
     openaire_type_map = df_openaire_type.set_index(
         "openaire_id", verify_integrity=True
     )["openaire_type"]
@@ -81,52 +180,249 @@ def get_openaire_dois(
     path_to_dois: Path,
     ids_to_include: Optional[Iterable] = None,
     glob_pattern: str = "df_openaire_dois*.parquet",
+    id_dictionary: Optional[IdDictionary] = None,
 ) -> pd.DataFrame:
+    # if id_dictionary is given, the openaire_id column holds the integer codes of the OpenAIRE IDs
     files = list(path_to_dois.glob(glob_pattern))
-    _dfs = []
-    for fp in files:
-        _df = pd.read_parquet(fp)
-        _dfs.append(_df)
-    df_openaire_doi = pd.concat(_dfs)
-    if ids_to_include is not None:
-        df_openaire_doi = df_openaire_doi[
-            df_openaire_doi["openaire_id"].isin(ids_to_include)
-        ]
+    df_openaire_doi = scan_openaire_parquet(
+        files, ["openaire_id", "doi"], ids_to_include=ids_to_include
+    )
+    if id_dictionary is not None:
+        df_openaire_doi["openaire_id"] = id_dictionary.encode(
+            df_openaire_doi["openaire_id"]
+        )
     return df_openaire_doi
 
 
-def get_crosstab(df: pd.DataFrame, type_map: pd.Series) -> pd.DataFrame:
-    cats = df["relType_name"].unique()
-    df_crosstab = pd.crosstab(
-        [df["source"], df["target"]], df["relType_name"].astype("string")
-    ).reset_index(drop=False)
-    for colname in cats:
-        df_crosstab[colname] = df_crosstab[colname].astype("int8")
+def count_pairs_by_type(
+    source: np.ndarray, target: np.ndarray, type_codes: np.ndarray, num_types: int
+):
+    # count the rows for each (source, target) pair and relation type.
+    # the pairs are sorted (if they aren't already), each run of equal pairs gets a group number,
+    # and the counts come from one bincount over group * num_types + type code.
+    # returns the unique pairs (sorted) and a (num_pairs, num_types) array of counts
+    if len(source) == 0:
+        return source, target, np.zeros((0, num_types), dtype=np.int64)
+    is_sorted = np.all(
+        (source[1:] > source[:-1])
+        | ((source[1:] == source[:-1]) & (target[1:] >= target[:-1]))
+    )
+    if not is_sorted:
+        order = np.lexsort((target, source))
+        source = source[order]
+        target = target[order]
+        type_codes = type_codes[order]
+    new_pair = np.empty(len(source), dtype=bool)
+    new_pair[0] = True
+    np.not_equal(source[1:], source[:-1], out=new_pair[1:])
+    new_pair[1:] |= target[1:] != target[:-1]
+    group = np.cumsum(new_pair) - 1
+    num_pairs = int(group[-1]) + 1
+    counts = np.bincount(
+        group * num_types + type_codes, minlength=num_pairs * num_types
+    ).reshape(num_pairs, num_types)
+    return source[new_pair], target[new_pair], counts
+
+
+def get_crosstab(
+    df: pd.DataFrame, type_map: pd.Series, rel_types: Optional[List[str]] = None
+) -> pd.DataFrame:
+    # one row per (source, target) pair, with the number of relations of each type
+    # (same output as pd.crosstab, without building its MultiIndex and dense intermediate).
+    # if rel_types is given, every one of them gets a column, even if it doesn't occur in df
+    # (so that the crosstabs of different partitions have the same columns)
+    if rel_types is None:
+        rel_type = df["relType_name"].astype("category")
+    else:
+        rel_type = df["relType_name"].astype(pd.CategoricalDtype(rel_types))
+    source = df["source"].to_numpy()
+    target = df["target"].to_numpy()
+    type_codes = rel_type.cat.codes.to_numpy()
+    # rows without a relation type are not counted
+    has_type = type_codes >= 0
+    if not has_type.all():
+        source, target, type_codes = (
+            source[has_type],
+            target[has_type],
+            type_codes[has_type],
+        )
+    pair_source, pair_target, counts = count_pairs_by_type(
+        source, target, type_codes, len(rel_type.cat.categories)
+    )
+    df_crosstab = pd.DataFrame({"source": pair_source, "target": pair_target})
+    # like pd.crosstab, only the relation types that occur get a column, in sorted order
+    present = counts.sum(axis=0) > 0
+    if rel_types is not None:
+        present[:] = True
+    for i in sorted(np.flatnonzero(present), key=lambda i: rel_type.cat.categories[i]):
+        df_crosstab[rel_type.cat.categories[i]] = counts[:, i].astype("int8")
+    df_crosstab.columns = pd.Index(
+        df_crosstab.columns, dtype="string", name="relType_name"
+    )
     df_crosstab["source_type"] = df_crosstab["source"].map(type_map).astype("category")
     df_crosstab["target_type"] = df_crosstab["target"].map(type_map).astype("category")
     return df_crosstab
 
 
-def load_corpus_doi_data(path_to_corpus: Path, glob_pattern="*.json") -> pd.DataFrame:
-    # get citations from corpus, only doi-doi citations
-    files = list(path_to_corpus.glob(glob_pattern))
-    corpus_citations_doi = []
-    for fp in files:
-        txt = fp.read_text()
-        records = json.loads(txt)
-        for r in records:
-            try:
-                source_doi = clean_doi(r["publication"])
-                target_doi = clean_doi(r["dataset"])
-                corpus_citations_doi.append((source_doi, target_doi))
-            except NoDoiException:
-                pass
-    return pd.DataFrame(
-        corpus_citations_doi, columns=["doi_source", "doi_target"]
-    ).drop_duplicates()
+def load_corpus_doi_data(
+    path_to_corpus: Path, cache_dir: Optional[Union[str, Path]] = None
+) -> pd.DataFrame:
+    # get citations from corpus, only doi-doi citations.
+    # they are read from the shared corpus cache (see corpus_utils), where the dois are already cleaned
+    import pyarrow.compute as pc
+
+    table = load_corpus_table(
+        path_to_corpus,
+        columns=["publication", "dataset"],
+        filter=pc.field("publication_is_doi") & pc.field("dataset_is_doi"),
+        cache_dir=cache_dir,
+    )
+    df_corpus_citations_doi = pd.DataFrame(
+        {
+            "doi_source": table["publication"].to_pandas().astype("string"),
+            "doi_target": table["dataset"].to_pandas().astype("string"),
+        }
+    )
+    return df_corpus_citations_doi.drop_duplicates()
+
+
+def decode_ids(
+    df: pd.DataFrame, id_dictionary: IdDictionary, columns=("source", "target")
+) -> pd.DataFrame:
+    # copy of df with the integer codes in the id columns turned back into OpenAIRE ID strings
+    df = df.copy()
+    for colname in columns:
+        df[colname] = id_dictionary.decode(df[colname].to_numpy())
+    return df
+
+
+def get_provenance(df_relations: pd.DataFrame) -> pd.DataFrame:
+    # the provenance of the first relation of each (source, target) pair. df_relations is sorted by source and target
+    return df_relations[
+        ["source", "target", "provenance", "trust", "validated"]
+    ].drop_duplicates(subset=["source", "target"])
+
+
+def crosstab_partitioned(
+    relations_spill: PartitionedSpill,
+    crosstab_spill: PartitionedSpill,
+    type_map: pd.Series,
+    rel_types: List[str],
+    id_dictionary: IdDictionary,
+    outdir: Path,
+) -> None:
+    # steps 1 and 3, one partition at a time: the relations (partitioned by source) are encoded and sorted,
+    # their provenance data is streamed to df_provenance.parquet, and their crosstab is spilled to crosstab_spill.
+    # all of the relations with the same source are in the same partition, so each crosstab row is complete
+    outfp = outdir.joinpath("df_provenance.parquet")
+    logger.debug(f"saving provenance data to {outfp}")
+    with ParquetFrameWriter(outfp) as provenance_writer:
+        for partition in range(relations_spill.num_partitions):
+            df_relations = relations_spill.read(partition)
+            for colname in ["relType_name", "provenance"]:
+                df_relations[colname] = df_relations[colname].astype("category")
+            for colname in ["source", "target"]:
+                df_relations[colname] = id_dictionary.encode(df_relations[colname])
+            df_relations = df_relations.sort_values(["source", "target"]).reset_index(
+                drop=True
+            )
+            provenance_writer.write(
+                decode_ids(get_provenance(df_relations), id_dictionary)
+            )
+            crosstab_spill.write(
+                get_crosstab(df_relations, type_map=type_map, rel_types=rel_types)
+            )
+            relations_spill.delete(partition)
+
+
+def merge_dois_partitioned(
+    crosstab_spill: PartitionedSpill,
+    doi_spill: PartitionedSpill,
+    tmpdir: Union[str, Path],
+    drop_cols: List[str],
+) -> PartitionedSpill:
+    # step 4, one partition at a time: the crosstab (partitioned by source) is joined with the dois
+    # (partitioned by openaire_id) on source, the result is spilled again by target and joined on target.
+    # returns the relations with dois, partitioned by (doi_source, doi_target) for the merge with the corpus
+    num_partitions = crosstab_spill.num_partitions
+    by_target = PartitionedSpill(tmpdir, "relation_doi_by_target", ["target"], num_partitions)
+    for partition in range(num_partitions):
+        df_relation_doi = crosstab_spill.read(partition).drop(columns=drop_cols)
+        df_relation_doi = df_relation_doi.merge(
+            doi_spill.read(partition).rename(
+                columns={"openaire_id": "source", "doi": "doi_source"}
+            ),
+            how="inner",
+            on="source",
+        )
+        by_target.write(df_relation_doi)
+    by_doi = PartitionedSpill(
+        tmpdir, "relation_doi", ["doi_source", "doi_target"], num_partitions
+    )
+    for partition in range(num_partitions):
+        df_relation_doi = by_target.read(partition).merge(
+            doi_spill.read(partition).rename(
+                columns={"openaire_id": "target", "doi": "doi_target"}
+            ),
+            how="inner",
+            on="target",
+        )
+        by_target.delete(partition)
+        by_doi.write(df_relation_doi)
+    return by_doi
+
+
+def merge_corpus_partitioned(
+    relation_doi_spill: PartitionedSpill,
+    crosstab_spill: PartitionedSpill,
+    df_corpus_citations_doi: pd.DataFrame,
+    tmpdir: Union[str, Path],
+    outdir: Path,
+    id_dictionary: IdDictionary,
+) -> None:
+    # step 6, one partition at a time: the relations with dois are merged with the corpus citations
+    # and streamed to df_relation_doi.parquet, and the pairs found in the corpus (spilled by source)
+    # are merged into the crosstab and streamed to df_relation.parquet
+    num_partitions = relation_doi_spill.num_partitions
+    corpus_spill = PartitionedSpill(
+        tmpdir, "corpus", ["doi_source", "doi_target"], num_partitions
+    )
+    corpus_spill.write(df_corpus_citations_doi.assign(in_corpus=True))
+    in_corpus_spill = PartitionedSpill(tmpdir, "in_corpus", ["source"], num_partitions)
+    outfp = outdir.joinpath("df_relation_doi.parquet")
+    with ParquetFrameWriter(outfp) as writer:
+        for partition in range(num_partitions):
+            df_relation_doi = relation_doi_spill.read(partition).merge(
+                corpus_spill.read(partition),
+                how="left",
+                on=["doi_source", "doi_target"],
+            )
+            df_relation_doi["in_corpus"] = (
+                df_relation_doi["in_corpus"].fillna(value=False).astype(bool)
+            )
+            writer.write(decode_ids(df_relation_doi, id_dictionary))
+            to_merge = df_relation_doi[df_relation_doi["in_corpus"] == True]
+            in_corpus_spill.write(to_merge[["source", "target", "in_corpus"]])
+    logger.debug(f"wrote {writer.num_rows} rows to {outfp}")
+    outfp = outdir.joinpath("df_relation.parquet")
+    with ParquetFrameWriter(outfp) as writer:
+        for partition in range(num_partitions):
+            # all rows with the same source are in the same partition, so dropping duplicates here is enough
+            to_merge = in_corpus_spill.read(partition).drop_duplicates()
+            df_relation = crosstab_spill.read(partition).merge(
+                to_merge, how="left", on=["source", "target"]
+            )
+            df_relation["in_corpus"] = (
+                df_relation["in_corpus"].fillna(value=False).astype(bool)
+            )
+            writer.write(decode_ids(df_relation, id_dictionary))
+    logger.debug(f"wrote {writer.num_rows} rows to {outfp}")
 
 
 def main(args):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
     path_to_relations = Path(args.path_to_relations)
     path_to_types = Path(args.path_to_types)
     path_to_dois = Path(args.path_to_dois)
@@ -135,117 +431,225 @@ def main(args):
     if not outdir.exists():
         logger.debug(f"creating directory: {outdir}")
         outdir.mkdir()
-
+    if args.partitions:
+        num_partitions = args.partitions
+        tmpdir = tempfile.TemporaryDirectory(prefix="partitions_", dir=outdir)
+        logger.debug(f"using {num_partitions} partitions in {tmpdir.name}")
     logger.debug(
         f"Step 1: load relations with datasets from directory: {path_to_relations}..."
     )
     this_start = timer()
-    df_relations = load_relations_with_datasets(path_to_relations)
+    if args.partitions:
+        relations_spill = PartitionedSpill(
+            tmpdir.name, "relations", ["source"], num_partitions
+        )
+        relation_ids, rel_types = spill_relations_with_datasets(
+            path_to_relations, relations_spill, n_jobs=args.n_jobs
+        )
+        logger.debug(
+            f"spilled the relations ({len(relation_ids)} unique openaire ids). took {format_timespan(timer()-this_start)}"
+        )
+    else:
+        df_relations = load_relations_with_datasets(
+            path_to_relations, n_jobs=args.n_jobs
+        )
+        logger.debug(
+            f"loaded {len(df_relations)} relations. took {format_timespan(timer()-this_start)}"
+        )
+        relation_ids = pc.unique(
+            pa.chunked_array(
+                [
+                    pa.array(df_relations[colname], type=pa.string(), from_pandas=True)
+                    for colname in ["source", "target"]
+                ]
+            )
+        )
+    # only the dictionary entries for the IDs in the relations are loaded. the types and doi data
+    # are filtered to those IDs, so every ID that is encoded later is among them
+    if args.id_dictionary:
+        path_to_id_dictionary = Path(args.id_dictionary)
+    else:
+        path_to_id_dictionary = path_to_types.joinpath(ID_DICTIONARY_FILENAME)
+    if path_to_id_dictionary.exists():
+        logger.debug(f"loading openaire id dictionary from {path_to_id_dictionary}")
+        id_dictionary = IdDictionary.from_file(
+            path_to_id_dictionary, openaire_ids=relation_ids
+        )
+    else:
+        logger.warning(
+            f"openaire id dictionary {path_to_id_dictionary} not found. building it from the types files"
+        )
+        id_dictionary = IdDictionary.from_types_files(
+            sorted(path_to_types.glob("df_openaire_types*.parquet")),
+            openaire_ids=relation_ids,
+        )
     logger.debug(
-        f"loaded {len(df_relations)} relations. took {format_timespan(timer()-this_start)}"
+        f"openaire id dictionary has {len(id_dictionary)} ids, {len(id_dictionary.ids)} of them loaded"
     )
-
-    outfp = outdir.joinpath("df_provenance.parquet")
-    logger.debug(f"saving provenance data to {outfp}")
-    df_relations[
-        ["source", "target", "provenance", "trust", "validated"]
-    ].drop_duplicates(subset=["source", "target"]).to_parquet(outfp)
-    logger.debug("dropping provenance columns")
-    df_relations.drop(columns=["provenance", "trust", "validated"], inplace=True)
-
-    pairs_dedup = df_relations[["source", "target"]].drop_duplicates()
-    logger.debug(f"{len(pairs_dedup)} unique openaire id pairs")
-    all_ids = (
-        pd.concat([pairs_dedup["source"], pairs_dedup["target"]])
-        .sort_values()
-        .drop_duplicates()
-        .reset_index()
-    )
-    logger.debug(f"{len(all_ids)} unique openaire ids (either source or target)")
-    # convert dataframe to series
-    all_ids = all_ids[0]
+    if args.partitions:
+        # the types and doi files hold the ID strings, so filter them on those
+        all_ids = relation_ids.to_pandas()
+    del relation_ids
+    if not args.partitions:
+        # the relations are sorted by source and target, and the codes sort in the same order as the IDs
+        for colname in ["source", "target"]:
+            df_relations[colname] = id_dictionary.encode(df_relations[colname])
+
+        outfp = outdir.joinpath("df_provenance.parquet")
+        logger.debug(f"saving provenance data to {outfp}")
+        decode_ids(get_provenance(df_relations), id_dictionary).to_parquet(outfp)
+        logger.debug("dropping provenance columns")
+        df_relations.drop(columns=["provenance", "trust", "validated"], inplace=True)
+
+        pairs_dedup = df_relations[["source", "target"]].drop_duplicates()
+        logger.debug(f"{len(pairs_dedup)} unique openaire id pairs")
+        all_id_codes = np.unique(
+            np.concatenate([pairs_dedup["source"].values, pairs_dedup["target"].values])
+        )
+        logger.debug(f"{len(all_id_codes)} unique openaire ids (either source or target)")
+        # the types and doi files hold the ID strings, so filter them on those
+        all_ids = pd.Series(id_dictionary.decode(all_id_codes))
 
     logger.debug(f"Step 2: load openaire types data and doi data")
     logger.debug(f"Loading openaire types data from directory: {path_to_types}...")
     this_start = timer()
-    openaire_type_map = get_openaire_type_map(path_to_types, ids_to_include=all_ids)
+    openaire_type_map = get_openaire_type_map(
+        path_to_types, ids_to_include=all_ids, id_dictionary=id_dictionary
+    )
     logger.debug(
         f"loaded openaire type map ({len(openaire_type_map)} items). took {format_timespan(timer()-this_start)}"
     )
     logger.debug(f"Loading openaire doi data from directory: {path_to_dois}...")
     this_start = timer()
-    df_openaire_doi = get_openaire_dois(path_to_dois, ids_to_include=all_ids)
+    df_openaire_doi = get_openaire_dois(
+        path_to_dois, ids_to_include=all_ids, id_dictionary=id_dictionary
+    )
     logger.debug(
         f"loaded openaire dois ({len(df_openaire_doi)} items). took {format_timespan(timer()-this_start)}"
     )
     logger.debug(f"num unique openaire ids: {df_openaire_doi['openaire_id'].nunique()}")
     logger.debug(f"num unique dois: {df_openaire_doi['doi'].nunique()}")
+    del all_ids
 
     logger.debug("Step 3: get crosstab...")
     this_start = timer()
-    df_crosstab = get_crosstab(df_relations, type_map=openaire_type_map)
-    logger.debug(
-        f"done getting crosstab (dataframe shape: {df_crosstab.shape}). took {format_timespan(timer()-this_start)}"
-    )
+    if args.partitions:
+        crosstab_spill = PartitionedSpill(
+            tmpdir.name, "crosstab", ["source"], num_partitions
+        )
+        crosstab_partitioned(
+            relations_spill,
+            crosstab_spill,
+            openaire_type_map,
+            rel_types,
+            id_dictionary,
+            outdir,
+        )
+        logger.debug(
+            f"done getting crosstab (spilled). took {format_timespan(timer()-this_start)}"
+        )
+    else:
+        df_crosstab = get_crosstab(df_relations, type_map=openaire_type_map)
+        logger.debug(
+            f"done getting crosstab (dataframe shape: {df_crosstab.shape}). took {format_timespan(timer()-this_start)}"
+        )
 
-    # # checkpoint
-    # outfp = outdir.joinpath("df_relations_crosstab_checkpoint.parquet")
-    # logger.debug(f"writing to file: {outfp}")
-    # df_crosstab.to_parquet(outfp)
+        # # checkpoint
+        # outfp = outdir.joinpath("df_relations_crosstab_checkpoint.parquet")
+        # logger.debug(f"writing to file: {outfp}")
+        # df_crosstab.to_parquet(outfp)
 
-    logger.debug("deleting df_relations and running garbage collection")
-    del df_relations
-    gc.collect()
-    logger.debug("gc.get_stats():")
-    logger.debug(gc.get_stats())
-    logger.debug("gc.garbage:")
-    logger.debug(gc.garbage)
+        logger.debug("deleting df_relations and running garbage collection")
+        del df_relations
+        gc.collect()
+        logger.debug("gc.get_stats():")
+        logger.debug(gc.get_stats())
+        logger.debug("gc.garbage:")
+        logger.debug(gc.garbage)
 
-    logger.debug(f"Step 4: merge relations and dois")
-    this_start = timer()
     drop_cols = ["Cites", "IsSupplementedBy", "References"]
-    df_relation_doi = df_crosstab.drop(columns=drop_cols)
-    df_relation_doi = df_relation_doi.merge(
-        df_openaire_doi.rename(columns={"openaire_id": "source", "doi": "doi_source"}),
-        how="inner",
-        on="source",
-    )
-    logger.debug("done merging on source column. merging on target column...")
-    df_relation_doi = df_relation_doi.merge(
-        df_openaire_doi.rename(columns={"openaire_id": "target", "doi": "doi_target"}),
-        how="inner",
-        on="target",
-    )
-    logger.debug(
-        f"done merging relations and dois. df_relation_doi has shape {df_relation_doi.shape}. took {format_timespan(timer()-this_start)}"
-    )
+    if args.partitions:
+        logger.debug(f"Step 4: merge relations and dois")
+        this_start = timer()
+        doi_spill = PartitionedSpill(tmpdir.name, "doi", ["openaire_id"], num_partitions)
+        doi_spill.write(df_openaire_doi)
+        del df_openaire_doi
+        gc.collect()
+        relation_doi_spill = merge_dois_partitioned(
+            crosstab_spill, doi_spill, tmpdir.name, drop_cols
+        )
+        logger.debug(
+            f"done merging relations and dois. took {format_timespan(timer()-this_start)}"
+        )
+    else:
+        logger.debug(f"Step 4: merge relations and dois")
+        this_start = timer()
+        df_relation_doi = df_crosstab.drop(columns=drop_cols)
+        df_relation_doi = df_relation_doi.merge(
+            df_openaire_doi.rename(
+                columns={"openaire_id": "source", "doi": "doi_source"}
+            ),
+            how="inner",
+            on="source",
+        )
+        logger.debug("done merging on source column. merging on target column...")
+        df_relation_doi = df_relation_doi.merge(
+            df_openaire_doi.rename(
+                columns={"openaire_id": "target", "doi": "doi_target"}
+            ),
+            how="inner",
+            on="target",
+        )
+        logger.debug(
+            f"done merging relations and dois. df_relation_doi has shape {df_relation_doi.shape}. took {format_timespan(timer()-this_start)}"
+        )
 
     logger.debug("Step 5: load corpus data")
     this_start = timer()
-    df_corpus_citations_doi = load_corpus_doi_data(path_to_corpus)
+    df_corpus_citations_doi = load_corpus_doi_data(path_to_corpus, cache_dir=args.corpus_cache)
     logger.debug(
         f"loaded {len(df_corpus_citations_doi)} rows. took {format_timespan(timer()-this_start)}"
     )
 
     logger.debug("Step 6: merge corpus data with openaire data and save files")
     this_start = timer()
-    df_corpus_citations_doi["in_corpus"] = True
-    df_relation_doi = df_relation_doi.merge(
-        df_corpus_citations_doi, how="left", on=["doi_source", "doi_target"]
-    )
-    df_relation_doi["in_corpus"] = df_relation_doi["in_corpus"].fillna(value=False)
-    outfp = outdir.joinpath("df_relation_doi.parquet")
-    logger.debug(f"writing dataframe with shape {df_relation_doi.shape} to {outfp}")
-    df_relation_doi.to_parquet(outfp)
-    logger.debug("continuing to merge...")
-    to_merge = df_relation_doi[df_relation_doi["in_corpus"] == True]
-    to_merge = to_merge[["source", "target", "in_corpus"]].drop_duplicates()
-    df_relation = df_crosstab.merge(to_merge, how="left", on=["source", "target"])
-    df_relation["in_corpus"] = df_relation["in_corpus"].fillna(value=False)
-
-    outfp = outdir.joinpath("df_relation.parquet")
-    logger.debug(f"writing dataframe with shape {df_relation.shape} to {outfp}")
-    df_relation.to_parquet(outfp)
+    if args.partitions:
+        merge_corpus_partitioned(
+            relation_doi_spill,
+            crosstab_spill,
+            df_corpus_citations_doi,
+            tmpdir.name,
+            outdir,
+            id_dictionary,
+        )
+        tmpdir.cleanup()
+    else:
+        df_corpus_citations_doi["in_corpus"] = True
+        df_relation_doi = df_relation_doi.merge(
+            df_corpus_citations_doi, how="left", on=["doi_source", "doi_target"]
+        )
+        df_relation_doi["in_corpus"] = df_relation_doi["in_corpus"].fillna(
+            value=False
+        )
+        outfp = outdir.joinpath("df_relation_doi.parquet")
+        logger.debug(f"writing dataframe with shape {df_relation_doi.shape} to {outfp}")
+        decode_ids(df_relation_doi, id_dictionary).to_parquet(outfp)
+        logger.debug("continuing to merge...")
+        to_merge = df_relation_doi[df_relation_doi["in_corpus"] == True]
+        to_merge = to_merge[["source", "target", "in_corpus"]].drop_duplicates()
+        df_relation = df_crosstab.merge(to_merge, how="left", on=["source", "target"])
+        df_relation["in_corpus"] = df_relation["in_corpus"].fillna(value=False)
+
+        outfp = outdir.joinpath("df_relation.parquet")
+        logger.debug(f"writing dataframe with shape {df_relation.shape} to {outfp}")
+        df_relation = decode_ids(df_relation, id_dictionary)
+        if id_dictionary.extra_ids:
+            # IDs missing from the dictionary have codes after all of the others,
+            # so put the rows back in the order of the ID strings
+            df_relation = df_relation.sort_values(["source", "target"]).reset_index(
+                drop=True
+            )
+        df_relation.to_parquet(outfp)
 
     logger.debug(
         f"step 6 (merging corpus with openaire and saving files) took {format_timespan(timer()-this_start)}"
@@ -282,6 +686,26 @@ if __name__ == "__main__":
         "path_to_corpus", help="directory with Data Citation Corpus data"
     )
     parser.add_argument("outdir", help="output directory")
+    parser.add_argument(
+        "--corpus-cache",
+        help="directory for the parsed corpus shared with the other scripts that read the corpus (default: .corpus_cache in the corpus directory)",
+    )
+    parser.add_argument(
+        "--id-dictionary",
+        help=f"openaire id dictionary file (default: {ID_DICTIONARY_FILENAME} in path_to_types). if it doesn't exist, it is built from the types files",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=0,
+        help="process the relations out of core, in this many hash partitions spilled to disk (default: 0, all in memory). only the types and doi data for the ids in the relations are held in memory. the rows of the output files are then in partition order",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=-1,
+        help="number of relation files to read in parallel (default: -1, one per CPU)",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
@@ -3,18 +3,19 @@
 DESCRIPTION = """process OpenAIRE graph data files, collecting the type and doi"""
 
 # process OpenAIRE graph data files, collecting the type and doi
-# save output in chunks, deleting as we go to free up memory
+# output is streamed to parquet one row group at a time, to keep memory use down.
+# the tarfile members are processed in parallel, and the results combined into one file per tarfile.
+# at the end, a dictionary of all of the OpenAIRE IDs (openaire_id -> int64 code) is written,
+# which downstream steps use to work with integer codes instead of ID strings
 
 import sys, os, time
 from pathlib import Path
 from datetime import datetime
 from timeit import default_timer as timer
 from typing import Union, List, Optional, Dict, Set
-import tarfile
 import gzip
 import json
 from tqdm import tqdm
-from joblib import Parallel, delayed
 
 try:
     from humanfriendly import format_timespan
@@ -26,6 +27,15 @@ except ImportError:
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from openaire.tar_utils import (
+    TarMember,
+    open_tar_member,
+    run_on_tar_members,
+)
+from openaire.id_dictionary import ID_DICTIONARY_FILENAME, write_id_dictionary
 
 import logging
 
@@ -33,107 +43,199 @@ root_logger = logging.getLogger()
 logger = root_logger.getChild(__name__)
 
 
-def write_types_df_part_file(
-    rows_types: Dict,
-    outfp_types_idx: int,
-    path_to_tarfile: Union[str, Path],
-    output_basedir: Path,
+# schemas of the output files. the filename and tarfile member are the same for long runs of rows,
+# so they are dictionary-encoded (stored once, with an integer code per row)
+OPENAIRE_TYPES_SCHEMA = pa.schema(
+    [
+        ("openaire_id", pa.string()),
+        ("openaire_type", pa.string()),
+        ("openaire_filename", pa.dictionary(pa.int32(), pa.string())),
+        ("tarfile_member", pa.dictionary(pa.int32(), pa.string())),
+    ]
+)
+OPENAIRE_DOIS_SCHEMA = pa.schema(
+    [
+        ("openaire_id", pa.string()),
+        ("doi", pa.string()),
+    ]
+)
+
+
+class StreamingParquetWriter:
+    # buffer rows column by column (no per-row dicts) and write them to a single parquet file
+    # in row groups of `row_group_size` rows, so memory use is bounded by the row group size.
+    # for dictionary-typed columns, the buffer holds integer codes from get_code().
+    # the column lists are cleared in place on flush, so callers can keep references to them
+
+    def __init__(
+        self,
+        outfp: Union[str, Path],
+        schema: pa.Schema,
+        row_group_size: int = 1000000,
+    ) -> None:
+        self.outfp = Path(outfp)
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for name in schema.names}
+        self.dictionaries = {
+            field.name: {} for field in schema if pa.types.is_dictionary(field.type)
+        }
+        self.num_rows = 0
+        self.writer = pq.ParquetWriter(self.outfp, schema)
+
+    def get_code(self, column: str, value: str) -> int:
+        dictionary = self.dictionaries[column]
+        if value not in dictionary:
+            dictionary[value] = len(dictionary)
+        return dictionary[value]
+
+    def maybe_flush(self) -> None:
+        if len(self.columns[self.schema.names[0]]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        num_rows = len(self.columns[self.schema.names[0]])
+        if not num_rows:
+            return
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if pa.types.is_dictionary(field.type):
+                dictionary = list(self.dictionaries[field.name])
+                arr = pa.DictionaryArray.from_arrays(
+                    pa.array(values, type=field.type.index_type),
+                    pa.array(dictionary, type=field.type.value_type),
+                )
+            else:
+                arr = pa.array(values, type=field.type)
+            arrays.append(arr)
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        self.writer.write_batch(batch, row_group_size=self.row_group_size)
+        for values in self.columns.values():
+            values.clear()
+        self.num_rows += num_rows
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+        logger.debug(f"wrote {self.num_rows} rows to {self.outfp}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def collect_from_member(
+    gf,  # uncompressed JSON-lines stream for one tarfile member
+    filename: str,
+    member_name: str,
+    types_writer: StreamingParquetWriter,
+    dois_writer: StreamingParquetWriter,
 ) -> None:
-    # write types df part file
-    path_to_tarfile = Path(path_to_tarfile)
-    outfp = output_basedir.joinpath(
-        f"df_openaire_types_fromfile_{path_to_tarfile.stem}_part{outfp_types_idx:02}.parquet"
+    types_ids = types_writer.columns["openaire_id"]
+    types_types = types_writer.columns["openaire_type"]
+    types_filenames = types_writer.columns["openaire_filename"]
+    types_members = types_writer.columns["tarfile_member"]
+    dois_ids = dois_writer.columns["openaire_id"]
+    dois_dois = dois_writer.columns["doi"]
+    filename_code = types_writer.get_code("openaire_filename", filename)
+    member_code = types_writer.get_code("tarfile_member", member_name)
+    for line in gf:
+        if line:
+            record = json.loads(line)
+            types_ids.append(record["id"])
+            types_types.append(record["type"])
+            types_filenames.append(filename_code)
+            types_members.append(member_code)
+            types_writer.maybe_flush()
+            pid = record.get("pid", [])
+            for item in pid:
+                if item.get("scheme") == "doi":
+                    dois_ids.append(record["id"])
+                    dois_dois.append(item.get("value"))
+            dois_writer.maybe_flush()
+
+
+def get_output_paths(path_to_tarfile: Path, outdir: Path) -> tuple[Path, Path]:
+    outfp_types = outdir.joinpath(
+        f"df_openaire_types_fromfile_{path_to_tarfile.stem}.parquet"
     )
-    out_df = pd.DataFrame(rows_types)
-    logger.debug(f"writing {len(out_df)} rows to {outfp}")
-    out_df.to_parquet(outfp)
-    del out_df
+    outfp_dois = outdir.joinpath(
+        f"df_openaire_dois_fromfile_{path_to_tarfile.stem}.parquet"
+    )
+    return outfp_types, outfp_dois
 
 
-def write_doi_df_part_file(
-    rows_dois: Dict,
-    outfp_dois_idx: int,
-    path_to_tarfile: Union[str, Path],
-    output_basedir: Path,
-) -> None:
-    # write doi df part file
-    path_to_tarfile = Path(path_to_tarfile)
-    outfp = output_basedir.joinpath(
-        f"df_openaire_dois_fromfile_{path_to_tarfile.stem}_part{outfp_dois_idx:02}.parquet"
+def process_one_member(
+    path_to_tarfile: Path,
+    member_idx: int,
+    member: TarMember,
+    partsdir: Path,
+    row_group_size: int = 1000000,
+) -> tuple[Path, Path]:
+    # process a single tarfile member (a gzipped JSON-lines file), writing its own types and doi part files.
+    # these are combined into the per-tarfile output files by combine_parquet_files
+    outfp_types = partsdir.joinpath(
+        f"types_{path_to_tarfile.stem}_{member_idx:05}.parquet"
     )
-    out_df = pd.DataFrame(rows_dois)
-    logger.debug(f"writing {len(out_df)} rows to {outfp}")
-    out_df.to_parquet(outfp)
-    del out_df
+    outfp_dois = partsdir.joinpath(f"dois_{path_to_tarfile.stem}_{member_idx:05}.parquet")
+    with StreamingParquetWriter(
+        outfp_types, OPENAIRE_TYPES_SCHEMA, row_group_size=row_group_size
+    ) as types_writer, StreamingParquetWriter(
+        outfp_dois, OPENAIRE_DOIS_SCHEMA, row_group_size=row_group_size
+    ) as dois_writer:
+        with open_tar_member(path_to_tarfile, member) as f:
+            with gzip.GzipFile(fileobj=f) as gf:
+                collect_from_member(
+                    gf, path_to_tarfile.name, member.name, types_writer, dois_writer
+                )
+    return outfp_types, outfp_dois
 
 
-def process_one_tarfile(
-    path_to_tarfile: Union[str, Path],
-    outdir: Union[str, Path],
-    chunksize: int = 10000000,
+def combine_parquet_files(
+    files: List[Path],
+    outfp: Path,
+    schema: pa.Schema,
+    row_group_size: int = 1000000,
+    sort_by: Optional[str] = None,
 ) -> None:
-    rows_types = []
-    outfp_types_idx = 0
-    rows_dois = []
-    outfp_dois_idx = 0
-    with tarfile.open(path_to_tarfile, "r") as tar:
-        members = list(tar.getmembers())
-        logger.debug(f"file {path_to_tarfile} has {len(members)} members")
-        for member in members:
-            with tar.extractfile(member) as f:
-                with gzip.GzipFile(fileobj=f) as gf:
-                    for line in gf:
-                        if line:
-                            record = json.loads(line)
-                            rows_types.append(
-                                {
-                                    "openaire_id": record["id"],
-                                    "openaire_type": record["type"],
-                                    "openaire_filename": path_to_tarfile.name,
-                                    "tarfile_member": member.name,
-                                }
-                            )
-                            pid = record.get("pid", [])
-                            for item in pid:
-                                if item.get("scheme") == "doi":
-                                    rows_dois.append(
-                                        {
-                                            "openaire_id": record["id"],
-                                            "doi": item.get("value"),
-                                        }
-                                    )
-            if len(rows_types) > chunksize:
-                write_types_df_part_file(
-                    rows_types,
-                    outfp_types_idx,
-                    path_to_tarfile=path_to_tarfile,
-                    output_basedir=outdir,
-                )
-                rows_types = []
-                outfp_types_idx += 1
-
-                write_doi_df_part_file(
-                    rows_dois,
-                    outfp_dois_idx,
-                    path_to_tarfile=path_to_tarfile,
-                    output_basedir=outdir,
-                )
-                rows_dois = []
-                outfp_dois_idx += 1
-
-    # finished with this tarfile, write the final rows
-    write_types_df_part_file(
-        rows_types,
-        outfp_types_idx,
-        path_to_tarfile=path_to_tarfile,
-        output_basedir=outdir,
-    )
-    write_doi_df_part_file(
-        rows_dois,
-        outfp_dois_idx,
-        path_to_tarfile=path_to_tarfile,
-        output_basedir=outdir,
-    )
+    # concatenate parquet files (in order) into one file, in row groups of up to row_group_size rows.
+    # the input files are deleted as they are consumed.
+    # if sort_by is given, all of the rows are read into memory and the output is sorted by that column,
+    # so each row group covers a narrow range of values, and its min/max statistics let readers
+    # that filter on the column skip most row groups
+    if sort_by is not None:
+        tables = [pq.read_table(fp, schema=schema) for fp in files]
+        if tables:
+            table = pa.concat_tables(tables).sort_by(sort_by)
+        else:
+            table = schema.empty_table()
+        pq.write_table(table, outfp, row_group_size=row_group_size)
+        for fp in files:
+            fp.unlink()
+        logger.debug(f"wrote {outfp} (sorted by {sort_by})")
+        return
+    buffer = []
+    num_buffered = 0
+    with pq.ParquetWriter(outfp, schema) as writer:
+        for fp in files:
+            for batch in pq.ParquetFile(fp).iter_batches(batch_size=row_group_size):
+                buffer.append(batch)
+                num_buffered += batch.num_rows
+                if num_buffered >= row_group_size:
+                    table = pa.Table.from_batches(buffer, schema=schema)
+                    writer.write_table(table, row_group_size=row_group_size)
+                    buffer = []
+                    num_buffered = 0
+            fp.unlink()
+        if buffer:
+            writer.write_table(
+                pa.Table.from_batches(buffer, schema=schema),
+                row_group_size=row_group_size,
+            )
+    logger.debug(f"wrote {outfp}")
 
 
 def main(args):
@@ -149,18 +251,47 @@ def main(args):
         raw_data_files = [x for x in raw_data_files if not x.name.startswith(ignore)]
     logger.info(f"found {len(raw_data_files)} raw data files")
     outdir = Path(args.outdir)
-    chunksize = args.chunksize
+    row_group_size = args.row_group_size
+    sort_by = "openaire_id" if args.sort_by_id else None
     n_jobs = args.n_jobs
 
-    parallel_args = [
-        [(fp,), {"outdir": outdir, "chunksize": chunksize}] for fp in raw_data_files
-    ]
-    logger.info(
-        f"running {len(parallel_args)} jobs in parallel -- number of parallel jobs: {n_jobs}"
-    )
-    Parallel(n_jobs=n_jobs, verbose=100)(
-        delayed(process_one_tarfile)(*args, **kwargs) for args, kwargs in parallel_args
+    # members are processed in parallel across all of the tarfiles (largest first),
+    # then the per-member part files are combined into one types file and one doi file per tarfile
+    partsdir = outdir.joinpath("member_parts")
+    partsdir.mkdir(parents=True, exist_ok=True)
+    results = run_on_tar_members(
+        raw_data_files,
+        process_one_member,
+        n_jobs=n_jobs,
+        verbose=100,
+        partsdir=partsdir,
+        row_group_size=row_group_size,
     )
+    for fp in raw_data_files:
+        member_outputs = results.get(fp, [])
+        outfp_types, outfp_dois = get_output_paths(fp, outdir)
+        logger.info(f"combining {len(member_outputs)} member part files for {fp.name}")
+        combine_parquet_files(
+            [types_fp for types_fp, _ in member_outputs],
+            outfp_types,
+            OPENAIRE_TYPES_SCHEMA,
+            row_group_size=row_group_size,
+            sort_by=sort_by,
+        )
+        combine_parquet_files(
+            [dois_fp for _, dois_fp in member_outputs],
+            outfp_dois,
+            OPENAIRE_DOIS_SCHEMA,
+            row_group_size=row_group_size,
+            sort_by=sort_by,
+        )
+    partsdir.rmdir()
+
+    # the dictionary covers all of the types files in the output directory,
+    # including ones from earlier runs on other tarfiles
+    outfp_dictionary = outdir.joinpath(ID_DICTIONARY_FILENAME)
+    logger.info(f"writing openaire id dictionary to {outfp_dictionary}")
+    write_id_dictionary(sorted(outdir.glob("df_openaire_types*.parquet")), outfp_dictionary)
 
 
 if __name__ == "__main__":
@@ -183,13 +314,21 @@ if __name__ == "__main__":
     parser.add_argument("datadir", help="input data directory")
     parser.add_argument("outdir", help="output directory")
     parser.add_argument(
-        "--chunksize",
+        "--row-group-size",
+        type=int,
+        default=1000000,
+        help="number of rows to buffer before writing them out as a parquet row group (default: 1000000)",
+    )
+    parser.add_argument(
+        "--n-jobs",
         type=int,
-        default=10000000,
-        help="save part files when we hit this number of rows",
+        default=1,
+        help="number of parallel jobs to run (tarfile members are spread over the jobs) (default: 1)",
     )
     parser.add_argument(
-        "--n-jobs", default=1, help="number of parallel jobs to run (default: 1)"
+        "--sort-by-id",
+        action="store_true",
+        help="sort each output file by openaire_id, so that loading the files with a filter on the ids can skip most row groups. this needs memory for all of the rows of one output file",
     )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args